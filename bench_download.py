@@ -0,0 +1,137 @@
+import argparse
+import tempfile
+import socket
+import signal
+import time
+import re
+import os
+
+from myhttp.server import HTTPServer, AsyncHTTPServer
+from myhttp.content import HTTPHeaderUtils
+
+
+"""
+    Throughput Benchmark of a Large Download
+        forks a server serving a `--size` MiB file by update_by_file_path(), downloads it `--rounds` times on one keep-alive connection,
+        and reports the throughput and the peak memory (VmHWM) of the server process.
+        With `--ranges N`, each download asks for N disjoint ranges covering half of the file, served as multipart/byteranges.
+        With `--body producer`, the file is streamed chunked by update_by_producer(), with `--body push` by the chunked_transmit() calls of the handler.
+    e.g.
+        python ./bench_download.py --size 1024 --engine asyncio
+        python ./bench_download.py --size 1024 --ranges 8
+        python ./bench_download.py --size 1024 --body producer
+"""
+def cli_parser():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--size', '-s', type = int, default = 1024, help = 'MiB of the file')
+    argument_parser.add_argument('--rounds', '-r', type = int, default = 3)
+    argument_parser.add_argument('--port', '-p', type = int, default = 18082)
+    argument_parser.add_argument('--engine', type = str, default = 'selector', choices = ['selector', 'asyncio'])
+    argument_parser.add_argument('--workers', '-w', type = int, default = 0, help = 'worker threads of the server')
+    argument_parser.add_argument('--ranges', type = int, default = 0, help = 'ranges per request, 0 for the whole file')
+    argument_parser.add_argument('--body', type = str, default = 'file', choices = ['file', 'producer', 'push'], help = 'how the whole file is sent')
+    return argument_parser.parse_args()
+
+
+def run_server(ServerClass, port, file_path, worker_threads, body):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)                                                     # no per-connection logs
+    server = ServerClass('127.0.0.1', port, worker_threads = worker_threads)
+    
+    @server.route('/download', methods = ['GET'])
+    def download(path, parameters, connection_handler):
+        request = connection_handler.request
+        if request.headers.is_exist('Range') and (parsed_range := HTTPHeaderUtils.parse_range(request.headers.get('Range'), os.stat(file_path).st_size)) is not None:
+            ranges, unit = parsed_range
+            connection_handler.response.update_by_file_ranges(file_path, ranges, 'application/octet-stream', boundary = 'bench')
+        elif body == 'producer':
+            connection_handler.response.update_by_producer(open(file_path, 'rb'))
+        elif body == 'push':
+            connection_handler.launch_chunked_transfer()
+            with open(file_path, 'rb') as f:
+                while chunk := f.read(65536):
+                    connection_handler.chunked_transmit(chunk)
+            connection_handler.finish_chunked_transfer()
+        else:
+            connection_handler.response.update_by_file_path(file_path, use_mime = False)
+    
+    server.launch()
+
+
+def peak_memory(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return line.split(':')[1].strip()
+    return 'unknown'
+
+
+if __name__ == '__main__':
+    args = cli_parser()
+    size = args.size * 1024 * 1024
+    
+    with tempfile.NamedTemporaryFile() as file:
+        chunk = b'x' * (1024 * 1024)
+        for _ in range(args.size):
+            file.write(chunk)
+        file.flush()
+        
+        ServerClass = AsyncHTTPServer if args.engine == 'asyncio' else HTTPServer
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_server(ServerClass, args.port, file.name, args.workers, args.body)
+            finally:
+                os._exit(0)
+        
+        try:
+            # wait for the server
+            for _ in range(100):
+                try:
+                    socket.create_connection(('127.0.0.1', args.port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+            time.sleep(0.5)
+            
+            request = b'GET /download HTTP/1.1\r\nHost: localhost\r\n'
+            if args.ranges > 0:
+                step = size // args.ranges
+                request += ('Range: bytes=' + ','.join(f'{i * step}-{i * step + step // 2 - 1}' for i in range(args.ranges)) + '\r\n').encode()
+            request += b'\r\n'
+            
+            connection = socket.create_connection(('127.0.0.1', args.port))
+            buffer = bytearray(1024 * 1024)
+            downloaded = 0
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                connection.sendall(request)
+                head = b''
+                while b'\r\n\r\n' not in head:
+                    head += connection.recv(4096)
+                head, body = head.split(b'\r\n\r\n', 1)
+                received = len(body)
+                if b'transfer-encoding: chunked' in head.lower():
+                    # the file is all b'x', so the last chunk is the only b'\r\n0\r\n\r\n'
+                    tail = body[-7:]
+                    while not tail.endswith(b'\r\n0\r\n\r\n'):
+                        n = connection.recv_into(buffer)
+                        received += n
+                        tail = (tail + buffer[max(n - 7, 0):n])[-7:]
+                    downloaded += size
+                    continue
+                length = re.search(rb'content-length: (\d+)', head.lower())
+                if not length or (args.ranges == 0 and int(length[1]) != size):
+                    raise SystemExit(f'Unexpected response: {head[:200]}')
+                length = int(length[1])
+                while received < length:
+                    received += connection.recv_into(buffer)
+                downloaded += length
+            elapsed = time.perf_counter() - start
+            connection.close()
+            
+            print(f'engine: {args.engine}, workers: {args.workers}, body: {args.body}, ranges: {args.ranges}, downloaded: {downloaded / 1048576:.0f} MiB in {args.rounds} rounds')
+            print(f'elapsed: {elapsed:.2f} s, throughput: {downloaded / 1048576 / elapsed:.1f} MiB/s, server peak memory: {peak_memory(pid)}')
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
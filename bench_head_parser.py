@@ -0,0 +1,71 @@
+import argparse
+import timeit
+
+from myhttp.message import HTTPRequestLine, HTTPHeaders, HTTPRequestMessage
+from myhttp.exception import HTTPStatusException
+
+
+"""
+    Benchmark of the Request Head Parser
+        parses typical browser request heads with HTTPRequestMessage.parse_head()
+        and with the former parser (request line and header lines decoded and split one by one), kept below for comparison.
+    e.g.
+        python ./bench_head_parser.py --number 100000
+"""
+def cli_parser():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--number', '-n', type = int, default = 100000, help = 'heads parsed per round')
+    argument_parser.add_argument('--repeat', '-r', type = int, default = 5, help = 'rounds, the best one is reported')
+    return argument_parser.parse_args()
+
+
+heads = {
+    'short': (
+        b'GET / HTTP/1.1\r\n'
+        b'Host: localhost:8080'
+    ),
+    'browser': (
+        b'GET /client1/photos/2024/IMG_0001.jpg?download=1 HTTP/1.1\r\n'
+        b'Host: localhost:8080\r\n'
+        b'Connection: keep-alive\r\n'
+        b'Cache-Control: max-age=0\r\n'
+        b'Authorization: Basic Y2xpZW50MToxMjM=\r\n'
+        b'Upgrade-Insecure-Requests: 1\r\n'
+        b'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36\r\n'
+        b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8\r\n'
+        b'Sec-Fetch-Site: same-origin\r\n'
+        b'Sec-Fetch-Mode: navigate\r\n'
+        b'Sec-Fetch-Dest: document\r\n'
+        b'Referer: http://localhost:8080/client1/photos/\r\n'
+        b'Accept-Encoding: gzip, deflate, br\r\n'
+        b'Accept-Language: en-US,en;q=0.9\r\n'
+        b'Cookie: session-id=4a1f0c9e2b7d4e8f9a6b3c2d1e0f9a8b; theme=dark'
+    ),
+}
+
+
+def legacy_parse_head(head):
+    eorl = head.find(b'\r\n')
+    
+    splitted = head[:eorl].decode().split(' ')
+    if len(splitted) != 3:
+        raise HTTPStatusException(400)
+    request_line = HTTPRequestLine(splitted[0], splitted[1], splitted[2])
+    
+    headers = {}
+    for line in head[(eorl + 2):].split(b'\r\n'):
+        splitted = line.decode().split(':', 1)
+        if len(splitted) == 2:
+            headers[splitted[0].lower().strip()] = splitted[1].strip()
+        elif len(line) != 0:
+            raise HTTPStatusException(400)
+    return request_line, HTTPHeaders(headers)
+
+
+if __name__ == '__main__':
+    args = cli_parser()
+    for name, head in heads.items():
+        assert legacy_parse_head(head)[1].headers == HTTPRequestMessage.parse_head(head)[1].headers
+        legacy = min(timeit.repeat(lambda: legacy_parse_head(head), number = args.number, repeat = args.repeat)) / args.number
+        current = min(timeit.repeat(lambda: HTTPRequestMessage.parse_head(head, 100), number = args.number, repeat = args.repeat)) / args.number
+        print(f'{name} ({len(head)} bytes): former {legacy * 1e6:.2f} us, parse_head() {current * 1e6:.2f} us, {legacy / current:.2f}x')
@@ -0,0 +1,97 @@
+import argparse
+import resource
+import socket
+import signal
+import time
+import os
+
+from myhttp.server import HTTPServer, AsyncHTTPServer
+
+
+"""
+    Memory Benchmark of Idle Keep-Alive Connections
+        forks a server, opens `--connections` keep-alive connections (one request each, then idle)
+        and reports the RSS of the server process per connection.
+    e.g.
+        python ./bench_idle_connections.py -n 10000 --engine asyncio
+"""
+def cli_parser():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--connections', '-n', type = int, default = 10000)
+    argument_parser.add_argument('--port', '-p', type = int, default = 18080)
+    argument_parser.add_argument('--engine', type = str, default = 'selector', choices = ['selector', 'asyncio'])
+    return argument_parser.parse_args()
+
+
+def rss_of(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def run_server(ServerClass, port):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)                                                     # no per-connection logs
+    server = ServerClass('127.0.0.1', port)
+    
+    @server.route('/')
+    def index(path, parameters, connection_handler):
+        connection_handler.response.update_by_content_type('ok')
+    
+    server.ConnectionHandlerClass.keep_alive_timeout = 3600                 # stay idle during the benchmark
+    server.launch()
+
+
+if __name__ == '__main__':
+    args = cli_parser()
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if args.connections + 64 > hard:
+        raise SystemExit(f'RLIMIT_NOFILE ({hard}) is too low for {args.connections} connections')
+    
+    ServerClass = AsyncHTTPServer if args.engine == 'asyncio' else HTTPServer
+    ServerClass.backlog_size = 1024
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_server(ServerClass, args.port)
+        finally:
+            os._exit(0)
+    
+    try:
+        # wait for the server
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', args.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        time.sleep(0.5)
+        rss_before = rss_of(pid)
+        
+        # open idle keep-alive connections
+        request = b'GET / HTTP/1.1\r\nHost: localhost\r\nConnection: keep-alive\r\n\r\n'
+        connections = []
+        for _ in range(args.connections):
+            connection = socket.create_connection(('127.0.0.1', args.port))
+            connection.sendall(request)
+            connections.append(connection)
+        for connection in connections:
+            response = b''
+            while not response.endswith(b'ok'):
+                data = connection.recv(4096)
+                if not data:
+                    raise SystemExit('Connection closed by the server')
+                response += data
+        time.sleep(1.0)
+        rss_after = rss_of(pid)
+        
+        print(f'engine: {args.engine}, connections: {args.connections}')
+        print(f'RSS before: {rss_before / 1024 / 1024:.1f} MiB, after: {rss_after / 1024 / 1024:.1f} MiB')
+        print(f'RSS per idle connection: {(rss_after - rss_before) / args.connections:.0f} bytes')
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
@@ -0,0 +1,99 @@
+import argparse
+import socket
+import signal
+import time
+import os
+
+from myhttp.server import HTTPServer, AsyncHTTPServer
+
+
+"""
+    Throughput Benchmark of a Large Upload
+        forks a server, POSTs `--size` MiB with Content-Length on one connection
+        and reports the time until the response (the server replies with the body length it received),
+        then the recv calls the server made per request (GET /stats).
+    e.g.
+        python ./bench_upload.py --size 1024 --engine asyncio
+"""
+def cli_parser():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument('--size', '-s', type = int, default = 1024, help = 'MiB to upload')
+    argument_parser.add_argument('--port', '-p', type = int, default = 18081)
+    argument_parser.add_argument('--engine', type = str, default = 'selector', choices = ['selector', 'asyncio'])
+    return argument_parser.parse_args()
+
+
+def run_server(ServerClass, port):
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)                                                     # no per-connection logs
+    server = ServerClass('127.0.0.1', port)
+    
+    @server.route('/upload', methods = ['POST'])
+    def upload(path, parameters, connection_handler):
+        connection_handler.response.update_by_content_type(str(len(connection_handler.request.body)))
+    
+    @server.route('/stats', methods = ['GET'])
+    def stats(path, parameters, connection_handler):
+        connection_handler.response.update_by_content_type(f'{server.reads_per_request():.1f}')
+    
+    server.ConnectionHandlerClass.body_min_rate = 0                         # the client may be slower than the server
+    server.launch()
+
+
+if __name__ == '__main__':
+    args = cli_parser()
+    size = args.size * 1024 * 1024
+    
+    ServerClass = AsyncHTTPServer if args.engine == 'asyncio' else HTTPServer
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_server(ServerClass, args.port)
+        finally:
+            os._exit(0)
+    
+    try:
+        # wait for the server
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', args.port)).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        time.sleep(0.5)
+        
+        chunk = b'x' * (1024 * 1024)
+        connection = socket.create_connection(('127.0.0.1', args.port))
+        start = time.perf_counter()
+        connection.sendall(f'POST /upload HTTP/1.1\r\nHost: localhost\r\nContent-Length: {size}\r\nConnection: close\r\n\r\n'.encode())
+        for _ in range(args.size):
+            connection.sendall(chunk)
+        response = b''
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                break
+            response += data
+        elapsed = time.perf_counter() - start
+        connection.close()
+        
+        received = response.rsplit(b'\r\n\r\n', 1)[-1].decode()
+        if received != str(size):
+            raise SystemExit(f'Unexpected response: {response[:200]}')
+        print(f'engine: {args.engine}, uploaded: {args.size} MiB')
+        print(f'elapsed: {elapsed:.2f} s, throughput: {args.size / elapsed:.1f} MiB/s')
+        
+        connection = socket.create_connection(('127.0.0.1', args.port))
+        connection.sendall(b'GET /stats HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+        response = b''
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                break
+            response += data
+        connection.close()
+        reads_per_request = response.rsplit(b'\r\n\r\n', 1)[-1].decode()
+        print(f'reads per request: {reads_per_request} (the upload and the stats request)')
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
@@ -79,6 +79,16 @@ class EncryptedHTTPClient():
         response = HTTPResponseMessage(status_line, headers, buf)
         return response
     
+    def recv_exactly(self, length):
+        # recv() may return less than asked for, e.g. when the server coalesces writes
+        buf = b""
+        while len(buf) < length:
+            data = self.client_socket.recv(min(length - len(buf), self.recv_block_size))
+            if not data:
+                raise ConnectionError('Connection closed by the server')
+            buf += data
+        return buf
+    
     def rsa_encrypt(self, message):
         rsa_cipher = PKCS1_OAEP.new(RSA.import_key(self.rsa_public_key))
         return rsa_cipher.encrypt(message)
@@ -133,11 +143,8 @@ class EncryptedHTTPClient():
                     while len(rec_buf) < 2 or rec_buf[-2:] != b'\r\n':
                         rec_buf += self.client_socket.recv(1)
                     lenth = int(rec_buf[:-2], 16)
-                    rec_buf = b""
-                    for i in range(0, lenth // self.recv_block_size):
-                        rec_buf += self.client_socket.recv(self.recv_block_size)
-                    rec_buf += self.client_socket.recv(lenth % self.recv_block_size)
-                    self.client_socket.recv(2)
+                    rec_buf = self.recv_exactly(lenth)
+                    self.recv_exactly(2)
                     if (lenth == 0):
                         break
                     else:
@@ -1,31 +1,78 @@
 import threading
+import asyncio
 import mimetypes
+import posixpath
+import gzip
 import pickle
+import base64
 import shutil
+import stat
 import json
 import time
 import os
 import re
 
-from myhttp.server import HTTPServer, HTTPConnectionHandler
+from myhttp.server import HTTPServer, AsyncTCPSocketServer, HTTPConnectionHandler
 from myhttp.exception import HTTPStatusException
-from myhttp.content import HTTPBodyUtils, HTTPHeaderUtils, HTMLUtils, KeyUtils
+from myhttp.log import log_print, LogLevel
+from myhttp.content import HTTPBodyUtils, HTTPHeaderUtils, TemplateCache, FileCache, MetadataCache, DirectoryCache, DirectoryListing, KeyUtils, MultipartFormDataParser
 
 from .page_renderer import *
+from .MetadataIndex import MetadataIndex
+
+try:
+    import fcntl # not available on Windows, where only threads are synchronized
+except ImportError:
+    fcntl = None
+
+
+"""
+    SharedLock
+        re-entrant within a process (threading.RLock), and exclusive across processes (flock on `lockpath`),
+        so pre-forked workers read and write the same pickle files consistently.
+"""
+class SharedLock:
+    def __init__(self, lockpath):
+        self.lockpath = lockpath
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+    
+    def acquire(self):
+        self.thread_lock.acquire()
+        self.depth += 1
+        if self.depth == 1 and fcntl:
+            self.lock_file = open(self.lockpath, 'a') # opened per acquisition, never shared with forked processes
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+    
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.lock_file:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+        self.thread_lock.release()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
 
 
 class UserManager:
     # user data format: {'<username>': info}, info = {'password': password, 'email': email, ...}
     def __init__(self, filepath):
         self.filepath = filepath
-        self.lock = threading.Lock()
+        self.lock = SharedLock(filepath + '.lock') # re-entrant, so read-modify-write sequences can hold it as a whole
 
     def _read(self):
-        if not os.path.exists(self.filepath):
-            self._write({})
-        
         self.lock.acquire()
         try:
+            if not os.path.exists(self.filepath):
+                self._write({})
+            
             with open(self.filepath, 'rb') as file:
                 data = pickle.load(file)
                 return data if data else {}
@@ -41,19 +88,21 @@ class UserManager:
             self.lock.release()
 
     def register(self, username, password, update_info = {}):
-        data = self._read()
-        data[username] = {'password': password, **update_info}
-        self._write(data)
+        with self.lock:
+            data = self._read()
+            data[username] = {'password': password, **update_info}
+            self._write(data)
     
     def get(self, username):
         data = self._read()
         return data.get(username, None)
 
     def remove(self, username):
-        data = self._read()
-        if username in data:
-            del data[username]
-            self._write(data)
+        with self.lock:
+            data = self._read()
+            if username in data:
+                del data[username]
+                self._write(data)
 
     def authenticate(self, username, password):
         data = self._read()
@@ -66,14 +115,14 @@ class CookieManager:
     
     def __init__(self, filepath):
         self.filepath = filepath
-        self.lock = threading.Lock()
+        self.lock = SharedLock(filepath + '.lock') # re-entrant, so read-modify-write sequences can hold it as a whole
 
     def _read(self):
-        if not os.path.exists(self.filepath):
-            self._write({})
-        
         self.lock.acquire()
         try:
+            if not os.path.exists(self.filepath):
+                self._write({})
+            
             with open(self.filepath, 'rb') as file:
                 data = pickle.load(file)
                 return data if data else {}
@@ -89,25 +138,273 @@ class CookieManager:
             self.lock.release()
 
     def get(self, cookie):
-        data = self._read()
-        for c in list(data.keys()):
-            if data[c].get('time_stamp', 0) + data[c].get('expire_time', CookieManager.default_expire_time) < time.time_ns():
-                data.pop(c)
-        self._write(data)
-        return data.get(cookie, None)
+        with self.lock:
+            data = self._read()
+            for c in list(data.keys()):
+                if data[c].get('time_stamp', 0) + data[c].get('expire_time', CookieManager.default_expire_time) < time.time_ns():
+                    data.pop(c)
+            self._write(data)
+            return data.get(cookie, None)
 
     def new(self, username, time_stamp, expire_time = default_expire_time, extend_info = {}):
-        data = self._read()
-        cookie = KeyUtils.random_key(not_in = data)
-        data[cookie] = {'username': username, 'time_stamp': time_stamp, 'expire_time': expire_time, **extend_info}
-        self._write(data)
-        return cookie
+        with self.lock:
+            data = self._read()
+            cookie = KeyUtils.random_key(not_in = data)
+            data[cookie] = {'username': username, 'time_stamp': time_stamp, 'expire_time': expire_time, **extend_info}
+            self._write(data)
+            return cookie
 
     def remove(self, cookie):
-        data = self._read()
-        if cookie in data:
-            del data[cookie]
+        with self.lock:
+            data = self._read()
+            if cookie in data:
+                del data[cookie]
+                self._write(data)
+
+
+"""
+    UsageManager
+        bytes and files (folders included, like the inodes of a disk quota) under each directory of each user,
+        measured by walking the user directory once, then kept up to date by the server as it changes the tree.
+        Nothing is recorded for a user not measured yet (the changes will be part of the measurement), and forget() a user
+        whose tree may have changed unaccounted (e.g. a failed rmtree, or files edited by hand) to measure it again.
+"""
+class UsageManager:
+    # usage data format: {'<username>': {'<directory>': [bytes, files]}}, directory = `<user>` or `<user>/<path>`
+    def __init__(self, filepath, root_dir):
+        self.filepath = filepath
+        self.root_dir = root_dir
+        self.lock = SharedLock(filepath + '.lock') # re-entrant, so read-modify-write sequences can hold it as a whole
+        self.data = None                                                    # as last read or written, see _read()
+        self.version = None
+    
+    def _read(self):
+        # loaded again only once written by another process, as it grows with the directories of the users
+        self.lock.acquire()
+        try:
+            if not os.path.exists(self.filepath):
+                self._write({})
+            
+            file_stat = os.stat(self.filepath)
+            version = (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+            if version != self.version:
+                with open(self.filepath, 'rb') as file:
+                    data = pickle.load(file)
+                    self.data = data if data else {}
+                self.version = version
+            return self.data
+        finally:
+            self.lock.release()
+    
+    def _write(self, data):
+        self.lock.acquire()
+        try:
+            temp_path = f'{self.filepath}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as file:
+                pickle.dump(data, file)
+            os.replace(temp_path, self.filepath)                            # a new inode, so that _read() of other processes tells it apart
+            file_stat = os.stat(self.filepath)
+            self.data, self.version = data, (file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+        finally:
+            self.lock.release()
+    
+    def measure(self, username):
+        # [bytes, files] of the user directory and of every directory under it, walked breadth-first without following symbolic links
+        totals = {username: [0, 0]}
+        directories = [username]
+        for directory in directories:                                       # extended while iterating
+            try:
+                with os.scandir(self.root_dir + directory) as it:
+                    for entry in it:
+                        totals[directory][1] += 1
+                        if entry.is_dir(follow_symlinks = False):
+                            totals[directory + '/' + entry.name] = [0, 0]
+                            directories.append(directory + '/' + entry.name)
+                        else:
+                            try:
+                                totals[directory][0] += entry.stat(follow_symlinks = False).st_size
+                            except OSError:
+                                pass # removed meanwhile
+            except OSError:
+                continue # e.g. the user directory not created yet
+        for directory in reversed(directories[1:]):                         # every directory after those under it
+            parent = posixpath.dirname(directory)
+            totals[parent][0] += totals[directory][0]
+            totals[parent][1] += totals[directory][1]
+        return totals
+    
+    def get(self, path, measure = True):
+        # {'bytes': bytes, 'files': files} under a directory (e.g. `<user>`), measuring the user first if needed, None if it is not a known directory
+        path = MetadataIndex.normalize(path)
+        if path is None:
+            return None
+        username = path.split('/')[0]
+        if measure and username not in self._read():
+            totals = self.measure(username)                                 # without the lock, which other processes wait for
+            with self.lock:
+                data = self._read()
+                if username not in data:
+                    data[username] = totals
+                    self._write(data)
+        with self.lock:
+            totals = self._read().get(username, {}).get(path)
+            return {'bytes': totals[0], 'files': totals[1]} if totals else None
+    
+    def forget(self, username):
+        with self.lock:
+            data = self._read()
+            if username in data:
+                del data[username]
+                self._write(data)
+    
+    """
+        Updates, by the server after changing the tree
+    """
+    
+    def _apply(self, data, directory, size, files):
+        # add to the totals of `directory` and of every directory above it, up to the user directory
+        totals = data.get(directory.split('/')[0])
+        while totals is not None and directory:
+            if directory in totals:
+                totals[directory][0] += size
+                totals[directory][1] += files
+            directory = posixpath.dirname(directory)
+    
+    def created(self, path):
+        # an empty directory created at `path`
+        path = MetadataIndex.normalize(path)
+        with self.lock:
+            data = self._read()
+            if path is None or path.split('/')[0] not in data or path in data[path.split('/')[0]]:
+                return
+            data[path.split('/')[0]][path] = [0, 0]
+            self._apply(data, posixpath.dirname(path), 0, 1)
+            self._write(data)
+    
+    def written(self, path, size, old_size = None):
+        # a file of `size` bytes written at `path`, replacing one of `old_size` bytes if it existed
+        path = MetadataIndex.normalize(path)
+        with self.lock:
+            data = self._read()
+            if path is None or path.split('/')[0] not in data:
+                return
+            self._apply(data, posixpath.dirname(path), size - (old_size or 0), 1 if old_size is None else 0)
+            self._write(data)
+    
+    def removed(self, path, size = 0):
+        # a file of `size` bytes, or a directory with everything under it (as recorded, `size` is ignored), removed from `path`
+        path = MetadataIndex.normalize(path)
+        with self.lock:
+            data = self._read()
+            if path is None or path.split('/')[0] not in data:
+                return
+            totals = data[path.split('/')[0]]
+            if path == path.split('/')[0]:
+                del data[path]                                              # the user directory itself, measured again once created
+            elif path in totals:
+                size, files = totals[path][0], totals[path][1] + 1
+                for directory in [directory for directory in totals if directory == path or directory.startswith(path + '/')]:
+                    del totals[directory]
+            else:
+                files = 1
+            self._apply(data, posixpath.dirname(path), -size, -files)
+            self._write(data)
+    
+    def moved(self, old_path, new_path, size = 0):
+        # a file of `size` bytes, or a directory with everything under it, renamed from `old_path` to `new_path` of the same user (removed() what it replaced first)
+        old_path, new_path = MetadataIndex.normalize(old_path), MetadataIndex.normalize(new_path)
+        with self.lock:
+            data = self._read()
+            if old_path is None or new_path is None or old_path.split('/')[0] not in data:
+                return
+            totals = data[old_path.split('/')[0]]
+            if old_path in totals:
+                size, files = totals[old_path][0], totals[old_path][1] + 1
+                for directory in [directory for directory in totals if directory == old_path or directory.startswith(old_path + '/')]:
+                    totals[new_path + directory[len(old_path):]] = totals.pop(directory)
+            else:
+                files = 1
+            self._apply(data, posixpath.dirname(old_path), -size, -files)
+            self._apply(data, posixpath.dirname(new_path), size, files)
             self._write(data)
+    
+    def lookup(self, directory, names):
+        # [bytes, files] of the directories `names` in `directory` (each None if unknown), e.g. for the entries of a listing
+        directory = MetadataIndex.normalize(directory)
+        if directory is None or self.get(directory) is None:
+            return [None] * len(names)
+        with self.lock:
+            totals = self._read().get(directory.split('/')[0], {})
+            return [tuple(totals[directory + '/' + name]) if directory + '/' + name in totals else None for name in names]
+
+
+"""
+    UploadStream
+        multipart/form-data upload parsed while being received, each file part is written to a temporary file in `temp_dir`
+        (`upload_dir` of the server, out of the listed tree) and moved by FileManagerServer.upload_file()
+        once the request is authorized; what is left is deleted on close(), or by FileManagerServer.clean_uploads() after a crash.
+        A body longer than `max_size` (what is left of the quota) is discarded as soon as it gets over it, see `exceeded`.
+"""
+class UploadStream(MultipartFormDataParser):
+    def __init__(self, boundary, temp_dir, max_size = None):
+        super().__init__(boundary, self.open_part)
+        self.temp_dir = temp_dir
+        self.temp_paths = []
+        self.max_size = max_size
+        self.received = 0
+        self.exceeded = False
+    
+    def write(self, data):
+        self.received += len(data)
+        if self.exceeded or (self.max_size is not None and self.received > self.max_size):
+            if not self.exceeded:
+                self.exceeded = True
+                self.close()                                                # the temporary files are deleted at once, the rest of the body is only received
+            return len(data)
+        return super().write(data)
+    
+    def open_part(self, file_item):
+        if not file_item.get('filename', None):
+            return None # not a file
+        temp_path = self.temp_dir + '.upload-' + KeyUtils.random_key()
+        part_file = open(temp_path, 'xb') # created with the same permissions as other uploaded files
+        self.temp_paths.append(temp_path)
+        return part_file
+    
+    def close(self):
+        super().close()
+        for temp_path in self.temp_paths:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass # moved into place
+        self.temp_paths = []
+
+
+"""
+    PathMetadata
+        what fetch_handler() needs to know about a path, from a single stat()
+"""
+class PathMetadata:
+    __slots__ = ('real_path', 'stat', 'is_directory', 'is_file', 'content_type', 'content_disposition')
+    
+    def __init__(self, real_path, stat_result):
+        self.real_path = real_path
+        self.stat = stat_result
+        self.is_directory = stat.S_ISDIR(stat_result.st_mode)
+        self.is_file = stat.S_ISREG(stat_result.st_mode)
+        self.content_type, file_encoding = mimetypes.guess_type(real_path) if self.is_file else (None, None)
+        self.content_disposition = 'inline'
+        if not self.content_type or file_encoding:                                          # e.g. `.tar.gz`, downloaded as it is, never decoded by the browser
+            self.content_type = 'application/octet-stream'
+            self.content_disposition = 'attachment'
+    
+    @classmethod
+    def from_path(c, real_path):
+        try:
+            return c(real_path, os.stat(real_path))
+        except (FileNotFoundError, NotADirectoryError):
+            return None # e.g. `/abc/def.jpg/` when `def.jpg` is a file
 
 
 """
@@ -115,6 +412,12 @@ class CookieManager:
         all the `path` (`<user>/<path>`) in this class is relative to `root_dir`
 """
 class FileManagerServer(HTTPServer):
+    template_extensions = ('.html', '.js', '.css')                                          # resources rendered as templates, the others are served as they are
+    listing_page_size = 1000                                                                # entries per page of a listing by default, also inlined into the directory page
+    listing_max_page_size = 10000
+    listing_parameters = ('limit', 'cursor', 'sort', 'order', 'filter')                     # any of them asks for a page of the listing, see list_directory_page()
+    upload_stale_time = 24 * 60 * 60                                                        # seconds after which a temporary file of an upload is left by a crash, see clean_uploads()
+    
     """
         Routes
     """
@@ -136,11 +439,9 @@ class FileManagerServer(HTTPServer):
         if not server.is_file(virtual_path, resourse = True):                               # path is not a file
             raise HTTPStatusException(400, 'Resource Not File')
         
-        response.update_by_file_path(server.get_path(virtual_path, resourse = True))
-        response.update_body(HTMLUtils.render_template(response.body.decode(), {
-            **parameters,
-            **get_file_manager_rendering_extended_variables(server)
-        }).encode())
+        file_path = server.get_path(virtual_path, resourse = True)
+        if not server.check_not_modified(connection_handler, os.stat(file_path)):           # 304 if the copy of the client is still valid
+            server.render_resource(connection_handler, file_path, parameters)
     
     def api_user_register(path, parameters, connection_handler):
         request = connection_handler.request
@@ -157,8 +458,7 @@ class FileManagerServer(HTTPServer):
         if not parameters.__contains__('path'):                                             # param path not exist
             raise HTTPStatusException(400, 'Param path Not Exist')
         
-        virtual_path = parameters.get('path').strip('/')                                    # target path (virtual)
-        located_user = server.belongs_to(virtual_path)                                      # target user
+        virtual_path, located_user = server.locate(parameters.get('path'))                  # target path (virtual) and its user
         
         username, new_cookie = server.authenticate(connection_handler)                      # authenticate
         if new_cookie:
@@ -182,8 +482,7 @@ class FileManagerServer(HTTPServer):
         
         # TODO: is file name valid?
         
-        virtual_path = parameters.get('path').strip('/')                                    # target path (virtual)
-        located_user = server.belongs_to(virtual_path)                                      # target user
+        virtual_path, located_user = server.locate(parameters.get('path'))                  # target path (virtual) and its user
         
         username, new_cookie = server.authenticate(connection_handler)                      # authenticate
         if new_cookie:
@@ -195,7 +494,111 @@ class FileManagerServer(HTTPServer):
             raise HTTPStatusException(404)
         
         prefix_path = '/'.join(virtual_path.split('/')[:-1])
-        os.rename(server.get_path(virtual_path), server.get_path(prefix_path + '/' + parameters.get('rename')))
+        new_virtual_path, new_user = server.locate(prefix_path + '/' + parameters.get('rename'))
+        if new_user != username:                                                            # out of the user's tree, where its usage is not accounted
+            raise HTTPStatusException(403)
+        
+        new_path = server.get_path(new_virtual_path)
+        with server.usage_manager.lock:                                                     # accounted as a whole, see UsageManager
+            size, replaced_size = FileManagerServer.file_size(server.get_path(virtual_path)), FileManagerServer.file_size(new_path)
+            try:
+                os.rename(server.get_path(virtual_path), new_path)
+            finally:
+                server.invalidate(server.get_path(virtual_path))
+                server.invalidate(new_path)                                                 # replaced, if it existed
+            if new_virtual_path != virtual_path:
+                if replaced_size is not None:
+                    server.usage_manager.removed(new_virtual_path, replaced_size)
+                server.usage_manager.moved(virtual_path, new_virtual_path, size)
+        if server.metadata_index:
+            server.metadata_index.move(virtual_path, new_virtual_path)
+    
+    def api_search(path, parameters, connection_handler):
+        server = connection_handler.server
+        response = connection_handler.response
+        
+        username, new_cookie = server.authenticate(connection_handler)                      # authenticate
+        if new_cookie:
+            response.update_header('Set-Cookie', f'session-id={new_cookie}')
+        
+        if server.metadata_index is None:                                                   # see `metadata_index` of FileManagerServer
+            raise HTTPStatusException(404, 'Search Not Enabled')
+        if not parameters.get('q'):                                                         # param q not exist
+            raise HTTPStatusException(400, 'Param q Not Exist')
+        
+        scope, located_user = server.locate(parameters.get('path', username))               # the user's tree, or a directory in it
+        if located_user != username:                                                        # wrong user
+            raise HTTPStatusException(403)
+        mode = parameters.get('mode', 'substring')
+        if mode not in MetadataIndex.search_modes:
+            raise HTTPStatusException(400, 'Invalid Mode')
+        try:
+            limit = int(parameters.get('limit', 100))
+        except ValueError:
+            raise HTTPStatusException(400, 'Invalid Limit')
+        if not 0 < limit <= 1000:
+            raise HTTPStatusException(400, 'Invalid Limit')
+        try:
+            cursor = parameters.get('cursor')
+            after = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode() if cursor else None # the last path of the previous page
+        except ValueError:                                                                  # e.g. not base64, not utf-8
+            raise HTTPStatusException(400, 'Invalid Cursor')
+        
+        results, last_path = server.metadata_index.search(scope, parameters['q'], mode, limit, after)
+        response.update_by_content_type(
+            body = json.dumps({
+                'results': [{
+                    'path': result_path,
+                    'name': name,
+                    'type': 'directory' if is_directory else 'file',
+                    'size': size,
+                    'mtime': mtime,
+                } for result_path, name, is_directory, size, mtime in results],
+                'next_cursor': last_path and base64.urlsafe_b64encode(last_path.encode()).decode().rstrip('='),
+                'indexing': server.metadata_index.reconciled_at() is None,                  # not built yet, some paths may be missing
+            }),
+            content_type = 'application/json',
+        )
+    
+    def api_usage(path, parameters, connection_handler):
+        server = connection_handler.server
+        response = connection_handler.response
+        
+        username, new_cookie = server.authenticate(connection_handler)                      # authenticate
+        if new_cookie:
+            response.update_header('Set-Cookie', f'session-id={new_cookie}')
+        
+        virtual_path, located_user = server.locate(parameters.get('path', username))        # the user's tree, or a directory in it
+        if located_user != username:                                                        # wrong user
+            raise HTTPStatusException(403)
+        usage = server.usage_manager.get(virtual_path)                                      # measured once, see UsageManager
+        if usage is None:                                                                   # not a directory
+            raise HTTPStatusException(404)
+        
+        quota_bytes, quota_files = server.get_quota(username)
+        response.update_by_content_type(
+            body = json.dumps({
+                'path': virtual_path,
+                'bytes': usage['bytes'],
+                'files': usage['files'],                                                    # folders included
+                'quota_bytes': quota_bytes,                                                 # null for no limit
+                'quota_files': quota_files,
+            }),
+            content_type = 'application/json',
+        )
+    
+    def api_cache_stats(path, parameters, connection_handler):
+        server = connection_handler.server
+        response = connection_handler.response
+        
+        username, new_cookie = server.authenticate(connection_handler)                      # authenticate
+        if new_cookie:
+            response.update_header('Set-Cookie', f'session-id={new_cookie}')
+        
+        response.update_by_content_type(
+            body = json.dumps(server.file_cache.stats()),                                   # hits, misses, evictions, ... of FileCache
+            content_type = 'application/json',
+        )
 
     def fetch_handler(path, parameters, connection_handler):
         request = connection_handler.request
@@ -211,76 +614,65 @@ class FileManagerServer(HTTPServer):
         if new_cookie:
             response.update_header('Set-Cookie', f'session-id={new_cookie}')
         
-        if not server.is_exist(virtual_path):                                               # path not exist, wrong path like `/abc/def.jpg/` (when `def.jpg` is in fact a file) will failed in this step
+        metadata = server.resolve(virtual_path)                                             # one stat(), see resolve()
+        if metadata is None:                                                                # path not exist, wrong path like `/abc/def.jpg/` (when `def.jpg` is in fact a file) will failed in this step
             raise HTTPStatusException(404)
         
-        if server.is_directory(virtual_path): # and path[-1] == '':                         # 如果确实是目录，则忽略缺少末尾斜杠的错误
+        if metadata.is_directory: # and path[-1] == '':                                     # 如果确实是目录，则忽略缺少末尾斜杠的错误
+            directory_stat = metadata.stat                                                  # its mtime changes as entries are added, removed or renamed
             if parameters.get('SUSTech-HTTP', '0') != '0':
-                # SUSTech-HTTP == 1, return json list
+                # SUSTech-HTTP == 1, return json list, or a page of it with entry details if any of `listing_parameters` is given
+                if any(key in parameters for key in server.listing_parameters):
+                    body = server.list_directory_page(virtual_path, parameters)
+                    if server.check_not_modified(connection_handler, content = body.encode()): # sizes and mtimes change without the directory
+                        return
+                else:
+                    if server.check_not_modified(connection_handler, directory_stat):      # names change with the directory mtime
+                        return
+                    body = server.list_directory(virtual_path)
                 response.update_by_content_type(
-                    body = server.list_directory(virtual_path),
+                    body = body,
                     content_type = 'application/json',
                 )
             else:
-                # SUSTech-HTTP != 1, return html page
-                FileManagerServer.resource_handler(['view_directory_template.html'], {      # 把对目录的 GET 请求视作对目录下的 view_directory_template.html 的资源请求，重定向到资源渲染器
+                # SUSTech-HTTP != 1, return html page, with the first page of the listing (the rest is fetched by the page)
+                template_path = server.get_path('view_directory_template.html', resourse = True)
+                if server.check_not_modified(connection_handler, directory_stat, os.stat(template_path)):
+                    return
+                entries, next_key = server.get_listing(virtual_path).page(limit = server.listing_page_size)
+                server.render_resource(connection_handler, template_path, {               # 把对目录的 GET 请求视作对 view_directory_template.html 的资源请求，交给资源渲染器
                     'virtual_path': virtual_path,
-                    'scan_list': server.list_directory(virtual_path),
-                }, connection_handler)
-        elif server.is_file(virtual_path): # path[-1] != '':
-            # file type
-            file_type, file_encoding = mimetypes.guess_type(server.root_dir + virtual_path)
-            content_disposition = 'inline'
-            if not file_type:
-                file_type = 'application/octet-stream'
-                content_disposition = 'attachment'
+                    'scan_list': json.dumps([name + ('/' if is_directory else '') for name, is_directory, _, _ in entries]),
+                    'next_cursor': json.dumps(next_key and FileManagerServer.encode_cursor('name', False, next_key)),
+                })
+        elif metadata.is_file: # path[-1] != '':
+            file_type, content_disposition = metadata.content_type, metadata.content_disposition
             response.update_header('Accept-Ranges', 'bytes') # TODO
             
+            file_path = metadata.real_path
+            file_stat = metadata.stat
+            if server.check_not_modified(connection_handler, file_stat):
+                return
+            
             # download type
             if parameters.get('chunked', '0') == '1':
-                # chunked download, TODO: 不用 update_by_file_path 为了效率，或许可以给这些函数加个 header_only？
+                # chunked download, streamed from the file as the connection drains (not even opened for HEAD)
+                response.update_by_producer(open(file_path, 'rb') if request.request_line.method == 'GET' else (), content_type = file_type)
+            elif request.request_line.method == 'HEAD':
+                # answered from the metadata alone, without opening the file; Range is only defined for GET
                 response.update_header('Content-Type', file_type)
-                response.update_header('Content-Disposition', f'{content_disposition}; filename="{path[-1]}"')
-                
-                connection_handler.launch_chunked_transfer()
-                # if request.request_line.method != 'HEAD':
-                # TODO: threading transmitting?
-                with open(server.get_path(virtual_path), 'rb') as f:
-                    while True:
-                        chunk_content = f.read(4096)
-                        if not chunk_content:
-                            connection_handler.finish_chunked_transfer()
-                            break
-                        connection_handler.chunked_transmit(chunk_content)
-            elif request.headers.is_exist('Range'):
-                # range download
-                with open(server.get_path(virtual_path), 'rb') as f: # TODO: 不全部读入，按照 Range 需求移动文件指针
-                    file = f.read()
-                    file_length = len(file)
-                
-                ranges, unit = HTTPHeaderUtils.parse_range(request.headers.get('Range'), content_length = file_length)
+                response.update_header('Content-Length', str(file_stat.st_size))
+            elif request.headers.is_exist('Range') and HTTPHeaderUtils.is_range_valid(request.headers, response.headers.get('ETag'), file_stat.st_mtime) and (parsed_range := HTTPHeaderUtils.parse_range(request.headers.get('Range'), content_length = file_stat.st_size)) is not None:
+                # range download, each range is sent from the file at its offset; the full content instead if If-Range does not match or Range is malformed
+                ranges, unit = parsed_range
                 if unit != 'bytes':
                     raise HTTPStatusException(416) # TODO: only support bytes now
-                if ranges:
-                    response.update_status(206)
-                    if len(ranges) == 1:
-                        response.update_header('Content-Type', file_type)
-                        response.update_header('Content-Range', f'bytes {ranges[0][0]}-{ranges[0][1]}/{file_length}')
-                        response.update_body(file[ranges[0][0] : (ranges[0][1] + 1)])
-                    else:
-                        boundary = KeyUtils.random_key()
-                        response.update_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
-                        body = f'--{boundary}'.encode()
-                        for r in ranges:
-                            body += f'\r\nContent-Type: {file_type}\r\n'.encode()
-                            body += f'Content-Range: bytes {r[0]}-{r[1]}/{file_length}\r\n\r\n'.encode()
-                            body += file[r[0] : (r[1] + 1)]
-                            body += f'\r\n--{boundary}'.encode()
-                        body += b'--\r\n'
-                        response.update_body(body)
+                response.update_by_file_ranges(file_path, ranges, file_type, boundary = KeyUtils.random_key())
             else:
-                # direct download
-                response.update_by_file_path(server.get_path(virtual_path))
+                # direct download, a small file from memory if it is cached
+                response.update_by_file_path(file_path, content = server.file_cache.get(file_path, file_stat))
+                response.update_header('Content-Type', file_type)
+            response.update_header('Content-Disposition', f'{content_disposition}; filename="{path[-1]}"')
         else:
             raise HTTPStatusException(404)
     
@@ -295,8 +687,7 @@ class FileManagerServer(HTTPServer):
         if not parameters.__contains__('path'):                                             # param path not exist
             raise HTTPStatusException(400, 'Param path Not Exist')
         
-        virtual_path = parameters.get('path').strip('/')                                    # target path (virtual)
-        located_user = server.belongs_to(virtual_path)                                      # target user
+        virtual_path, located_user = server.locate(parameters.get('path'))                  # target path (virtual) and its user
         
         username, new_cookie = server.authenticate(connection_handler)                      # authenticate
         if new_cookie:
@@ -318,8 +709,27 @@ class FileManagerServer(HTTPServer):
         
         server.upload_file(virtual_path, request)                                           # save uploaded file to disk
         # response is 200 OK in default
+    
+    def upload_consumer(path, parameters, headers, connection_handler):
+        # multipart/form-data bodies are streamed to disk while receiving, the checks are left to upload_handler() except for the quota
+        server = connection_handler.server
+        
+        if not headers.is_exist('Content-Type'):
+            return None
+        content_type_dict = HTTPHeaderUtils.parse_content_type(headers.get('Content-Type'))
+        if 'multipart/form-data' not in content_type_dict or not content_type_dict.get('boundary', None):
+            return None
+        
+        virtual_path, located_user = server.locate(parameters.get('path', ''))              # target path (virtual) and its user
+        if located_user is None or server.identify(headers) != located_user:                # received as usual, then refused by upload_handler() (401 or 403)
+            return None
+        
+        # refused before the body if it cannot fit, as if it were all new files (the size of a chunked body is not known, at least a byte)
+        content_length = headers.get('Content-Length')
+        max_size = server.check_quota(located_user, int(content_length) if content_length else 1, 1, measure = False)
+        return UploadStream(content_type_dict['boundary'], server.upload_dir, max_size)
 
-    def delete_handler(path, parameters, connection_handler):
+    async def delete_handler(path, parameters, connection_handler):
         request = connection_handler.request
         server = connection_handler.server
         response = connection_handler.response
@@ -330,8 +740,7 @@ class FileManagerServer(HTTPServer):
         if not parameters.__contains__('path'):                                             # param path not exist
             raise HTTPStatusException(400, 'Param path Not Exist')
         
-        virtual_path = parameters.get('path').strip('/')                                        # target path (virtual)
-        located_user = server.belongs_to(virtual_path)                                      # target user
+        virtual_path, located_user = server.locate(parameters.get('path'))                  # target path (virtual) and its user
         
         username, new_cookie = server.authenticate(connection_handler)                      # authenticate
         if new_cookie:
@@ -342,7 +751,7 @@ class FileManagerServer(HTTPServer):
         if not server.is_exist(virtual_path):                                               # path not exist
             raise HTTPStatusException(404)
         
-        server.delete_file(virtual_path)                                                    # delele file or directory from disk
+        await asyncio.to_thread(server.delete_file, virtual_path)                           # delele file or directory from disk, rmtree may take long
         # response is 200 OK in default
     
     """
@@ -363,9 +772,17 @@ class FileManagerServer(HTTPServer):
         api_route = '/file_manager_backend_api',
         fetch_route = '/file_manager_fetch',
         upload_route = '/file_manager_upload',
-        delete_route = '/file_manager_delete'
+        delete_route = '/file_manager_delete',
+        file_cache_size = 64 * 1024 * 1024,
+        file_cache_max_file_size = 256 * 1024,
+        metadata_ttl = 1.0,
+        metadata_index = False,
+        upload_dir = None,
+        quota_bytes = None,
+        quota_files = None,
+        **kwargs
     ):
-        super().__init__(hostname, port, ConnectionHandlerClass)
+        super().__init__(hostname, port, ConnectionHandlerClass, **kwargs)
         
         self.res_route = FileManagerServer.regularize_route(res_route)
         self.api_route = FileManagerServer.regularize_route(api_route)
@@ -373,20 +790,49 @@ class FileManagerServer(HTTPServer):
         self.upload_route = FileManagerServer.regularize_route(upload_route)
         self.delete_route = FileManagerServer.regularize_route(delete_route)
         
-        self.route(self.res_route, methods = 'GET')(FileManagerServer.resource_handler)
+        self.route(self.res_route, methods = ['GET', 'HEAD'])(FileManagerServer.resource_handler)
         self.route(self.api_route + '/user_register', methods = 'POST')(FileManagerServer.api_user_register)
         self.route(self.api_route + '/new_folder', methods = 'POST')(FileManagerServer.api_new_folder)
         self.route(self.api_route + '/rename', methods = 'POST')(FileManagerServer.api_rename)
+        self.route(self.api_route + '/cache_stats', methods = 'GET')(FileManagerServer.api_cache_stats)
+        self.route(self.api_route + '/search', methods = 'GET')(FileManagerServer.api_search)
+        self.route(self.api_route + '/usage', methods = 'GET')(FileManagerServer.api_usage)
         self.route(self.fetch_route, methods = ['GET', 'HEAD', 'POST'])(FileManagerServer.fetch_handler)
         self.route(self.upload_route, methods = ['GET', 'HEAD', 'POST'])(FileManagerServer.upload_handler)
         self.route(self.delete_route, methods = ['GET', 'HEAD', 'POST'])(FileManagerServer.delete_handler)
+        self.body_consumer(self.upload_route, methods = 'POST')(FileManagerServer.upload_consumer)
         
         self.root_dir = root_dir
         self.reg_dir = reg_dir
+        self.upload_dir = upload_dir or reg_dir + 'uploads/'                # temporary files of uploads, best on the file system of root_dir
         self.res_dir = FileManagerServer.join_absoluted_path('res/') # absolute path
+        self.template_cache = TemplateCache()
+        self.file_cache = FileCache(file_cache_size, file_cache_max_file_size) # small user files, see fetch_handler()
+        self.metadata_cache = MetadataCache(metadata_ttl)                   # PathMetadata of paths under root_dir, see resolve()
+        self.directory_cache = DirectoryCache()                             # listings of directories under root_dir, see get_listing()
+        self.metadata_index = MetadataIndex(self.reg_dir + 'index.sqlite3', self.root_dir) if metadata_index else None # for searching, built once launched
+        self.precompress_resources()
+        self.clean_uploads()
         
         self.user_manager = UserManager(self.reg_dir + 'users.pkl')
         self.cookie_manager = CookieManager(self.reg_dir + 'cookies.pkl')
+        self.usage_manager = UsageManager(self.reg_dir + 'usage.pkl', self.root_dir)
+        self.quota_bytes = quota_bytes                                      # per user by default, None for no limit, see get_quota()
+        self.quota_files = quota_files
+    
+    def reset_after_fork(self):
+        super().reset_after_fork()
+        if self.metadata_index:
+            self.metadata_index.reset_after_fork()
+    
+    def launch(self):
+        if self.metadata_index:
+            self.metadata_index.start()                                                     # in the serving process, e.g. each pre-forked worker
+        try:
+            super().launch()
+        finally:
+            if self.metadata_index:
+                self.metadata_index.stop()
     
     """
         Information
@@ -411,6 +857,10 @@ class FileManagerServer(HTTPServer):
         real_path = prefix + virtual_path
         return os.path.isfile(real_path)
 
+    def resolve(self, virtual_path):
+        # PathMetadata of a path under root_dir, None if it does not exist; cached for `metadata_ttl` seconds, or until changed by this server
+        return self.metadata_cache.get(self.root_dir + virtual_path, PathMetadata.from_path)
+    
     def belongs_to(self, virtual_path):
         virtual_path = virtual_path.strip('/')
         if virtual_path == '':
@@ -420,11 +870,160 @@ class FileManagerServer(HTTPServer):
         # return split[0] if self.is_exist(split[0]) and self.is_directory(split[0]) else None
             # TODO: 现在只管返回第一个就是了，不判断这是否是个用户目录
     
+    def locate(self, virtual_path):
+        # (`<user>/<path>` normalized, its user), so that a path is checked against the user it changes (e.g. `client1/../client2` is of client2); (None, None) if out of the tree
+        virtual_path = MetadataIndex.normalize(virtual_path)
+        return (virtual_path, self.belongs_to(virtual_path)) if virtual_path is not None else (None, None)
+    
+    def get_listing(self, path):
+        # DirectoryListing of a directory under root_dir, scanned again only once it is modified
+        metadata = self.resolve(path)
+        if metadata is None or not metadata.is_directory:
+            raise HTTPStatusException(404)
+        return self.directory_cache.get(metadata.real_path, metadata.stat)
+    
     def list_directory(self, path):
-        real_path = self.root_dir + path.strip('/') + '/'
-        with os.scandir(real_path) as it:
-            dir_list = [entry.name + ('/' if os.path.isdir(real_path + entry.name) else '') for entry in it]
-            return json.dumps(dir_list)
+        # names of all the entries (directories with a trailing slash), as json
+        return json.dumps([name + ('/' if is_directory else '') for name, is_directory, _, _ in self.get_listing(path).entries])
+    
+    def list_directory_page(self, path, parameters):
+        """
+            [Parameters]
+                limit: entries at most, 1 to `listing_max_page_size`, `listing_page_size` by default
+                cursor: `next_cursor` of the previous page
+                sort: name (directories first), size or mtime; order: asc or desc
+                filter: a substring of the names, case-insensitive
+            [Return] json {"entries": [{"name", "type": "directory" | "file", "size", "mtime"}, ...], "total": <entries of the directory>, "next_cursor": <null at the end>}
+                with the bytes and files under each directory as well, "total_size" and "total_files" (see UsageManager)
+        """
+        sort = parameters.get('sort', 'name')
+        order = parameters.get('order', 'asc')
+        if sort not in DirectoryListing.sort_keys or order not in ('asc', 'desc'):
+            raise HTTPStatusException(400, 'Invalid Sort')
+        try:
+            limit = int(parameters.get('limit', self.listing_page_size))
+        except ValueError:
+            raise HTTPStatusException(400, 'Invalid Limit')
+        if not 0 < limit <= self.listing_max_page_size:
+            raise HTTPStatusException(400, 'Invalid Limit')
+        after = FileManagerServer.decode_cursor(parameters['cursor'], sort, order == 'desc') if parameters.get('cursor') else None
+        name_filter = parameters.get('filter', '').lower() or None
+        
+        listing = self.get_listing(path)
+        entries, next_key = listing.page(sort, order == 'desc', after, limit, name_filter)
+        directory_names = [name for name, is_directory, _, _ in entries if is_directory]
+        directory_totals = {name: totals or (None, None) for name, totals in zip(directory_names, self.usage_manager.lookup(path, directory_names))}
+        return json.dumps({
+            'entries': [{
+                'name': name,
+                'type': 'directory' if is_directory else 'file',
+                'size': size,
+                'mtime': mtime,
+                **({'total_size': directory_totals[name][0], 'total_files': directory_totals[name][1]} if is_directory else {}),
+            } for name, is_directory, size, mtime in entries],
+            'total': len(listing.entries),
+            'next_cursor': next_key and FileManagerServer.encode_cursor(sort, order == 'desc', next_key),
+        })
+    
+    def file_size(real_path):
+        # st_size of a path (not followed if it is a symbolic link), None if it does not exist
+        try:
+            return os.lstat(real_path).st_size
+        except OSError:
+            return None
+    
+    def encode_cursor(sort, descending, key):
+        # the sort key of the last entry of a page, so the next page starts after it wherever it is now; url-safe without escaping
+        return base64.urlsafe_b64encode(json.dumps([sort, descending, key]).encode()).decode().rstrip('=')
+    
+    def decode_cursor(cursor, sort, descending):
+        try:
+            cursor_sort, cursor_descending, key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            key = tuple(key)
+            valid_types = {'name': (bool, str), 'size': (int, str), 'mtime': ((int, float), str)}[sort]
+            if (cursor_sort, cursor_descending) == (sort, descending) and len(key) == 2 and all(isinstance(value, valid_type) for value, valid_type in zip(key, valid_types)):
+                return key
+        except (ValueError, TypeError):
+            pass # e.g. not base64, not json
+        raise HTTPStatusException(400, 'Invalid Cursor')
+    
+    """
+        Responding
+    """
+    
+    def check_not_modified(self, connection_handler, *stats, content = None):
+        # validators (ETag, Last-Modified) of a response made of the files of `stats`, turned into 304 if the request is conditional and they match;
+        # or only the ETag of `content`, a response generated from more than the files (e.g. a listing with the sizes of its entries)
+        request = connection_handler.request
+        response = connection_handler.response
+        
+        if content is not None:
+            etag = HTTPHeaderUtils.generate_content_etag(content)
+            last_modified = None                                            # If-Modified-Since is ignored, no date tells this content apart
+        else:
+            etag = HTTPHeaderUtils.generate_etag(*stats)
+            last_modified = max(stat.st_mtime for stat in stats)
+            response.update_header('Last-Modified', HTTPHeaderUtils.format_http_date(last_modified))
+        response.update_header('ETag', etag)
+        response.update_header('Cache-Control', 'no-cache')                 # revalidated on every use, user files may change at any time
+        if last_modified is None and not request.headers.is_exist('If-None-Match'):
+            return False
+        if request.request_line.method in ['GET', 'HEAD'] and HTTPHeaderUtils.is_not_modified(request.headers, etag, last_modified):
+            response.update_not_modified()
+            return True
+        return False
+    
+    def render_resource(self, connection_handler, file_path, variables = {}):
+        # a resource of `res_dir`, rendered if it is a template with variables, otherwise sent as it is (e.g. fonts), gzipped by precompress_resources() if possible
+        response = connection_handler.response
+        content_type = mimetypes.guess_type(file_path)[0]
+        if file_path.endswith(self.template_extensions):
+            template = self.template_cache.get(file_path)                                   # parsed once, see TemplateCache
+            if template.variables:
+                response.update_by_content_type(template.render({
+                    **variables,
+                    **get_file_manager_rendering_extended_variables(self)
+                }), content_type)
+                return
+        
+        compressed_path = file_path + '.gz'
+        if HTTPHeaderUtils.is_compressible(content_type):
+            response.headers.add('Vary', 'Accept-Encoding')
+            try:
+                is_fresh = os.stat(compressed_path).st_mtime >= os.stat(file_path).st_mtime
+            except OSError:
+                is_fresh = False # not precompressed
+            if is_fresh and HTTPHeaderUtils.accepts_encoding(connection_handler.request.headers, 'gzip'):
+                response.update_by_file_path(compressed_path)
+                response.update_header('Content-Type', content_type)
+                response.update_header('Content-Encoding', 'gzip')
+                response.update_header('Content-Disposition', f'inline; filename="{os.path.basename(file_path)}"')
+                if response.headers.is_exist('ETag'):
+                    response.update_header('ETag', 'W/' + response.headers.get('ETag')) # see HTTPConnectionHandler.compress_response()
+                return
+        response.update_by_file_path(file_path)
+    
+    def precompress_resources(self):
+        # write `<name>.gz` next to each static resource of a compressible type (templates with variables are compressed per response instead)
+        for dir_path, _, file_names in os.walk(self.res_dir):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                if file_name.endswith('.gz') or not HTTPHeaderUtils.is_compressible(mimetypes.guess_type(file_path)[0]):
+                    continue
+                try:
+                    if file_name.endswith(self.template_extensions) and self.template_cache.get(file_path).variables:
+                        continue
+                    compressed_path = file_path + '.gz'
+                    if os.path.exists(compressed_path) and os.stat(compressed_path).st_mtime >= os.stat(file_path).st_mtime:
+                        continue # up to date
+                    with open(file_path, 'rb') as f:
+                        data = gzip.compress(f.read(), compresslevel = 9, mtime = 0)
+                    temp_path = f'{compressed_path}.{os.getpid()}.tmp'
+                    with open(temp_path, 'wb') as f:
+                        f.write(data)
+                    os.replace(temp_path, compressed_path)                                  # never seen half-written
+                except OSError as e:
+                    log_print(f'Resource {file_path} not precompressed: {e}', LogLevel.WARNING) # e.g. a read-only installation, served as it is
     
     """
         Verification
@@ -465,6 +1064,40 @@ class FileManagerServer(HTTPServer):
         return (username, new_cookie)
             # if not authenicated, raise 401, no need to return
             # if authenicated, return (username, new_cookie); new_cookie is not None when authenicated by Authorization, otherwise None
+    
+    def identify(self, headers):
+        # the user of a valid session cookie or Authorization in `headers`, None otherwise; unlike authenticate(), nothing is issued or answered
+        session_id = HTTPHeaderUtils.parse_cookie(headers.get('Cookie')).get('session-id', None) if headers.is_exist('Cookie') else None
+        cookie_info = self.cookie_manager.get(session_id) if session_id else None
+        if cookie_info:
+            return cookie_info.get('username', None)
+        if headers.is_exist('Authorization'):
+            username, password = HTTPHeaderUtils.parse_authorization_basic(headers.get('Authorization'))
+            if username and password and self.user_manager.authenticate(username, password):
+                return username
+        return None
+    
+    def get_quota(self, username):
+        # (bytes, files) the user may use at most, None for no limit; `quota_bytes` and `quota_files` of the user info override those of the server
+        info = self.user_manager.get(username) or {}
+        return info.get('quota_bytes', self.quota_bytes), info.get('quota_files', self.quota_files)
+    
+    def check_quota(self, username, size = 0, count = 0, measure = True):
+        """
+            Raise 507 if there is no room for `count` more files (folders included), or no byte left at all, otherwise 413 if `size` more bytes do not fit
+            [Return] bytes left before the change, None for no limit (or when the user is not measured yet and `measure` is False)
+        """
+        max_size, max_files = self.get_quota(username)
+        if max_size is None and max_files is None:
+            return None
+        usage = self.usage_manager.get(username, measure)
+        if usage is None:
+            return None
+        if max_files is not None and count > 0 and usage['files'] + count > max_files:
+            raise HTTPStatusException(507, 'File Quota Exceeded')
+        if max_size is not None and size > 0 and usage['bytes'] + size > max_size:
+            raise HTTPStatusException(507 if usage['bytes'] >= max_size else 413, 'Quota Exceeded')
+        return None if max_size is None else max_size - usage['bytes']
 
     """
         Manipulations
@@ -473,12 +1106,28 @@ class FileManagerServer(HTTPServer):
     # TODO: to be checked
     def mkdir(self, virtual_path):
         real_path = self.root_dir + virtual_path
-        try:
-            os.makedirs(real_path)
-        except FileNotFoundError:
-            raise HTTPStatusException(403) # TODO: 建立目录路径上存在同名文件导致建立失败会报这个错误，状态码待定
-        except Exception:
-            raise HTTPStatusException(500)
+        username = self.belongs_to(virtual_path)
+        created = []                                                                        # the missing directories, from the top
+        path = MetadataIndex.normalize(virtual_path)
+        while path and not os.path.lexists(self.root_dir + path):
+            created.insert(0, path)
+            path = posixpath.dirname(path)
+        with self.usage_manager.lock:                                                       # checked and accounted as a whole, see UsageManager
+            if username:
+                self.check_quota(username, 0, len([path for path in created if path != username])) # the user directory is not counted
+            try:
+                os.makedirs(real_path)
+            except FileNotFoundError:
+                raise HTTPStatusException(403) # TODO: 建立目录路径上存在同名文件导致建立失败会报这个错误，状态码待定
+            except Exception:
+                raise HTTPStatusException(500)
+            finally:
+                self.invalidate(real_path)
+                for path in created:
+                    if os.path.isdir(self.root_dir + path):                                 # even if only a part of them is created
+                        self.usage_manager.created(path)
+        if self.metadata_index:
+            self.metadata_index.update(virtual_path)
     
     # TODO: to be checked
     def upload_file(self, virtual_path, request):
@@ -493,21 +1142,53 @@ class FileManagerServer(HTTPServer):
             mimetype = mimetype_list[0]
             if mimetype == 'multipart/form-data':
                 boundary = content_type_dict.get('boundary', None)
-                if boundary:
+                if isinstance(request.body_consumer, UploadStream):
+                    # streamed to temporary files while receiving, see upload_consumer()
+                    if request.body_consumer.exceeded:                                      # over the quota, discarded while receiving
+                        raise HTTPStatusException(413, 'Quota Exceeded')
+                    file_list = request.body_consumer.finish()
+                    if file_list is not None:
+                        parsed = True
+                        file_list = [file for file in file_list if file.get('filename', None) is not None and file.get('file', None) is not None]
+                        with self.usage_manager.lock:                                       # checked and accounted as a whole, see UsageManager
+                            self.check_upload(real_path, [(file['filename'], os.path.getsize(file['file'].name)) for file in file_list])
+                            for file in file_list:
+                                filename = file.get('filename', None)
+                                part_file = file.get('file', None)
+                                
+                                # 重名覆盖
+                                old_size = FileManagerServer.file_size(real_path + filename)
+                                try:
+                                    shutil.move(part_file.name, real_path + filename) # renamed, or copied if `upload_dir` is on another file system
+                                    self.usage_manager.written(virtual_path + '/' + filename, os.path.getsize(real_path + filename), old_size)
+                                except Exception: # TODO: unexpected os error
+                                    file_errer = True
+                                self.invalidate(real_path + filename)
+                                if self.metadata_index:
+                                    self.metadata_index.update(virtual_path + '/' + filename)
+                elif boundary:
                     file_list = HTTPBodyUtils.parse_multipart_form_data(request.body, boundary)
                     if file_list is not None:
                         parsed = True
-                        for file in file_list:
-                            filename = file.get('filename', None)
-                            content = file.get('content', None)
-                            
-                            # 重名覆盖
-                            if filename is not None and content is not None:
+                        file_list = [file for file in file_list if file.get('filename', None) is not None and file.get('content', None) is not None]
+                        with self.usage_manager.lock:                                       # checked and accounted as a whole, see UsageManager
+                            self.check_upload(real_path, [(file['filename'], len(file['content'])) for file in file_list])
+                            for file in file_list:
+                                filename = file.get('filename', None)
+                                content = file.get('content', None)
+                                
+                                # 重名覆盖
+                                old_size = FileManagerServer.file_size(real_path + filename)
                                 try:
                                     with open(real_path + filename, 'wb') as f:
                                         f.write(content)
+                                    self.usage_manager.written(virtual_path + '/' + filename, len(content), old_size)
                                 except Exception: # TODO: unexpected os error
                                     file_errer = True
+                                    self.usage_manager.forget(self.belongs_to(virtual_path))        # e.g. written in part, measured again
+                                self.invalidate(real_path + filename)
+                                if self.metadata_index:
+                                    self.metadata_index.update(virtual_path + '/' + filename)
             else:
                 pass # TODO: 其它 MIME 类型，文档只要求支持 multipart/form-data，因为测试使用 requests
         if file_errer:
@@ -515,14 +1196,58 @@ class FileManagerServer(HTTPServer):
         if not parsed:
             raise HTTPStatusException(400) # TODO: Content-Type is required
     
+    def clean_uploads(self):
+        # create `upload_dir`, and delete the temporary files left by a crash (also in root_dir, where they were written before);
+        # only those untouched for `upload_stale_time`, as other processes (e.g. pre-forked workers) may be receiving theirs
+        os.makedirs(self.upload_dir, exist_ok = True)
+        for temp_dir in (self.upload_dir, self.root_dir):
+            try:
+                with os.scandir(temp_dir) as it:
+                    for entry in it:
+                        if entry.name.startswith('.upload-') and entry.stat(follow_symlinks = False).st_mtime < time.time() - self.upload_stale_time:
+                            os.remove(entry.path)
+            except OSError as e:
+                log_print(f'Uploads in {temp_dir} not cleaned: {e}', LogLevel.WARNING)
+    
+    def check_upload(self, real_path, files):
+        # check the quota for `files` ([(filename, size), ...]) written into the directory `real_path`, replacing those of the same names
+        size, count, sizes = 0, 0, {}
+        for filename, new_size in files:
+            old_size = sizes[filename] if filename in sizes else FileManagerServer.file_size(real_path + filename)
+            size += new_size - (old_size or 0)
+            count += old_size is None
+            sizes[filename] = new_size
+        if size > 0 or count > 0:
+            self.check_quota(self.belongs_to(real_path[len(self.root_dir):]), size, count)
+    
     # TODO: to be checked
     def delete_file(self, virtual_path):
         real_path = self.root_dir + virtual_path
-        if os.path.isfile(real_path):
-            os.remove(real_path)
+        try:
+            if os.path.isfile(real_path):
+                size = os.path.getsize(real_path)
+                os.remove(real_path)
+            else:
+                size = 0 # recorded for directories, see UsageManager.removed()
+                shutil.rmtree(real_path)
+                # os.removedirs(real_path)
+        except Exception:
+            self.usage_manager.forget(self.belongs_to(virtual_path))                        # e.g. only a part of a directory removed, measured again
+            raise
         else:
-            shutil.rmtree(real_path)
-            # os.removedirs(real_path)
+            self.usage_manager.removed(virtual_path, size)
+        finally:
+            self.invalidate(real_path)                                                      # even if only a part of a directory is removed
+            if self.metadata_index:
+                self.metadata_index.remove(virtual_path)
+    
+    def invalidate(self, real_path):
+        # forget what is cached of `real_path` (and of everything under it) after it is changed, as well as the metadata of its directory (e.g. mtime)
+        self.file_cache.invalidate(real_path)
+        self.metadata_cache.invalidate(real_path)
+        self.metadata_cache.invalidate(os.path.dirname(real_path.rstrip('/')), subtree = False)
+        self.directory_cache.invalidate(real_path)
+        self.directory_cache.invalidate(os.path.dirname(real_path.rstrip('/')), subtree = False) # e.g. the size of an entry rewritten in place
     
     """
         Page Rendering
@@ -531,3 +1256,10 @@ class FileManagerServer(HTTPServer):
     def error_page(self, code, desc):
         return get_error_page_rendered(code, desc, server = self)
 
+
+"""
+    AsyncFileManagerServer
+        FileManagerServer served by the asyncio engine
+"""
+class AsyncFileManagerServer(FileManagerServer, AsyncTCPSocketServer):
+    pass
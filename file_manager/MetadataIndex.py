@@ -0,0 +1,254 @@
+import posixpath
+import threading
+import sqlite3
+import stat
+import time
+import os
+
+from myhttp.log import log_print, LogLevel
+
+try:
+    import fcntl # not available on Windows, where every process reconciles on its own
+except ImportError:
+    fcntl = None
+
+
+"""
+    MetadataIndex
+        name, parent, size, mtime and type of every path under `root_dir` (relative to it, e.g. `client1/photos/a.jpg`),
+        in a SQLite database (WAL mode, so searches never wait for writes), each thread with its own connection.
+        Built in the background once launched and reconciled with the disk every `reconcile_interval` seconds
+        (by one process at a time, see `lock_path`), updated by the server as it changes the tree in between.
+        The index only helps searching: its errors are logged, never raised to a request.
+"""
+class MetadataIndex:
+    batch_size = 1000                                                       # rows per transaction while reconciling, so that updates by requests never wait long
+    busy_timeout = 5                                                        # seconds to wait for the write lock
+    ignored_prefix = '.upload-'                                             # temporary files of UploadStream, left in `root_dir` by older versions
+    search_modes = ('substring', 'prefix', 'glob')
+    
+    def __init__(self, db_path, root_dir, reconcile_interval = 600):
+        self.db_path = db_path
+        self.lock_path = db_path + '.lock'
+        self.root_dir = root_dir
+        self.reconcile_interval = reconcile_interval
+        self.reset_after_fork()
+        
+        connection = self.connect() # not kept, connections must not be shared with forked processes
+        try:
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    path TEXT PRIMARY KEY,
+                    parent TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    lower_name TEXT NOT NULL,
+                    is_directory INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+                CREATE INDEX IF NOT EXISTS entries_lower_name ON entries (lower_name);
+                CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value);
+            ''')
+        finally:
+            connection.close()
+    
+    def reset_after_fork(self):
+        self.local = threading.local()                                      # connection of each thread
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.launched_at = None
+    
+    def connect(self):
+        connection = sqlite3.connect(self.db_path, timeout = self.busy_timeout)
+        connection.execute('PRAGMA synchronous = NORMAL')                   # durable enough for an index that is rebuilt from the disk anyway
+        return connection
+    
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+        return connection
+    
+    """
+        Background Reconciliation
+    """
+    
+    def start(self):
+        self.launched_at = time.time()
+        self.thread = threading.Thread(target = self.run, name = 'MetadataIndex', daemon = True)
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join(self.busy_timeout)                             # it stops between two batches
+            self.thread = None
+    
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.reconcile()
+            except (OSError, sqlite3.Error) as e:
+                log_print(f'Metadata index not reconciled: {e}', LogLevel.WARNING)
+            self.stop_event.wait(self.reconcile_interval)
+    
+    def reconcile(self):
+        # walk the tree and write every path, then drop what was not written since (i.e. removed behind the server's back)
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False # being reconciled by another process
+            reconciled_at = self.reconciled_at()
+            if reconciled_at is not None and reconciled_at > max(self.launched_at, time.time() - self.reconcile_interval / 2):
+                return False # just reconciled by another process
+            
+            start = time.time()
+            count = 0
+            batch = []
+            for row in self.walk():
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    self.write(batch)
+                    count += len(batch)
+                    batch = []
+                    if self.stop_event.is_set():
+                        return False
+            self.write(batch)
+            count += len(batch)
+            
+            connection = self.get_connection()
+            with connection:
+                removed = connection.execute('DELETE FROM entries WHERE updated < ?', (start, )).rowcount
+                connection.execute("INSERT OR REPLACE INTO info VALUES ('reconciled_at', ?)", (start, ))
+            log_print(f'Metadata index reconciled: {count} paths, {removed} removed, in {time.time() - start:.1f} s', LogLevel.INFO)
+            return True
+    
+    def reconciled_at(self):
+        row = self.get_connection().execute("SELECT value FROM info WHERE key = 'reconciled_at'").fetchone()
+        return row[0] if row else None
+    
+    def walk(self):
+        # rows of every path under `root_dir`, symbolic links to directories are not followed
+        directories = ['']
+        while directories:
+            parent = directories.pop()
+            try:
+                with os.scandir(self.root_dir + parent) as it:
+                    for entry in it:
+                        if not parent and entry.name.startswith(self.ignored_prefix):
+                            continue
+                        path = posixpath.join(parent, entry.name)
+                        try:
+                            row = self.make_row(path, entry.stat())
+                        except OSError:
+                            continue # removed meanwhile, or a broken symbolic link
+                        if entry.is_dir(follow_symlinks = False):
+                            directories.append(path)
+                        yield row
+            except OSError:
+                continue # removed meanwhile
+    
+    def make_row(self, path, stat_result):
+        parent, name = posixpath.split(path)
+        is_directory = stat.S_ISDIR(stat_result.st_mode)
+        return (path, parent, name, name.lower(), int(is_directory), 0 if is_directory else stat_result.st_size, stat_result.st_mtime, time.time())
+    
+    def write(self, rows):
+        connection = self.get_connection()
+        with connection:
+            connection.executemany('''
+                INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (path) DO UPDATE SET is_directory = excluded.is_directory, size = excluded.size, mtime = excluded.mtime, updated = excluded.updated
+            ''', rows)
+    
+    """
+        Updates, by the server after changing the tree
+    """
+    
+    @staticmethod
+    def normalize(path):
+        # `path` relative to `root_dir`, None if it is not under it
+        path = posixpath.normpath(path.strip('/'))
+        return None if path in ('.', '') or path.split('/')[0] == '..' else path # `..foo` is a name, `../foo` is out of it
+    
+    def update(self, path):
+        # the path (e.g. uploaded or created) and its parent directories, as they are on the disk now
+        path = MetadataIndex.normalize(path)
+        try:
+            rows = []
+            while path:
+                try:
+                    rows.append(self.make_row(path, os.stat(self.root_dir + path)))
+                except FileNotFoundError:
+                    self.remove(path)
+                path = posixpath.dirname(path)
+            self.write(rows)
+        except (OSError, sqlite3.Error) as e:
+            log_print(f'Metadata index not updated: {e}', LogLevel.WARNING)
+    
+    def remove(self, path):
+        # the path and everything under it
+        path = MetadataIndex.normalize(path)
+        if path is None:
+            return
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)', (path, path + '/', path + '0')) # `0` is right after `/`
+        except sqlite3.Error as e:
+            log_print(f'Metadata index not updated: {e}', LogLevel.WARNING)
+    
+    def move(self, old_path, new_path):
+        # the path and everything under it renamed, without walking it again
+        old_path, new_path = MetadataIndex.normalize(old_path), MetadataIndex.normalize(new_path)
+        if old_path is None or new_path is None:
+            return
+        self.remove(new_path)                                               # replaced, if it existed
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.execute('''
+                    UPDATE entries SET path = ? || substr(path, ?), parent = ? || substr(parent, ?)
+                    WHERE path >= ? AND path < ?
+                ''', (new_path, len(old_path) + 1, new_path, len(old_path) + 1, old_path + '/', old_path + '0'))
+                connection.execute('DELETE FROM entries WHERE path = ?', (old_path, ))
+        except sqlite3.Error as e:
+            log_print(f'Metadata index not updated: {e}', LogLevel.WARNING)
+        self.update(new_path)
+    
+    """
+        Searching
+    """
+    
+    def search(self, scope, query, mode = 'substring', limit = 100, after = None):
+        """
+            Paths under `scope` whose name matches `query` (case-insensitive): a substring of it, a prefix of it, or a glob pattern (e.g. `*.jpg`)
+            [Return] ([(path, name, is_directory, size, mtime), ...] ordered by path, the last path if there are more after it, otherwise None)
+        """
+        query = query.lower()
+        conditions, arguments = ['path >= ? AND path < ?'], [scope + '/', scope + '0']
+        if mode == 'prefix':
+            conditions.append('lower_name >= ? AND lower_name < ?')
+            arguments += [query, query + '\U0010ffff']
+        elif mode == 'glob':
+            conditions.append('lower_name GLOB ?')
+            arguments.append(query)
+        else:
+            conditions.append('instr(lower_name, ?) > 0')
+            arguments.append(query)
+        if after is not None:
+            conditions.append('path > ?')
+            arguments.append(after)
+        
+        rows = self.get_connection().execute(
+            f'SELECT path, name, is_directory, size, mtime FROM entries WHERE {" AND ".join(conditions)} ORDER BY path LIMIT ?',
+            arguments + [limit + 1]                                         # one more, to tell if there are more
+        ).fetchall()
+        if len(rows) > limit:
+            return rows[:limit], rows[limit - 1][0]
+        return rows, None
@@ -1,2 +1,2 @@
-from .FileManagerServer import FileManagerServer
+from .FileManagerServer import FileManagerServer, AsyncFileManagerServer
 
@@ -32,10 +32,7 @@ def get_file_manager_rendering_extended_variables(server: FileManagerServer):
 """
 
 def get_error_page_rendered(code, desc, server: FileManagerServer):
-    with open(server.res_dir + 'error_template.html', 'r') as f:
-        page_content = f.read()
-    
-    return HTMLUtils.render_template(page_content, {
+    return server.template_cache.render(server.res_dir + 'error_template.html', {
         'error_code': code,
         'error_desc': desc,
         **get_file_manager_rendering_extended_variables(server)
@@ -91,6 +91,32 @@ function setBreadcrumb(path) {
     });
 }
 
+function loadMore() {
+    // the next page of the listing, see `next_cursor`
+    var xhr = new XMLHttpRequest();
+    xhr.open('GET', window.location.pathname + '?SUSTech-HTTP=1&cursor=' + next_cursor, true);
+
+    xhr.onload = function () {
+        if (xhr.status !== 200) {
+            alert(xhr.status + ' ' + xhr.statusText)
+            return;
+        }
+        var page = JSON.parse(xhr.responseText);
+        page.entries.forEach(function(entry) {
+            list.push(entry.type === "directory" ? entry.name + "/" : entry.name);
+        });
+        next_cursor = page.next_cursor;
+        displayFolderContentsAsIcons(list);
+    };
+
+    xhr.onerror = function () {
+        console.error('Load failed.');
+        alert(xhr.status + ' ' + xhr.statusText)
+    };
+
+    xhr.send();
+}
+
 function displayFolderContentsAsIcons(list) {
     var fileList = document.querySelector(".file_list");
     fileList.innerHTML = "";
@@ -147,6 +173,23 @@ function displayFolderContentsAsIcons(list) {
         fileList.appendChild(icon_panel);
     });
 
+    // more icon, while the listing is not fully loaded
+    if (next_cursor) {
+        var icon_panel = document.createElement("div");
+        icon_panel.className = "file_icon_panel";
+
+        var icon = document.createElement("i");
+        icon.className = "iconfont icon-folder";
+        icon_panel.appendChild(icon);
+
+        var text = document.createElement("p");
+        text.textContent = "More...";
+        icon_panel.appendChild(text);
+
+        icon_panel.addEventListener("click", loadMore);
+        fileList.appendChild(icon_panel);
+    }
+
     // upload icon
     var icon_panel = document.createElement("div");
     icon_panel.className = "upload_icon_panel";
@@ -207,16 +250,7 @@ function displayFolderContentsAsList(contents) { // Deserted
 }
 
 function initialize() {
-    // resort the list
-    list.sort(function(a, b) {
-        if (a.endsWith('/') && !b.endsWith('/')) {
-            return -1;
-        } else if (!a.endsWith('/') && b.endsWith('/')) {
-            return 1;
-        } else {
-            return a.localeCompare(b);
-        }
-    })
+    // the list is sorted by the server, directories first, page by page
 
     // breadcrumb
     setBreadcrumb(path.split('/'))
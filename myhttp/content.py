@@ -1,23 +1,285 @@
+import collections
+import threading
+import hashlib
+import bisect
 import re
 import os
 import base64
+import time
+import email.utils
 
 from .message import HTTPHeaders
 from .exception import HTTPStatusException
 
 
 class HTMLUtils:
+    template_pattern = re.compile(r'{{\s*([^{}]+)\s*}}') # r'{{\s*([^{}|]+)\s*(?:\|\s*safe\s*)?}}'
+    
     def __init__(self):
         pass
     
     @staticmethod
-    def render_template(template, variables = {}, pattern = r'{{\s*([^{}]+)\s*}}'): # r'{{\s*([^{}|]+)\s*(?:\|\s*safe\s*)?}}'
-        def replace(match):
-            variable = match.group(1).strip()
-            return str(variables.get(variable, f'{{{{ {variable} }}}}'))
+    def render_template(template, variables = {}, pattern = None):
+        # one-off rendering, see HTMLTemplate to render the same template repeatedly
+        return HTMLTemplate(template, pattern).render(variables)
+
+
+class HTMLTemplate:
+    """
+        Template parsed once into segments [literal, variable, literal, ..., literal], rendered by joining them,
+        an unknown variable is kept as `{{ variable }}`
+    """
+    __slots__ = ('segments', 'variables')
+    
+    def __init__(self, template, pattern = None):
+        pattern = HTMLUtils.template_pattern if pattern is None else re.compile(pattern)
+        self.segments = pattern.split(template)                             # the variables at odd indexes, as the pattern has one group
+        self.variables = [variable.strip() for variable in self.segments[1::2]]
+    
+    def render(self, variables = {}):
+        segments = self.segments[:]
+        segments[1::2] = [str(variables[variable]) if variable in variables else f'{{{{ {variable} }}}}' for variable in self.variables]
+        return ''.join(segments)
+
+
+class TemplateCache:
+    """
+        HTMLTemplate of files, parsed on first use and again once the file is modified (by mtime and size)
+    """
+    def __init__(self):
+        self.templates = {} # path -> (mtime_ns, size, template)
+    
+    def get(self, path):
+        stat = os.stat(path)
+        cached = self.templates.get(path)
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        with open(path, 'r', encoding = 'utf-8') as f:
+            template = HTMLTemplate(f.read())
+        self.templates[path] = (stat.st_mtime_ns, stat.st_size, template) # replaced as a whole, safe to share between threads
+        return template
+    
+    def render(self, path, variables = {}):
+        return self.get(path).render(variables)
+
+
+class FileCache:
+    """
+        Contents of small files in memory, keyed by path and valid as long as (inode, size, mtime) of the file are unchanged,
+        at most `max_size` bytes in all (the least recently used ones are evicted beyond), files above `max_file_size` are never cached
+    """
+    def __init__(self, max_size = 64 * 1024 * 1024, max_file_size = 256 * 1024):
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.files = collections.OrderedDict() # path -> (ino, size, mtime_ns, data), the most recently used last
+        self.size = 0
+        self.lock = threading.Lock()        # shared by the worker threads
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, path, stat):
+        # the content of the file of `stat` (just taken), read and cached on a miss; None if it is too large to be cached, or has changed since `stat`
+        if stat.st_size > self.max_file_size or stat.st_size > self.max_size:
+            return None
+        path = os.path.normpath(path)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.files.get(path)
+            if cached is not None and cached[:3] == key:
+                self.files.move_to_end(path)
+                self.hits += 1
+                return cached[3]
+            self.misses += 1
         
-        pattern_compiled = re.compile(pattern)
-        return pattern_compiled.sub(replace, template)
+        with open(path, 'rb') as f:
+            data = f.read(stat.st_size + 1)
+            fstat = os.fstat(f.fileno())
+        if (fstat.st_ino, fstat.st_size, fstat.st_mtime_ns) != key or len(data) != stat.st_size:
+            return None # e.g. being written
+        self.put(path, key + (data,))
+        return data
+    
+    def put(self, path, entry):
+        with self.lock:
+            self._remove(path)
+            self.files[path] = entry
+            self.size += len(entry[3])
+            while self.size > self.max_size:
+                _, evicted = self.files.popitem(last = False)
+                self.size -= len(evicted[3])
+                self.evictions += 1
+    
+    def _remove(self, path):
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[3])
+    
+    def invalidate(self, path):
+        # forget the file at `path`, or every file under it if it is a directory
+        path = os.path.normpath(path)
+        prefix = os.path.join(path, '')
+        with self.lock:
+            for cached_path in [cached_path for cached_path in self.files if cached_path == path or cached_path.startswith(prefix)]:
+                self._remove(cached_path)
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'files': len(self.files),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
+
+
+class MetadataCache:
+    """
+        Records of paths (e.g. made of a stat()) loaded on first use and kept for `ttl` seconds, unless invalidated before,
+        at most `max_entries` of them (the oldest are dropped beyond); a record of None (e.g. not found) is cached as well
+    """
+    def __init__(self, ttl = 1.0, max_entries = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.records = collections.OrderedDict() # path -> (expire_time, record), the oldest first
+        self.lock = threading.Lock()        # shared by the worker threads
+        self.generation = 0                 # of invalidations, a record loaded across one is not kept
+    
+    def get(self, path, load):
+        now = time.monotonic()
+        cached = self.records.get(path)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+        generation = self.generation
+        record = load(path)
+        with self.lock:
+            if generation != self.generation:
+                return record
+            self.records.pop(path, None)
+            self.records[path] = (now + self.ttl, record)
+            while len(self.records) > self.max_entries:
+                self.records.popitem(last = False)
+        return record
+    
+    def invalidate(self, path, subtree = True):
+        # forget the record of `path`, and of every path under it if `subtree`
+        path = os.path.normpath(path)
+        prefix = os.path.join(path, '')
+        with self.lock:
+            self.generation += 1
+            for cached_path in list(self.records):
+                normalized = os.path.normpath(cached_path)  # e.g. a trailing slash
+                if normalized == path or (subtree and normalized.startswith(prefix)):
+                    del self.records[cached_path]
+
+
+class DirectoryListing:
+    """
+        Entries (name, is_directory, size, mtime) of a directory as scanned, each order of them (see `sort_keys`) sorted once on first use
+    """
+    sort_keys = {
+        'name': lambda entry: (not entry[1], entry[0]),                     # directories first
+        'size': lambda entry: (entry[2], entry[0]),
+        'mtime': lambda entry: (entry[3], entry[0]),
+    }
+    
+    __slots__ = ('key', 'entries', 'orders')
+    
+    def __init__(self, key, entries):
+        self.key = key
+        self.entries = entries
+        self.orders = {} # sort -> (entries, their sort keys)
+    
+    def order(self, sort):
+        order = self.orders.get(sort)
+        if order is None:
+            sort_key = DirectoryListing.sort_keys[sort]
+            entries = sorted(self.entries, key = sort_key)
+            order = self.orders[sort] = (entries, [sort_key(entry) for entry in entries]) # the same either way if two threads sort at once
+        return order
+    
+    def page(self, sort = 'name', descending = False, after = None, limit = 1000, name_filter = None):
+        """
+            [Return] (entries, the sort key of the last one if there are more after it, otherwise None);
+            `after` is such a sort key (i.e. a cursor), so that pages stay in place as entries are added or removed;
+            `name_filter` is a lowercase substring of the names
+        """
+        entries, keys = self.order(sort)
+        if descending:
+            index = (len(keys) if after is None else bisect.bisect_left(keys, after)) - 1
+            step = -1
+        else:
+            index = 0 if after is None else bisect.bisect_right(keys, after)
+            step = 1
+        page = []
+        while 0 <= index < len(entries) and len(page) <= limit:             # one more than `limit`, to tell if there are more
+            entry = entries[index]
+            if name_filter is None or name_filter in entry[0].lower():
+                page.append(entry)
+            index += step
+        if len(page) > limit:
+            return page[:limit], DirectoryListing.sort_keys[sort](page[limit - 1])
+        return page, None
+
+
+class DirectoryCache:
+    """
+        DirectoryListing of directories, scanned on first use and again once the directory is modified (by inode and mtime),
+        at most `max_entries` entries in all (the least recently used directories are dropped beyond);
+        the size and mtime of a file changed in place may be stale, as it does not touch the directory
+    """
+    def __init__(self, max_entries = 500000):
+        self.max_entries = max_entries
+        self.listings = collections.OrderedDict() # path -> DirectoryListing, the most recently used last
+        self.size = 0                       # entries in all
+        self.lock = threading.Lock()        # shared by the worker threads
+    
+    def get(self, path, stat):
+        # the listing of the directory of `stat` (just taken)
+        path = os.path.normpath(path)
+        key = (stat.st_ino, stat.st_mtime_ns)
+        with self.lock:
+            listing = self.listings.get(path)
+            if listing is not None and listing.key == key:
+                self.listings.move_to_end(path)
+                return listing
+        
+        listing = DirectoryListing(key, DirectoryCache.scan(path))
+        with self.lock:
+            self._remove(path)
+            self.listings[path] = listing
+            self.size += len(listing.entries)
+            while self.size > self.max_entries and len(self.listings) > 1:
+                self._remove(next(iter(self.listings)))
+        return listing
+    
+    def _remove(self, path):
+        listing = self.listings.pop(path, None)
+        if listing is not None:
+            self.size -= len(listing.entries)
+    
+    def invalidate(self, path, subtree = True):
+        # forget the listing of `path`, and of every directory under it if `subtree`
+        path = os.path.normpath(path)
+        prefix = os.path.join(path, '')
+        with self.lock:
+            for cached_path in [cached_path for cached_path in self.listings if cached_path == path or (subtree and cached_path.startswith(prefix))]:
+                self._remove(cached_path)
+    
+    @staticmethod
+    def scan(path):
+        entries = []
+        with os.scandir(path) as it:
+            for entry in it:
+                is_directory = entry.is_dir()                               # from the directory entry itself, mostly without a stat()
+                try:
+                    stat = entry.stat()
+                    entries.append((entry.name, is_directory, 0 if is_directory else stat.st_size, stat.st_mtime))
+                except OSError:
+                    entries.append((entry.name, is_directory, 0, 0.0))      # e.g. a broken symbolic link
+        return entries
 
 
 class KeyUtils:
@@ -102,11 +364,14 @@ class HTTPHeaderUtils:
         return HTTPHeaderUtils.by_semicolon_equal_pairs(value)
     
     @staticmethod
-    def parse_range(value, content_length):
+    def parse_range(value, content_length, max_ranges = 16):
         """
-            [Format] Range: <unit>=<range-start>-[<range-end>], -<range-end>
+            [Format] Range: <unit>=<range-start>-[<range-end>], -<suffix-length>
             [Example Value] bytes=0-0,3-20,16-22,-10,60-
-            [Return] ranges: [(left, right), ...] (right is None if not specified)
+            [Return] ranges: [(left, right), ...] in order, unsatisfiable ones dropped, overlapping or adjacent ones coalesced,
+                e.g. [(0, 0), (3, 22), (60, content_length - 1)] if content_length > 70
+            None if the value is malformed, the header is then ignored and the full content is served (RFC 9110, 14.2)
+            416 if none of them is satisfiable, or there are more than `max_ranges` (if > 0) of them
         """
         if not '=' in value:
             unit = 'bytes'
@@ -114,36 +379,152 @@ class HTTPHeaderUtils:
         else:
             unit, value = value.split('=', 1)
             unit = unit.strip().lower()
+        specs = value.split(',')
+        if len(specs) > max_ranges > 0:
+            raise HTTPStatusException(416, 'Too Many Ranges')
         ranges = []
         try:
-            for range in value.split(','):
+            for range in specs:
                 range = range.strip()
                 if range.startswith('-'):
-                    left = None
-                    right = int(range[1:])
+                    # the last `suffix` bytes, the whole content if it is shorter
+                    suffix = int(range[1:])
+                    left = max(content_length - suffix, 0) if suffix > 0 else content_length
+                    right = content_length - 1
                 elif '-' in range:
                     left, right = range.split('-', 1)
                     left = int(left)
-                    right = int(right) if right else None
+                    if right:
+                        right = int(right)
+                        if left > right:
+                            return None                                 # invalid, not merely unsatisfiable
+                        right = min(right, content_length - 1)          # clamped to the end
+                    else:
+                        right = content_length - 1
                 else:
-                    raise HTTPStatusException(416)
-                
-                if left is None and right is None:
-                    raise HTTPStatusException(416)
-                
-                if left is None:
-                    left = content_length - right
-                    right = content_length - 1
-                elif right is None:
-                    right = content_length - 1
-                
-                if left > right or left >= content_length or right >= content_length:
-                    raise HTTPStatusException(416)
+                    return None
                 
+                if left < 0:
+                    return None
+                if left > right:
+                    continue # unsatisfiable, e.g. starting beyond the end
                 ranges.append((left, right))
         except ValueError:
-            raise HTTPStatusException(416) # from int()
-        return ranges, unit
+            return None # from int()
+        if not ranges:
+            raise HTTPStatusException(416)
+        
+        # coalesce, so that no byte is sent twice
+        ranges.sort()
+        coalesced = [ranges[0]]
+        for left, right in ranges[1:]:
+            if left <= coalesced[-1][1] + 1:
+                coalesced[-1] = (coalesced[-1][0], max(coalesced[-1][1], right))
+            else:
+                coalesced.append((left, right))
+        return coalesced, unit
+    
+    """
+        Content-Encoding
+    """
+    
+    compressible_types = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml', 'application/vnd.ms-fontobject', 'font/ttf', 'font/otf') # prefixes; already compressed ones (images, archives, woff, ...) are left out
+    
+    @staticmethod
+    def is_compressible(content_type):
+        return content_type is not None and content_type.lower().startswith(HTTPHeaderUtils.compressible_types)
+    
+    @staticmethod
+    def accepts_encoding(headers, coding):
+        """
+            [Format] Accept-Encoding: <coding>;q=<weight>, ...
+            [Example Value] gzip, deflate, br;q=0.9, *;q=0
+            [Return] whether `coding` is acceptable, i.e. listed (or `*` is) with a weight above 0; False without the header
+        """
+        weights = {}
+        for item in headers.get_all('Accept-Encoding'):
+            name, _, parameters = item.partition(';')
+            weight = 1.0
+            parameters = parameters.strip().lower()
+            if parameters.startswith('q='):
+                try:
+                    weight = float(parameters[2:])
+                except ValueError:
+                    weight = 0.0
+            weights[name.strip().lower()] = weight
+        return weights.get(coding, weights.get('*', 0.0)) > 0
+    
+    """
+        Validators, for conditional requests
+    """
+    
+    @staticmethod
+    def generate_etag(*stats):
+        """
+            [Return] strong entity tag of the content made of files of `stats` (os.stat_result), from their inode, size and mtime,
+                e.g. "3a2f1-2af8-17a3c5e1b2d4f000"
+        """
+        return '"' + '-'.join(f'{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}' for stat in stats) + '"'
+    
+    @staticmethod
+    def generate_content_etag(content):
+        """
+            [Return] strong entity tag of `content` (bytes) from its digest, for a response not made of files (e.g. a generated listing),
+                e.g. "9f86d081884c7d659a2feaa0"
+        """
+        return '"' + hashlib.blake2b(content, digest_size = 12).hexdigest() + '"'
+    
+    @staticmethod
+    def format_http_date(timestamp):
+        """
+            [Return] e.g. Sun, 18 Oct 2026 16:21:54 GMT
+        """
+        return email.utils.formatdate(timestamp, usegmt = True)
+    
+    @staticmethod
+    def parse_http_date(value):
+        """
+            [Example Value] Sun, 18 Oct 2026 16:21:54 GMT
+            [Return] timestamp, None if invalid (ignored as the header is, instead of 400)
+        """
+        try:
+            parsed = email.utils.parsedate_tz(value)
+            return email.utils.mktime_tz(parsed) if parsed else None
+        except (TypeError, ValueError, OverflowError):
+            return None
+    
+    @staticmethod
+    def is_not_modified(headers, etag, last_modified):
+        """
+            [Format] If-None-Match: "<etag>", W/"<etag>", ... | *
+                     If-Modified-Since: <http-date>, only considered without If-None-Match
+            [Return] whether the copy of the client is still valid, i.e. 304 for GET / HEAD; `last_modified` is a timestamp in seconds
+        """
+        if headers.is_exist('If-None-Match'):
+            tags = headers.get_all('If-None-Match')
+            return '*' in tags or etag in (tag[2:] if tag.startswith('W/') else tag for tag in tags) # weak comparison
+        if headers.is_exist('If-Modified-Since'):
+            since = HTTPHeaderUtils.parse_http_date(headers.get('If-Modified-Since'))
+            return since is not None and int(last_modified) <= since
+        return False
+    
+    @staticmethod
+    def is_range_valid(headers, etag, last_modified):
+        """
+            [Format] If-Range: "<etag>" | <http-date>
+            [Return] whether a Range of the request is applied, i.e. no If-Range or it still matches (strong comparison);
+                otherwise the full content is sent as the client's partial copy is stale
+        """
+        if not headers.is_exist('If-Range'):
+            return True
+        value = headers.get('If-Range').strip()
+        if value.startswith('"'):
+            return value == etag
+        if value.startswith('W/'):
+            return False # weak tags cannot validate a range
+        if time.time() - last_modified < 1:
+            return False # modified within the last second, the date cannot tell two versions apart
+        return HTTPHeaderUtils.parse_http_date(value) == int(last_modified)
 
 
 class HTTPBodyUtils:
@@ -165,39 +546,161 @@ class HTTPBodyUtils:
                 
                 Content of file 2
                 --327c6dfd4efcbc1a8cb73dfbd452c924--
-            [Return] file_list: [{name: str, filename: str, content_type: str, content: bytes}), ...], [] if no file, None if error
+            [Return] file_list: [{name: str, filename: str, content_type: str, content: memoryview}), ...], [] if no file, None if error
                 (the four items may not exist)
         """
-        if not isinstance(body, bytes):
+        if isinstance(body, str):
             body = body.encode()
         if not isinstance(boundary, bytes):
             boundary = boundary.encode()
+        body = memoryview(body) # bytes-like (e.g. a memoryview into the recv buffer), parts are sliced without copying
         
         file_list = []
-        parts = body.split(b'--' + boundary)
-        if len(parts) < 3:
+        delimiter = b'--' + boundary
+        positions = [match.start() for match in re.finditer(re.escape(delimiter), body)]
+        if len(positions) < 2:
             return None
-        for part in parts[1:-1]: # ignore '' and '--\r\n' at the beginning and end
-            part = part[2:-2] # remove \r\n at the beginning and end
-            part_splited = part.split(b'\r\n\r\n', 1)
-            if len(part_splited) != 2:
+        for begin, end in zip(positions[:-1], positions[1:]): # ignore '' and '--\r\n' at the beginning and end
+            begin += len(delimiter) + 2 # remove \r\n at the beginning and end
+            end -= 2
+            header_end = re.compile(b'\r\n\r\n').search(body, begin, end)
+            if header_end is None:
                 # return None
                 continue
             
-            header = HTTPHeaders.from_parsing(part_splited[0])
-            content = part_splited[1]
+            header = HTTPHeaders.from_parsing(body[begin:header_end.start()].tobytes())
+            content = body[header_end.end():end]
             
-            file_item = {}
-            if header.get('Content-Disposition'):
-                content_disposition_dict = HTTPHeaderUtils.by_semicolon_equal_pairs(header.get('Content-Disposition'))
-                if content_disposition_dict.get('name', None):
-                    file_item['name'] = content_disposition_dict['name'].strip('"').strip("'")
-                if content_disposition_dict.get('filename', None):
-                    file_item['filename'] = content_disposition_dict['filename'].strip('"').strip("'")
-                if header.get('Content-Type'):
-                    file_item['content_type'] = header.get('Content-Type')
+            file_item = HTTPBodyUtils.parse_part_header(header)
+            if file_item:
                 file_item['content'] = content
             file_list.append(file_item)
         
         return file_list
+    
+    @staticmethod
+    def parse_part_header(header):
+        # HTTPHeaders of a multipart/form-data part -> {name: str, filename: str, content_type: str} (the three items may not exist), {} without Content-Disposition
+        file_item = {}
+        if header.get('Content-Disposition'):
+            content_disposition_dict = HTTPHeaderUtils.by_semicolon_equal_pairs(header.get('Content-Disposition'))
+            if content_disposition_dict.get('name', None):
+                file_item['name'] = content_disposition_dict['name'].strip('"').strip("'")
+            if content_disposition_dict.get('filename', None):
+                file_item['filename'] = content_disposition_dict['filename'].strip('"').strip("'")
+            if header.get('Content-Type'):
+                file_item['content_type'] = header.get('Content-Type')
+        return file_item
+
+
+"""
+    MultipartFormDataParser
+        incremental multipart/form-data parser, written (fed) with the body in pieces of any size as it arrives;
+        the content of each part goes straight into the file object returned by `part_opener(file_item)` (None to drop it),
+        only the pending part header and a tail shorter than the delimiter are held in memory.
+    Usage:
+        parser = MultipartFormDataParser(boundary, part_opener)
+        parser.write(data) ...                  # e.g. as the body consumer of a request
+        file_list = parser.finish()             # like HTTPBodyUtils.parse_multipart_form_data(), 'file' instead of 'content', None if error
+        parser.close()
+"""
+class MultipartFormDataParser:
+    PREAMBLE = 0        # looking for the first delimiter
+    DELIMITED = 1       # after a delimiter, \r\n for the next part or -- for the end
+    HEADER = 2          # receiving part header
+    CONTENT = 3         # receiving part content, up to \r\n and the next delimiter
+    END = 4             # after the close delimiter, the epilogue is ignored
+    ERROR = 5
+    
+    max_header_size = 16384
+    
+    def __init__(self, boundary, part_opener):
+        if not isinstance(boundary, bytes):
+            boundary = boundary.encode()
+        self.delimiter = b'--' + boundary
+        self.content_end = b'\r\n' + self.delimiter
+        self.part_opener = part_opener
+        self.buffer = bytearray()
+        self.state = MultipartFormDataParser.PREAMBLE
+        self.delimiter_num = 0
+        self.file_list = []
+        self.part_file = None
+    
+    def write(self, data):
+        self.buffer += data
+        with memoryview(self.buffer) as view:
+            consumed = self.process(view)
+        del self.buffer[:consumed]
+        return len(data)
+    
+    def process(self, view):
+        # parse as far as possible, returns the number of bytes consumed
+        pos = 0
+        while True:
+            if self.state == MultipartFormDataParser.PREAMBLE:
+                find_idx = self.buffer.find(self.delimiter, pos)
+                if find_idx < 0:
+                    return max(pos, len(self.buffer) - len(self.delimiter) + 1)
+                pos = find_idx + len(self.delimiter)
+                self.delimiter_num += 1
+                self.state = MultipartFormDataParser.DELIMITED
+            elif self.state == MultipartFormDataParser.DELIMITED:
+                if len(self.buffer) - pos < 2:
+                    return pos
+                if view[pos:(pos + 2)] == b'--':
+                    self.state = MultipartFormDataParser.END
+                elif view[pos:(pos + 2)] == b'\r\n':
+                    self.state = MultipartFormDataParser.HEADER
+                else:
+                    self.state = MultipartFormDataParser.ERROR
+                pos += 2
+            elif self.state == MultipartFormDataParser.HEADER:
+                find_idx = self.buffer.find(b'\r\n\r\n', pos)
+                if find_idx < 0:
+                    if len(self.buffer) - pos > self.max_header_size:
+                        self.state = MultipartFormDataParser.ERROR
+                    return pos
+                try:
+                    header = HTTPHeaders.from_parsing(view[pos:find_idx].tobytes())
+                except HTTPStatusException:
+                    self.state = MultipartFormDataParser.ERROR
+                    continue
+                file_item = HTTPBodyUtils.parse_part_header(header)
+                self.part_file = self.part_opener(file_item) if file_item else None
+                if self.part_file is not None:
+                    file_item['file'] = self.part_file
+                self.file_list.append(file_item)
+                pos = find_idx + 4
+                self.state = MultipartFormDataParser.CONTENT
+            elif self.state == MultipartFormDataParser.CONTENT:
+                find_idx = self.buffer.find(self.content_end, pos)
+                content_end = find_idx if find_idx >= 0 else max(pos, len(self.buffer) - len(self.content_end) + 1) # the tail may be part of the delimiter
+                if self.part_file is not None and content_end > pos:
+                    self.part_file.write(view[pos:content_end])
+                if find_idx < 0:
+                    return content_end
+                self.close_part()
+                pos = find_idx + len(self.content_end)
+                self.delimiter_num += 1
+                self.state = MultipartFormDataParser.DELIMITED
+            else: # END or ERROR
+                return len(self.buffer)
+    
+    def finish(self):
+        # file_list once the body has been written completely, None if it is not a valid multipart/form-data body
+        if self.state == MultipartFormDataParser.ERROR or self.delimiter_num < 2:
+            return None
+        if self.state == MultipartFormDataParser.CONTENT:
+            self.close_part()
+            self.file_list.pop() # unterminated part, ignored as parse_multipart_form_data() does
+        return self.file_list
+    
+    def close_part(self):
+        if self.part_file is not None:
+            self.part_file.close()
+            self.part_file = None
+    
+    def close(self):
+        self.close_part()
+        self.buffer = bytearray()
 
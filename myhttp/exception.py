@@ -3,15 +3,21 @@ class HTTPStatusException(Exception):
         200: 'OK',
         206: 'Partial Content',
         301: 'Redirect',
+        304: 'Not Modified',
         400: 'Bad Request',
         401: 'Unauthorized',
         403: 'Forbidden',
         404: 'Not Found',
         405: 'Method Not Allowed',
+        408: 'Request Timeout',
+        413: 'Content Too Large',
         416: 'Range Not Satisfiable',
+        431: 'Request Header Fields Too Large',
         500: 'Internal Server Error', # TODO: not in the document
+        501: 'Not Implemented',
         502: 'Bad Gateway',
-        503: 'Service Temporarily Unavailable'
+        503: 'Service Temporarily Unavailable',
+        507: 'Insufficient Storage'
     }
     
     def __init__(self, status_code, status_desc = None):
@@ -1,6 +1,9 @@
 import mimetypes
+import mmap
+import zlib
 import re
 import os
+import io
 
 from .exception import HTTPStatusException
 
@@ -10,6 +13,8 @@ class HTTPUrl:
     params_pattern = re.compile(r'[\?&]([^=]+)=([^&]*)') # param key-value pairs
     percent_encoding_pattern = re.compile(r'%([0-9a-fA-F]{2})') # percent encoding
     
+    __slots__ = ('path_list', 'params')
+    
     def __init__(self, path_list = [''], params = {}):
         self.path_list = path_list # the last item is the file name, if path_list[-1] == '' means directory
         self.params = params
@@ -40,6 +45,8 @@ class HTTPUrl:
 
 
 class HTTPRequestLine:
+    __slots__ = ('method', 'path', 'version')
+    
     def __init__(self, method, path, version):
         self.method = method
         self.path = path
@@ -58,6 +65,8 @@ class HTTPRequestLine:
 
 
 class HTTPStatusLine:
+    __slots__ = ('version', 'status_code', 'status_desc')
+    
     def __init__(self, version, status_code, status_desc):
         self.version = version
         self.status_code = status_code
@@ -78,6 +87,12 @@ class HTTPStatusLine:
 
 
 class HTTPHeaders:
+    token_chars = b"!#$%&'*+-.^_`|~0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz" # field names and methods are tokens (RFC 7230 3.2.6), see from_lines()
+    list_separators = {'cookie': '; '}                                      # repeated fields are combined with ', ' (RFC 7230 3.2.2), except these
+    list_pattern = re.compile(r'(?:[^,"]|"(?:[^"\\]|\\.)*")+')               # items of a comma-separated value, commas in quoted strings kept
+    
+    __slots__ = ('headers',)
+    
     def __init__(self, headers = {}):
         headers_lower = {key.lower(): value for key, value in headers.items()} # key is case-insensitive
         self.headers: dict = headers_lower
@@ -91,12 +106,27 @@ class HTTPHeaders:
         # key is case-insensitive
         key_lower = key.lower()
         return self.headers.get(key_lower, None)
+    
+    def get_all(self, key):
+        # items of a (possibly repeated) list-valued field, e.g. 'Accept-Encoding: gzip, br' -> ['gzip', 'br'], [] if absent
+        value = self.get(key)
+        if value is None:
+            return []
+        return [item.strip() for item in self.list_pattern.findall(value) if item.strip()]
 
     def set(self, key, value):
         # key is case-insensitive
         key_lower = key.lower()
         self.headers[key_lower] = value
     
+    def add(self, key, value):
+        # append a value to a list-valued field, e.g. Vary
+        key_lower = key.lower()
+        if key_lower in self.headers:
+            self.headers[key_lower] = f'{self.headers[key_lower]}{self.list_separators.get(key_lower, ", ")}{value}'
+        else:
+            self.headers[key_lower] = value
+    
     def remove(self, key):
         # key is case-insensitive
         key_lower = key.lower()
@@ -110,38 +140,242 @@ class HTTPHeaders:
         return ''.join([f'{key}: {value}\r\n' for key, value in self.headers.items()]).encode()
     
     @classmethod
-    def from_parsing(c, lines):
+    def from_parsing(c, lines, max_count = 0):
+        # lines <- bytes of b'Name: value' lines separated by b'\r\n' (empty ones skipped)
+        try:
+            lines = lines.decode().split('\r\n')
+        except UnicodeDecodeError:
+            raise HTTPStatusException(400)
+        return c.from_lines([line for line in lines if line], max_count)
+    
+    @classmethod
+    def from_lines(c, lines, max_count = 0):
+        # lines <- list of 'Name: value', at most `max_count` of them if > 0 (431 otherwise)
+        if len(lines) > max_count > 0:
+            raise HTTPStatusException(431)
         headers = {}
-        splitted = lines.split(b'\r\n')
-        for line in splitted:
-            splitted = line.decode().split(':', 1) # TODO: value may contain ':', or use rsplit(': ')?
-            if len(splitted) == 2:
-                # key is case-insensitive, value is not certain
-                key_lower = splitted[0].lower().strip()
-                value = splitted[1].strip()
-                headers[key_lower] = value
-            elif len(line) != 0:
+        for line in lines:
+            name, colon, value = line.partition(':')
+            if not colon:
                 raise HTTPStatusException(400)
-        return c(headers)
+            headers[name.lower()] = value.strip(' \t')
+        if len(headers) != len(lines):
+            headers = {}                                                    # some field is repeated, combine the values this time
+            for line in lines:
+                name, _, value = line.partition(':')
+                key_lower, value = name.lower(), value.strip(' \t')
+                headers[key_lower] = f'{headers[key_lower]}{c.list_separators.get(key_lower, ", ")}{value}' if key_lower in headers else value
+        if '' in headers or ''.join(headers).encode().translate(None, c.token_chars):
+            raise HTTPStatusException(400) # a name is not a token (all of them are checked by one translate()), e.g. whitespace before the colon, obsolete line folding
+        headers_encapsulated = c.__new__(c)
+        headers_encapsulated.headers = headers                              # keys are lowercase already
+        return headers_encapsulated
 
 
 class HTTPRequestMessage:
-    def __init__(self, request_line, headers, body = b''):
+    __slots__ = ('request_line', 'headers', 'body_data', 'body_file', 'body_consumer')
+    
+    def __init__(self, request_line, headers, body = b'', body_file = None, body_consumer = None):
         self.request_line = request_line
         self.headers = headers
-        self.body = body
-        self.headers.set('Content-Length', len(body))
+        self.body_data = body # bytes-like
+        self.body_file = body_file # file object (e.g. tempfile.SpooledTemporaryFile) holding a large body instead of `body_data`
+        self.body_consumer = body_consumer # writable file object that has consumed the body while receiving, see HTTPServer.body_consumer()
+        self.headers.set('Content-Length', self.body_length())
+    
+    @property
+    def body(self):
+        # bytes-like, a body in a file is memory-mapped rather than read into memory
+        if self.body_file is None:
+            return self.body_data
+        if self.body_length() == 0:
+            return b''
+        self.body_file.flush()
+        return memoryview(mmap.mmap(self.body_file.fileno(), 0, access = mmap.ACCESS_READ)) # unmapped when the last view is released
+    
+    @body.setter
+    def body(self, body):
+        self.close()
+        self.body_data = body
+    
+    def body_length(self):
+        if self.body_file is None:
+            return len(self.body_data)
+        self.body_file.seek(0, os.SEEK_END)
+        return self.body_file.tell()
+    
+    def body_stream(self):
+        # readable binary file object at the beginning of the body, e.g. for shutil.copyfileobj()
+        if self.body_file is None:
+            return io.BytesIO(self.body_data)
+        self.body_file.seek(0)
+        return self.body_file
+    
+    @classmethod
+    def parse_head(c, head, max_header_count = 0):
+        # head <- bytes of a request line and header lines (without the empty line ending them), decoded and split once
+        # returns (HTTPRequestLine, HTTPHeaders), raises HTTPStatusException 400 (malformed) or 431 (more than `max_header_count` fields)
+        try:
+            lines = head.decode().split('\r\n')
+        except UnicodeDecodeError:
+            raise HTTPStatusException(400)
+        if head.count(b'\n') != len(lines) - 1 or head.count(b'\r') != len(lines) - 1:
+            raise HTTPStatusException(400) # a bare CR or LF
+        splitted = lines[0].split(' ')
+        if len(splitted) != 3 or not splitted[0] or splitted[0].encode().translate(None, HTTPHeaders.token_chars) or not splitted[1] or not splitted[2].startswith('HTTP/'):
+            raise HTTPStatusException(400)
+        return HTTPRequestLine(splitted[0], splitted[1], splitted[2]), HTTPHeaders.from_lines(lines[1:], max_header_count)
+    
+    def close(self):
+        # release the body file and consumer, e.g. delete a spooled body from disk
+        if self.body_file is not None:
+            self.body_file.close()
+            self.body_file = None
+        if self.body_consumer is not None:
+            self.body_consumer.close()
+            self.body_consumer = None
     
     def serialize(self):
         return self.request_line.serialize() + self.headers.serialize() + b'\r\n' + self.body
 
 
+class HTTPFileBody:
+    """
+        File-backed response body: `length` bytes of `file` from `offset`, written by the connection with os.sendfile()
+        (read in blocks where it cannot be used) instead of being read into memory.
+        The connection advances `offset` / `length` while sending, and closes it once sent.
+    """
+    drop_cache_size = 4194304                                               # bytes, a region at least this large leaves the page cache once sent, not to evict hot small files
+    
+    __slots__ = ('file', 'offset', 'length', 'start')
+    
+    def __init__(self, file, offset = 0, length = None):
+        self.file = file                                                    # binary file object, owned by the body
+        self.offset = offset
+        self.length = os.fstat(file.fileno()).st_size - offset if length is None else length
+        self.start = offset
+        self.advise('POSIX_FADV_SEQUENTIAL')                                # larger read-ahead
+    
+    def __len__(self):
+        return self.length                                                  # bytes not sent yet
+    
+    def fileno(self):
+        return self.file.fileno()
+    
+    def read(self, size = -1):
+        # the next `size` bytes (all the rest by default) into memory, e.g. to be encrypted
+        if size < 0 or size > self.length:
+            size = self.length
+        data = os.pread(self.file.fileno(), size, self.offset)
+        self.offset += len(data)
+        self.length -= len(data)
+        return data
+    
+    def advise(self, advice):
+        # posix_fadvise() on the region, where available
+        if hasattr(os, advice):
+            try:
+                os.posix_fadvise(self.file.fileno(), self.start, self.offset + self.length - self.start, getattr(os, advice))
+            except OSError:
+                pass
+    
+    def close(self):
+        if self.file is not None:
+            if self.length == 0 and self.offset - self.start >= self.drop_cache_size:
+                self.advise('POSIX_FADV_DONTNEED')                          # all sent
+            self.file.close()
+            self.file = None
+
+
+class HTTPBodyProducer:
+    """
+        Streamed response body: data pulled from `source` (an iterable of bytes-like / str, e.g. a generator, or a readable file object)
+        by the connection whenever the socket can take more, instead of being pushed by the route handler.
+        `length` is the total if known (sent as Content-Length), otherwise the data are framed as chunks when `chunked`.
+    """
+    read_block = 65536                                                      # bytes read per pull from a file object
+    
+    __slots__ = ('source', 'iterator', 'length', 'chunked', 'is_exhausted')
+    
+    def __init__(self, source, length = None, chunked = False):
+        self.source = source                                                # owned by the producer, closed with it
+        if hasattr(source, 'read'):
+            self.iterator = iter(lambda: source.read(self.read_block), source.read(0))
+        else:
+            self.iterator = iter(source)
+        self.length = length                                                # bytes not produced yet, None if unknown
+        self.chunked = chunked and length is None
+        self.is_exhausted = False
+    
+    def __len__(self):
+        # bytes not produced yet, 1 while the end of an unknown length is not reached, so that the connection keeps it pending
+        if self.length is not None:
+            return self.length
+        return 0 if self.is_exhausted else 1
+    
+    def pull(self):
+        # the next fragments to send, framed as a chunk if `chunked`; [] when there is nothing this time
+        try:
+            data = next(self.iterator)
+        except StopIteration:
+            if self.length:
+                raise ConnectionAbortedError('Body Truncated')              # the promised length cannot be sent any more
+            self.is_exhausted = True
+            return [b'0\r\n\r\n'] if self.chunked else []
+        if isinstance(data, str):
+            data = data.encode()
+        if not data:
+            return []
+        if self.length is not None:
+            if len(data) > self.length:
+                raise ConnectionAbortedError('Body Overlong')               # more than the Content-Length sent
+            self.length -= len(data)
+            if self.length == 0:
+                self.is_exhausted = True
+        if self.chunked:
+            return [f'{len(data):X}\r\n'.encode(), data, b'\r\n']      # framed without copying the data
+        return [data]
+    
+    def compress(self, level = 6):
+        # gzip the data as they are pulled (Content-Encoding: gzip), the length is unknown from then on, i.e. chunked
+        self.iterator = HTTPBodyProducer.gzip(self.iterator, level)
+        self.length = None
+        self.chunked = True
+    
+    @staticmethod
+    def gzip(iterator, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip container
+        for data in iterator:
+            data = compressor.compress(data.encode() if isinstance(data, str) else data)
+            if data:
+                yield data # nothing until the compressor has a block
+        yield compressor.flush()
+    
+    def read(self):
+        # all the rest into memory, unframed, e.g. to be encrypted
+        return b''.join(data.encode() if isinstance(data, str) else data for data in self.iterator)
+    
+    def close(self):
+        if hasattr(self.source, 'close'):
+            self.source.close()                                             # e.g. a generator is finalized without producing the rest
+
+
 class HTTPResponseMessage:
+    __slots__ = ('status_line', 'headers', 'body')
+    
     def __init__(self, status_line, headers, body = b''):
         self.status_line = status_line
         self.headers = headers
         self.body = body
     
+    def reset(self, version):
+        # reuse the message for the next response of the connection, i.e. 200 OK with an empty body
+        self.update_version(version)
+        self.update_status(200, 'OK')
+        self.headers.clear()
+        self.headers.set('Content-Length', '0')
+        self.update_body(b'')
+    
     def update_version(self, version):
         self.status_line.version = version
     
@@ -159,17 +393,35 @@ class HTTPResponseMessage:
             self.headers.set(key, value)
     
     def update_body(self, body): # automatically set Content-Length if there has been one; TODO: chunked 不走这
-        if not isinstance(body, bytes):
+        if isinstance(body, str):
             body = body.encode()
-        if self.headers.is_exist('Content-Length'):
-            self.headers.set('Content-Length', len(body))
+        if body is not self.body:
+            self.close_body()                                               # replaced before being sent
         self.body = body
+        if self.headers.is_exist('Content-Length'):
+            self.headers.set('Content-Length', self.body_length())
+    
+    def body_fragments(self):
+        # the body is bytes-like, a HTTPFileBody, or a list of them sent one after another (e.g. multipart/byteranges)
+        return self.body if isinstance(self.body, list) else [self.body]
+    
+    def body_length(self):
+        return sum(len(fragment) for fragment in self.body_fragments())
+    
+    def read_body(self):
+        # the whole body in memory, file fragments and producers are read (and consumed)
+        return b''.join(fragment.read() if isinstance(fragment, (HTTPFileBody, HTTPBodyProducer)) else fragment for fragment in self.body_fragments())
+    
+    def close_body(self):
+        for fragment in self.body_fragments():
+            if isinstance(fragment, (HTTPFileBody, HTTPBodyProducer)):
+                fragment.close()
         
     def serialize_header(self):
         return self.status_line.serialize() + self.headers.serialize() + b'\r\n'
     
     def serialize(self):
-        return self.serialize_header() + self.body
+        return self.serialize_header() + self.read_body()
     
     """
         Generating
@@ -183,9 +435,9 @@ class HTTPResponseMessage:
         self.update_header('Content-Length', str(len(body)))
         self.update_body(body)
     
-    def update_by_file_path(self, file_path, use_mime = True):
-        with open(file_path, 'rb') as f:
-            body = f.read()
+    def update_by_file_path(self, file_path, use_mime = True, content = None):
+        # `content`: the content of the file if it is already in memory (e.g. see FileCache), sent as it is, never copied
+        body = HTTPFileBody(open(file_path, 'rb')) if content is None else memoryview(content) # sent from the file, see HTTPFileBody
         if use_mime:
             content_type = mimetypes.guess_type(file_path)[0]
             content_disposition = 'inline'
@@ -198,6 +450,54 @@ class HTTPResponseMessage:
         self.update_header('Content-Disposition', f'{content_disposition}; filename="{os.path.basename(file_path)}"')
         self.update_body(body)
     
+    def update_by_producer(self, source, length = None, content_type = 'application/octet-stream'):
+        """
+            Streamed body, see HTTPBodyProducer: Content-Length if `length` is known, chunked otherwise;
+            nothing is produced for a HEAD request
+        """
+        body = HTTPBodyProducer(source, length, chunked = length is None)
+        self.update_header('Content-Type', content_type)
+        if length is None:
+            self.headers.remove('Content-Length')
+            self.update_header('Transfer-Encoding', 'chunked')
+        else:
+            self.update_header('Content-Length', str(length))
+        self.update_body(body)
+    
+    def update_not_modified(self):
+        # 304 to a conditional GET / HEAD: the validators (e.g. ETag) are kept, there is no body, not even its Content-Length
+        self.update_status(304)
+        self.headers.remove('Content-Length')
+        self.headers.remove('Content-Type')
+        self.update_body(b'')
+    
+    def update_by_file_ranges(self, file_path, ranges, content_type, boundary):
+        """
+            206 Partial Content of `ranges` ([(first, last), ...], see HTTPHeaderUtils.parse_range()) of the file,
+            each range is sent from the file at its offset, parts of a multipart/byteranges body are never joined in memory
+        """
+        file_length = os.stat(file_path).st_size
+        self.update_status(206)
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            self.update_header('Content-Type', content_type)
+            self.update_header('Content-Range', f'bytes {first}-{last}/{file_length}')
+            self.update_body(HTTPFileBody(open(file_path, 'rb'), first, last - first + 1))
+            self.update_header('Content-Length', str(self.body_length()))
+            return
+        
+        self.update_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+        body = [f'--{boundary}'.encode()]
+        try:
+            for first, last in ranges:
+                body.append(f'\r\nContent-Type: {content_type}\r\nContent-Range: bytes {first}-{last}/{file_length}\r\n\r\n'.encode())
+                body.append(HTTPFileBody(open(file_path, 'rb'), first, last - first + 1)) # one file object per part, each is closed once sent
+                body.append(f'\r\n--{boundary}'.encode())
+            body.append(b'--\r\n')
+        finally:
+            self.update_body(body)                                          # parts opened before a failure are closed with the response
+        self.update_header('Content-Length', str(self.body_length()))
+    
     @classmethod
     def from_parsing(c, data):
         print(data)
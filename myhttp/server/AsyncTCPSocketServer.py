@@ -0,0 +1,273 @@
+import threading
+import asyncio
+
+from .TCPSocketServer import TCPSocketServer, BaseConnectionHandlerClass
+from ..log import log_print, LogLevel, do_raise
+
+
+"""
+    AsyncConnection
+        socket-like facade of an asyncio transport, so connection handlers keep using `connection.send()` etc.;
+        calls from other threads (workers) are forwarded to the event loop.
+"""
+class AsyncConnection:
+    __slots__ = ('transport', 'loop', 'loop_thread_id', 'write_paused')
+    
+    def __init__(self, transport, loop, loop_thread_id):
+        self.transport = transport
+        self.loop = loop
+        self.loop_thread_id = loop_thread_id
+        self.write_paused = False                                           # the transport buffer is above its high-water mark, see AsyncConnectionProtocol
+    
+    def call(self, func, *args):
+        if threading.get_ident() == self.loop_thread_id:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+    
+    def getpeername(self):
+        return self.transport.get_extra_info('peername')
+    
+    def send(self, data):
+        self.call(self.transport.write, bytes(data))
+        return len(data)
+    
+    def sendmsg(self, buffers):
+        # the transport copies what it cannot write at once; buffers passed to another thread are copied first
+        if threading.get_ident() == self.loop_thread_id:
+            self.transport.writelines(buffers)
+        else:
+            self.loop.call_soon_threadsafe(self.transport.writelines, [bytes(buffer) for buffer in buffers])
+        return sum(len(buffer) for buffer in buffers)
+    
+    def is_writable(self):
+        # whether more data (e.g. blocks of a file) should be written now; from other threads, they are left to the event loop
+        return not self.write_paused and threading.get_ident() == self.loop_thread_id and not self.transport.is_closing()
+    
+    def shutdown(self, how):
+        self.call(self.write_eof)
+    
+    def close(self):
+        self.call(self.transport.close)
+    
+    def write_eof(self):
+        if not self.transport.is_closing() and self.transport.can_write_eof():
+            self.transport.write_eof()
+    
+    def pause_reading(self):
+        if not self.transport.is_closing():
+            self.transport.pause_reading()
+    
+    def resume_reading(self):
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+
+class AsyncConnectionProtocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.connection = None
+    
+    def connection_made(self, transport):
+        self.connection = AsyncConnection(transport, self.server.loop, self.server.loop_thread_id)
+        connection_handler = self.server.ConnectionHandlerClass(self.connection, self.server) # encapsulate
+        self.server.connection_handlers_map[self.connection] = connection_handler
+        connection_handler.setup()                                          # lifecycle: setup()
+        connection_handler.update_timer()
+    
+    def data_received(self, data):
+        self.feed(data)
+    
+    def eof_received(self):
+        self.feed(b'')
+        return False                                                        # let the transport close itself
+    
+    def pause_writing(self):
+        self.connection.write_paused = True
+    
+    def resume_writing(self):
+        self.connection.write_paused = False
+        self.server.loop.call_soon(self.flush)                              # not from within the transport's write callback, where closing the transport would report the loss twice
+    
+    def flush(self):
+        connection_handler = self.server.connection_handlers_map.get(self.connection)
+        if connection_handler and connection_handler.send_pending and not connection_handler.is_paused:
+            try:
+                connection_handler.on_writable()                            # e.g. the rest of a file region
+            except ConnectionError:
+                connection_handler.shutdown(force = True)
+    
+    def connection_lost(self, exc):
+        if self.connection in self.server.connection_handlers_map:
+            self.server.shutdown_connection(self.connection)
+    
+    def feed(self, data):
+        connection_handler = self.server.connection_handlers_map.get(self.connection)
+        if not connection_handler:
+            return
+        try:
+            connection_handler.feed(data)                                   # lifecycle: handle()
+        except ConnectionError:
+            connection_handler.shutdown(force = True)
+        except Exception:
+            if do_raise:
+                raise
+            log_print('unknown error', LogLevel.ERROR)
+
+
+"""
+    AsyncTCPSocketServer
+        the same server interface as TCPSocketServer, served by an asyncio event loop instead of the selectors loop.
+        Combine it with an application server by multiple inheritance, e.g.
+            class AsyncHTTPServer(HTTPServer, AsyncTCPSocketServer)
+        Coroutine route handlers are run as tasks of the loop, with the connection's reading paused until they finish.
+        Accepting and admission control are shared with TCPSocketServer, accepted sockets are then wrapped into transports.
+"""
+class AsyncTCPSocketServer(TCPSocketServer):
+    def __init__(self, hostname, port, ConnectionHandlerClass = BaseConnectionHandlerClass, **kwargs):
+        super().__init__(hostname, port, ConnectionHandlerClass, **kwargs)
+        self.loop = None
+        self.loop_thread_id = None
+        self.shutdown_event = None                                          # set by wakeup(), the serving coroutine then checks the signals
+        self.making_connections = set()                                     # tasks wrapping accepted sockets into transports
+    
+    def launch(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.stop_side_loop()                                           # used by the workers, see TCPSocketServer.run_awaitable()
+            self.shutdown_signal = False
+            self.is_shutdown.set()
+            if self.welcome_socket:
+                self.welcome_socket.close()
+                self.welcome_socket = None
+    
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.shutdown_event = asyncio.Event()
+        
+        # create welcome socket
+        if self.welcome_socket is None:
+            self.create_welcome_socket()
+        self.welcome_socket.setblocking(False)
+        self.resume_accepting()
+        log_print(f'Server is listening on {self.hostname}:{self.port} (asyncio)', 'INFO')
+        
+        # launch workers
+        if self.worker_pool:
+            self.worker_pool.launch()
+            log_print(f'Requests are handled by {self.worker_pool.worker_num} worker threads', 'INFO')
+        
+        # serve
+        try:
+            while not self.shutdown_signal:
+                if self.drain_signal and not self.is_draining:
+                    self.start_draining()
+                if self.pending_connections:
+                    self.admit_pending_connections()                        # slots may be freed
+                if self.is_draining and not (self.connection_handlers_map or self.pending_connections or self.making_connections):
+                    break # all connections are finished
+                await self.shutdown_event.wait()
+                self.shutdown_event.clear()
+        finally:
+            self.pause_accepting()
+            while self.pending_connections:
+                self.pending_connections.popleft().close()
+            for connection in list(self.connection_handlers_map.keys()):
+                self.shutdown_connection(connection)
+            if self.worker_pool:
+                await self.loop.run_in_executor(None, self.worker_pool.shutdown)
+            self.loop = None
+    
+    def wakeup(self):
+        loop = self.loop
+        if loop:
+            loop.call_soon_threadsafe(self.shutdown_event.set)
+    
+    def call_later(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+    
+    def reset_after_fork(self):
+        super().reset_after_fork()
+        self.loop = None
+        self.making_connections = set()
+    
+    """
+        Accepting
+            the welcome socket is watched by the loop, see TCPSocketServer.accept_connections()
+    """
+    
+    def pause_accepting(self):
+        if self.is_accepting:
+            self.loop.remove_reader(self.welcome_socket)
+            self.is_accepting = False
+    
+    def resume_accepting(self):
+        if not self.is_accepting and self.welcome_socket and not self.shutdown_signal:
+            self.loop.add_reader(self.welcome_socket, self.accept_connections)
+            self.is_accepting = True
+    
+    def connection_num(self):
+        return len(self.connection_handlers_map) + len(self.making_connections)
+    
+    def launch_connection(self, connection):
+        # the connection handler is created in AsyncConnectionProtocol.connection_made()
+        task = self.loop.create_task(self.loop.connect_accepted_socket(lambda: AsyncConnectionProtocol(self), connection))
+        self.making_connections.add(task)
+        self.accept_stats['accepted'] += 1
+        
+        def done(task):
+            self.making_connections.discard(task)
+            if not task.cancelled() and task.exception():
+                connection.close() # e.g. reset before being made
+            if self.is_draining:
+                self.wakeup()                                               # see serve()
+        
+        task.add_done_callback(done)
+    
+    def detach_connection(self, connection_handler):
+        self.connection_handlers_map.pop(connection_handler.connection, None)
+        if self.pending_connections or self.is_draining:
+            self.wakeup()                                                   # a slot is freed, see serve()
+    
+    def update_connection_events(self, connection_handler):
+        pass # the transport buffers and writes by itself
+    
+    """
+        Worker Dispatching & Coroutines
+    """
+    
+    def call_in_loop(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+    
+    def pause_connection(self, connection_handler):
+        connection_handler.connection.pause_reading()
+        connection_handler.is_paused = True
+    
+    def resume_connection(self, connection_handler, rehandle = True):
+        if connection_handler.connection is None:
+            return # closed by the worker
+        connection_handler.is_paused = False
+        try:
+            if connection_handler.send_pending:
+                connection_handler.on_writable()                            # left by the worker (e.g. a file region), closed after it if shut down
+            if connection_handler.is_closed:
+                return
+            connection_handler.connection.resume_reading()
+            if rehandle:
+                connection_handler.resume()                                 # data of pipelined requests may be buffered already
+        except ConnectionError:
+            connection_handler.shutdown(force = True)
+    
+    def run_awaitable(self, connection_handler, awaitable):
+        if threading.get_ident() != self.loop_thread_id:
+            return super().run_awaitable(connection_handler, awaitable)     # in a worker, which waits for it
+        
+        def done(task):
+            if not task.cancelled() and isinstance(task.exception(), ConnectionError):
+                connection_handler.shutdown(force = True)
+            self.resume_connection(connection_handler)
+        
+        self.pause_connection(connection_handler)
+        self.loop.create_task(awaitable).add_done_callback(done)
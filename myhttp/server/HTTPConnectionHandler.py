@@ -1,33 +1,48 @@
-from enum import Enum
+import tempfile
+import inspect
+import zlib
 
 from . import BaseConnectionHandlerClass
 from ..log import log_print, LogLevel, do_raise
-from ..message import HTTPRequestLine, HTTPStatusLine, HTTPHeaders, HTTPRequestMessage, HTTPResponseMessage
+from ..message import HTTPStatusLine, HTTPHeaders, HTTPRequestMessage, HTTPResponseMessage, HTTPBodyProducer
+from ..content import HTTPHeaderUtils
 from ..exception import HTTPStatusException
 
 
-class RecvBufferTargetType(Enum):
+class RecvBufferTargetType:                                                 # plain ints, compared on every step of process_targets()
     LENGTH = 0          # require for length -> [target_length]
     MARKER = 1          # require for marker -> [target_marker]
     NO_TARGET = 2       # received all (no target)
+    STREAM = 3          # require for length, written to the body file as it arrives -> [target_length]
 
 
-class RecvBufferState(Enum):
+class RecvBufferState:
     HEADER = 0          # receiving header
     BODY = 1            # receiving body (content-length)
     CHUNK_SIZE = 2      # receiving chunk size (chunked)
     CHUNK_DATA = 3      # receiving chunk data (chunked)
     ALL = 4             # received all
+    CHUNK_CRLF = 5      # receiving \r\n after chunk data (chunked)
+    TRAILER = 6         # receiving trailer field lines up to an empty line after the last chunk (chunked)
 
 
 class RecvBufferManager:
+    __slots__ = (
+        'buffer', 'start', 'end', 'header', 'request_line_encapsulated', 'headers_encapsulated', 'body', 'body_file',
+        'body_consumer', 'body_sink', 'trailer_size',
+        'target_type', 'target_length', 'target_marker', 'state'
+    )
+    
     def __init__(self):
-        self.concatenate_buffer = b'' # may contain part of next request at the end of each request, so only be cleared in __init__()
+        # buffer[start:end] is received but not consumed yet, it may contain part of next request at the end of each request
+        self.buffer = None                                                  # bytearray, allocated when data arrive and released when all consumed
+        self.start = 0
+        self.end = 0
         self.prepare()
     
     def set_target(self, target_type, target_value = None, next_state = None):
         self.target_type = target_type
-        if target_type == RecvBufferTargetType.LENGTH:
+        if target_type == RecvBufferTargetType.LENGTH or target_type == RecvBufferTargetType.STREAM:
             self.target_length = target_value
         elif target_type == RecvBufferTargetType.MARKER:
             self.target_marker = target_value
@@ -40,22 +55,120 @@ class RecvBufferManager:
         self.request_line_encapsulated = None
         self.headers_encapsulated = None
         self.body = b''
+        self.body_file = None
+        self.body_consumer = None
+        self.body_sink = None # where STREAM targets are written, `body_file` or `body_consumer`
+        self.trailer_size = 0 # bytes of trailer field lines discarded so far
         self.set_target(RecvBufferTargetType.MARKER, b'\r\n\r\n', RecvBufferState.HEADER)
+    
+    """
+        Buffer Management
+            reserve() -> recv_into() -> commit(), then find() / consume() pending data without copying;
+            compaction and growth move the pending data into a new bytearray,
+            so memoryviews returned by consume() (e.g. a request body) stay valid and never pin the buffer against resizing
+    """
+    
+    def pending(self):
+        return self.end - self.start
+    
+    def reserve(self, size):
+        # writable memoryview of at least `size` free bytes after the pending data
+        if self.buffer is None:
+            self.buffer = bytearray(size)
+        elif len(self.buffer) - self.end < size:
+            pending = self.end - self.start
+            buffer = bytearray(max(pending + size, 2 * pending))          # geometric growth, copies are amortized O(1) per byte
+            buffer[:pending] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer, self.start, self.end = buffer, 0, pending
+        return memoryview(self.buffer)[self.end:]
+    
+    def commit(self, size):
+        self.end += size
+    
+    def append(self, data):
+        with self.reserve(len(data)) as view:
+            view[:len(data)] = data
+        self.commit(len(data))
+    
+    def find(self, marker):
+        # index relative to start, -1 if not found
+        find_idx = self.buffer.find(marker, self.start, self.end) if self.buffer is not None else -1
+        return find_idx - self.start if find_idx >= 0 else -1
+    
+    def spool_body(self, threshold, rollover = False):
+        # the body is written to a file, kept in memory until `threshold` bytes
+        self.body_file = tempfile.SpooledTemporaryFile(max_size = threshold)
+        if rollover:
+            self.body_file.rollover() # known to exceed `threshold`
+        self.body_sink = self.body_file
+    
+    def consume_body(self, body_consumer):
+        self.body_consumer = body_consumer
+        self.body_sink = body_consumer
+    
+    def release_body(self):
+        # close the body file and consumer of an unfinished request
+        for body_sink in (self.body_file, self.body_consumer):
+            if body_sink is not None:
+                body_sink.close()
+        self.prepare()
+    
+    def unspool_body(self):
+        self.body_file.seek(0)
+        self.body = self.body_file.read()
+        self.body_file.close()
+        self.body_file = None
+    
+    def consume(self, size, skip = 0):
+        # memoryview of the next `size` bytes, then drop `skip` more bytes (e.g. a marker)
+        if self.buffer is None:
+            return memoryview(b'')                                          # nothing pending, e.g. an empty body
+        data = memoryview(self.buffer)[self.start:(self.start + size)]
+        self.start += size + skip
+        if self.start == self.end:
+            self.buffer, self.start, self.end = None, 0, 0                  # released, `data` keeps its bytes alive
+        return data
 
 
 class HTTPConnectionHandler(BaseConnectionHandlerClass):
-    recv_buffer_size = 4096
+    recv_buffer_size = 4096                                                 # bytes, smallest (and initial) recv size
+    max_recv_size = 262144                                                  # bytes, largest single recv
+    recv_drain_budget = 1048576                                             # bytes read per wakeup at most, so that a bulk upload does not starve the other connections
+    max_header_size = 16384                                                 # bytes of a request head, 431 beyond
+    max_header_count = 100                                                  # header fields of a request, 431 beyond
+    max_chunk_size_line = 1024                                              # bytes of a chunk size line (with extensions), 400 beyond
+    body_spool_threshold = 1048576                                          # bytes, larger request bodies (and chunked ones beyond it) are spooled to disk
+    keep_alive_timeout = 15                                                 # seconds, idle time between requests before closing
+    header_timeout = 10                                                     # seconds, from the first byte to the end of a request head
+    body_min_rate = 1024                                                    # bytes per second, checked every `body_rate_interval` seconds
+    body_rate_interval = 10
+    compress_min_size = 1024                                                # bytes, smaller bodies in memory are sent as they are
+    compress_level = 6                                                      # zlib level of gzip Content-Encoding
+    
+    __slots__ = (
+        'request', 'request_count', 'recv_buffer_manager', 'recv_hint',
+        'response', 'chunked_launched', 'chunked_finished', 'additional_data_dict'
+    )
     
     def __init__(self, connection, server):
         super().__init__(connection, server)
         
         self.request = None # each connection will only handle one request at a time
+        self.request_count = 0                                              # finished requests
         self.recv_buffer_manager = RecvBufferManager()
+        self.recv_hint = self.recv_buffer_size                              # adaptive recv size, see handle()
         
-        self.response = None
-        self.refresh_response()
+        self.response = None                                                # allocated for the first request, then reused, see refresh_response()
+        self.reset_chunked_transfer()
         
-        self.additional_data = {}
+        self.additional_data_dict = None
+    
+    @property
+    def additional_data(self):
+        # per-connection storage for applications, allocated on first use
+        if self.additional_data_dict is None:
+            self.additional_data_dict = {}
+        return self.additional_data_dict
     
     """
         Response Management
@@ -63,24 +176,28 @@ class HTTPConnectionHandler(BaseConnectionHandlerClass):
     
     def refresh_response(self):
         self.reset_chunked_transfer()
-        self.response = HTTPResponseMessage(
-            HTTPStatusLine(self.server.http_version, 200, 'OK'),
-            HTTPHeaders({'Content-Length': '0'}),
-            b''
-        )
+        if self.response is None:
+            self.response = HTTPResponseMessage(
+                HTTPStatusLine(self.server.http_version, 200, 'OK'),
+                HTTPHeaders({'Content-Length': '0'}),
+                b''
+            )
+        else:
+            self.response.reset(self.server.http_version)                   # the previous body is released here
     
     def launch_chunked_transfer(self):
         self.chunked_launched = True
         self.response.headers.remove('Content-Length')
         self.response.headers.set('Transfer-Encoding', 'chunked')
+        self.set_tcp_cork(True)                                             # full segments out of the chunks, until finish_request()
         self.send(self.response.serialize_header())
     
     def chunked_transmit(self, chunk_content):
         if self.chunked_launched:
             if self.request.request_line.method != 'HEAD':
-                if not isinstance(chunk_content, bytes):
+                if isinstance(chunk_content, str):
                     chunk_content = chunk_content.encode()
-                self.send(f'{len(chunk_content):X}\r\n'.encode() + chunk_content + b'\r\n')
+                self.send(f'{len(chunk_content):X}\r\n'.encode(), chunk_content, b'\r\n') # framed without copying the chunk
             # else: TODO: waste
         else:
             raise HTTPStatusException(500, 'Chunked Transfer Not Launched') # TODO
@@ -102,6 +219,8 @@ class HTTPConnectionHandler(BaseConnectionHandlerClass):
         Handle HTTP status errors from `connection`
     """
     def error_handler(self, code, desc = None):
+        if self.response is None:
+            self.refresh_response()
         if not desc:
             desc = HTTPStatusException.default_status_description[code]
         if self.request:
@@ -113,10 +232,28 @@ class HTTPConnectionHandler(BaseConnectionHandlerClass):
                 content_type = 'text/plain',
             )
     
+    """
+        Refuse a parsed request without routing it, e.g. 503 when the workers are all busy
+    """
+    def reject_request(self, code, desc = None):
+        self.error_handler(code, desc)
+        self.finish_request()
+    
     """
         Handle a single encapsulated request from `connection`
+            prepare_request() -> route handler -> finish_request(),
+            a coroutine route handler is awaited by the server engine (the connection is paused meanwhile) before finish_request()
     """
     def request_handler(self):
+        if self.prepare_request():
+            awaitable = self.call_route_handler()
+            if awaitable is not None:
+                self.server.run_awaitable(self, self.await_route_handler(awaitable))
+                return
+        self.finish_request()
+    
+    """ Override """
+    def prepare_request(self):
         # add default Connection header
         if not self.request.headers.is_exist('Connection'):
             if self.server.http_version == 'HTTP/1.1':
@@ -124,103 +261,328 @@ class HTTPConnectionHandler(BaseConnectionHandlerClass):
             elif self.server.http_version == 'HTTP/1.0':
                 self.request.headers.set('Connection', 'close')
         
-        # handle request
         self.response.update_version(self.request.request_line.version)
+        return True # whether to route the request
+    
+    def call_route_handler(self):
+        # return the awaitable if the route handler is a coroutine function, otherwise None
         try:
-            self.server.http_route_handler(self)
-        except HTTPStatusException as e:
+            result = self.server.http_route_handler(self)
+            if inspect.isawaitable(result):
+                return result
+        except Exception as e:
+            self.route_exception_handler(e)
+        return None
+    
+    async def await_route_handler(self, awaitable):
+        try:
+            await awaitable
+        except Exception as e:
+            self.route_exception_handler(e)
+        self.finish_request()
+    
+    def route_exception_handler(self, e):
+        if isinstance(e, ConnectionError):
+            raise e # the client is gone, no response to send
+        elif isinstance(e, HTTPStatusException):
             self.error_handler(e.status_code, e.status_desc)
-        except Exception:
+        else:
             if do_raise:
-                raise
+                raise e
             self.error_handler(500) # TODO: ensure the server will not crash due to one of the connections
-        
+    
+    """ Override """
+    def finish_request(self):
         # send prepared response
         if not self.chunked_launched:
-            self.send(self.response.serialize() if self.request.request_line.method != 'HEAD' else self.response.serialize_header())
+            if self.server.is_draining:
+                self.response.update_header('Connection', 'close')          # the last response of this connection
+            self.compress_response()
+            if isinstance(self.response.body, HTTPBodyProducer) and self.response.body.chunked and self.request.request_line.version == 'HTTP/1.0':
+                self.response.body.chunked = False                          # no chunked coding for HTTP/1.0, the end of the body is told by closing the connection
+                self.response.headers.remove('Transfer-Encoding')
+                self.response.update_header('Connection', 'close')
+            if self.request.request_line.method != 'HEAD':
+                self.send(self.response.serialize_header(), *self.response.body_fragments())
+                self.response.body = b'' # handed over to the send queue, e.g. a file body is closed once sent
+            else:
+                self.send(self.response.serialize_header())
         else:
             if not self.chunked_finished:
                 self.error_handler(500, 'Chunked Transfer Not Terminated')
+            self.set_tcp_cork(False)                                        # push out the last partial segment
         
-        # close connection if Connection: close
-        if self.request.headers.is_exist('Connection') and self.request.headers.get('Connection').lower() == 'close':
+        # close connection if Connection: close (asked by the request or the response), or if the server is shutting down
+        if self.server.is_draining or any((message.headers.get('Connection') or '').lower() == 'close' for message in (self.request, self.response)):
             self.shutdown()
         
         # refresh response and request
+        self.request.close()
         self.request = None
+        self.request_count += 1
         self.refresh_response()
     
+    def compress_response(self):
+        # gzip the body of a 200 response if its type is compressible and the client accepts it: a body in memory of at least `compress_min_size` bytes,
+        # or a body producer (compressed as it is pulled); file bodies (sent by os.sendfile(), or shared from a cache as memoryview) are left as they are
+        response = self.response
+        body = response.body
+        if not isinstance(body, (bytes, bytearray, HTTPBodyProducer)):
+            return # e.g. a file body, or a memoryview
+        if response.status_line.status_code != 200 or response.headers.is_exist('Content-Encoding'):
+            return
+        if not HTTPHeaderUtils.is_compressible(response.headers.get('Content-Type')):
+            return
+        if not isinstance(body, HTTPBodyProducer) and len(body) < self.compress_min_size:
+            return
+        response.headers.add('Vary', 'Accept-Encoding')                     # the representation depends on it, for caches
+        if not HTTPHeaderUtils.accepts_encoding(self.request.headers, 'gzip'):
+            return
+        
+        if isinstance(body, HTTPBodyProducer):
+            body.compress(self.compress_level)
+            response.headers.remove('Content-Length')
+            response.update_header('Transfer-Encoding', 'chunked')
+        else:
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip container
+            response.update_body(compressor.compress(body) + compressor.flush())
+        response.update_header('Content-Encoding', 'gzip')
+        etag = response.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            response.update_header('ETag', 'W/' + etag)                     # not byte-identical to the identity one, but If-None-Match still matches (weak comparison)
+    
     """ Override """
     def handle(self):
-        # get recv buffer manager
+        # receive data straight into the recv buffer, until the socket is drained or `recv_drain_budget` is used up
         r = self.recv_buffer_manager
-        
-        # receive data
-        peek_data = self.connection.recv(self.recv_buffer_size) # the connection may be closed by client ConnectionAbortedError will be handled outside
-        if not peek_data:
+        budget = self.recv_drain_budget
+        while True:
+            size = self.recv_size()
+            with r.reserve(size) as view:
+                try:
+                    received = self.connection.recv_into(view) # the connection may be closed by client ConnectionAbortedError will be handled outside
+                except (BlockingIOError, InterruptedError):
+                    return # drained, or a spurious wakeup of the non-blocking socket
+            r.commit(received)
+            
+            # double the hint while reads fill it up, halve it when they are mostly empty
+            if received == size and size >= self.recv_hint:
+                self.recv_hint = min(self.recv_hint * 2, self.max_recv_size)
+            elif received < self.recv_hint // 4:
+                self.recv_hint = max(self.recv_hint // 2, self.recv_buffer_size)
+            
+            self.on_received(received)
+            budget -= received
+            if received < size or budget <= 0 or self.is_paused or self.is_closed:
+                return # a short read has emptied the socket buffer, no need to wait for EAGAIN; the rest (if any) wakes up the selector again
+    
+    """ Override """
+    def feed(self, data):
+        if data:
+            self.recv_buffer_manager.append(data)
+        self.on_received(len(data))
+    
+    def recv_size(self):
+        # the rest of a known-length target in one call, the adaptive hint otherwise, bounded by `max_recv_size`
+        r = self.recv_buffer_manager
+        if r.target_type == RecvBufferTargetType.LENGTH or r.target_type == RecvBufferTargetType.STREAM:
+            return min(max(r.target_length - r.pending(), self.recv_hint), self.max_recv_size)
+        return self.recv_hint
+    
+    def on_received(self, received):
+        if not received:
             # TODO: what has happened?
             self.shutdown()
         else:
-            log_print(f'Data from <{self.address[0]}:{self.address[1]}>: {peek_data}', 'RAW_DATA')
-            r.concatenate_buffer += peek_data
-            
-            while True: # keep on trying to finish and publish targets
-                target_finished = False
-                target_acquired = None
-                if r.target_type == RecvBufferTargetType.LENGTH:
-                    if len(r.concatenate_buffer) >= r.target_length:
-                        target_acquired = r.concatenate_buffer[:r.target_length]
-                        r.concatenate_buffer = r.concatenate_buffer[r.target_length:]
-                        target_finished = True
-                elif r.target_type == RecvBufferTargetType.MARKER:
-                    find_idx = r.concatenate_buffer.find(r.target_marker)
-                    if find_idx >= 0:
-                        target_acquired = r.concatenate_buffer[:find_idx]
-                        r.concatenate_buffer = r.concatenate_buffer[(find_idx + len(r.target_marker)):]
-                        target_finished = True
-                else: # recv.target_type == RecvTargetType.NO_TARGET
+            log_print(f'Data from <{self.address[0]}:{self.address[1]}>: {received} bytes', 'RAW_DATA')
+            self.recv_bytes += received
+            stats = self.server.recv_stats
+            stats['reads'] += 1
+            stats['bytes'] += received
+            self.process_buffer()
+            self.update_timer()
+    
+    """ Override """
+    def get_body_consumer(self):
+        # consumer of the body of the request being received (its head is in the recv buffer manager), None to buffer the body
+        r = self.recv_buffer_manager
+        return self.server.http_body_consumer(r.request_line_encapsulated, r.headers_encapsulated, self)
+    
+    """ Override """
+    def resume(self):
+        self.process_buffer()
+        self.update_timer()
+    
+    """ Override """
+    def on_server_draining(self):
+        # close it now if idle between keep-alive requests, otherwise finish_request() does after the current response
+        r = self.recv_buffer_manager
+        if self.request_count and self.request is None and r.state == RecvBufferState.HEADER and not r.pending():
+            self.shutdown()
+    
+    """
+        Timeouts: keep-alive idle, request head deadline, minimum body rate
+    """
+    
+    """ Override """
+    def timer_state(self):
+        r = self.recv_buffer_manager
+        if self.send_pending or self.is_closed:
+            return super().timer_state()
+        if r.state == RecvBufferState.HEADER:
+            if r.pending():
+                return ('header', self.header_timeout)
+            return ('idle', self.keep_alive_timeout)
+        if r.state == RecvBufferState.ALL:
+            return None
+        return ('body', self.body_rate_interval)
+    
+    """ Override """
+    def on_timeout(self, kind):
+        if kind == 'idle':
+            self.shutdown()
+        elif kind == 'header':
+            self.close_with_error(408)
+        elif kind == 'body':
+            if self.recv_bytes - self.timer_mark[0] < self.body_min_rate * self.body_rate_interval:
+                self.close_with_error(408)
+        else:
+            super().on_timeout(kind)
+    
+    def close_with_error(self, code, desc = None):
+        # respond with an error to a request that cannot be received completely (e.g. a timeout, a malformed head), then close
+        self.request = None
+        self.refresh_response()
+        self.error_handler(code, desc)
+        self.response.update_header('Connection', 'close')
+        self.send(self.response.serialize_header(), *self.response.body_fragments())
+        self.shutdown()
+    
+    """
+        Parse buffered data into requests and dispatch them, stop when the connection is paused (request handed to a worker) or closed
+    """
+    def process_buffer(self):
+        # get recv buffer manager
+        r = self.recv_buffer_manager
+        
+        self.cork() # responses to pipelined requests are written together
+        try:
+            self.process_targets(r)
+        finally:
+            self.uncork()
+    
+    def process_targets(self, r):
+        while not (self.is_paused or self.is_closed): # keep on trying to finish and publish targets
+            target_finished = False
+            target_acquired = None
+            if r.target_type == RecvBufferTargetType.LENGTH:
+                if r.pending() >= r.target_length:
+                    target_acquired = r.consume(r.target_length)
                     target_finished = True
-                
-                if target_finished:
-                    if r.state == RecvBufferState.HEADER:
-                        r.header = target_acquired
-                        try:
-                            # parse request line
-                            eorl = r.header.find(b'\r\n')
-                            r.request_line_encapsulated = HTTPRequestLine.from_parsing(r.header[:eorl])
-                            
-                            # parse headers
-                            r.headers_encapsulated = HTTPHeaders.from_parsing(r.header[(eorl + 2):])
-                            if r.headers_encapsulated.is_exist('Content-Length'):
-                                r.set_target(RecvBufferTargetType.LENGTH, int(r.headers_encapsulated.get('Content-Length')), RecvBufferState.BODY)
-                            elif r.headers_encapsulated.is_exist('Transfer-Encoding'):
-                                r.set_target(RecvBufferTargetType.MARKER, b'\r\n', RecvBufferState.CHUNK_SIZE)
+            elif r.target_type == RecvBufferTargetType.MARKER:
+                find_idx = r.find(r.target_marker)
+                if find_idx >= 0:
+                    target_acquired = r.consume(find_idx, len(r.target_marker))
+                    target_finished = True
+                if r.state == RecvBufferState.HEADER:
+                    if (find_idx if find_idx >= 0 else r.pending()) > self.max_header_size:
+                        self.close_with_error(431)                          # do not buffer an endless head
+                        break
+                elif r.state == RecvBufferState.TRAILER:
+                    if r.trailer_size + (find_idx if find_idx >= 0 else r.pending()) > self.max_header_size:
+                        self.close_with_error(431)                          # nor an endless trailer section
+                        break
+                elif (find_idx if find_idx >= 0 else r.pending()) > self.max_chunk_size_line:
+                    self.close_with_error(400, 'Invalid Chunk Size')
+                    break
+            elif r.target_type == RecvBufferTargetType.STREAM:
+                if r.pending():
+                    stream_length = min(r.pending(), r.target_length)
+                    r.body_sink.write(r.consume(stream_length))
+                    r.target_length -= stream_length
+                target_finished = r.target_length == 0
+            else: # recv.target_type == RecvTargetType.NO_TARGET
+                target_finished = True
+            
+            if target_finished:
+                if r.state == RecvBufferState.HEADER:
+                    r.header = target_acquired.tobytes()
+                    self.server.recv_stats['requests'] += 1
+                    try:
+                        r.request_line_encapsulated, r.headers_encapsulated = HTTPRequestMessage.parse_head(r.header, self.max_header_count)
+                        content_length = r.headers_encapsulated.get('Content-Length')
+                        transfer_encoding = r.headers_encapsulated.get('Transfer-Encoding')
+                        if transfer_encoding is not None:
+                            if content_length is not None:
+                                raise HTTPStatusException(400, 'Both Content-Length and Transfer-Encoding') # ambiguous framing, e.g. request smuggling
+                            if transfer_encoding.lower() != 'chunked':
+                                raise HTTPStatusException(501, 'Transfer-Encoding Not Supported')
+                            body_consumer = self.get_body_consumer()
+                            if body_consumer is not None:
+                                r.consume_body(body_consumer)
                             else:
-                                # TODO: no Content-Length or Transfer-Encoding, no body in default
-                                r.set_target(RecvBufferTargetType.LENGTH, 0, RecvBufferState.BODY)
-                        except HTTPStatusException as e:
-                            self.error_handler(e.status_code, e.status_desc)
-                            self.shutdown() # TODO: 如果是 handle_connection 过程中出错，这里直接选择关闭连接
-                            break
-                    elif r.state == RecvBufferState.BODY:
-                        r.body = target_acquired
-                        r.set_target(RecvBufferTargetType.NO_TARGET)
-                    elif r.state == RecvBufferState.CHUNK_SIZE:
-                        chunk_size = int(target_acquired, 16)
-                        r.set_target(RecvBufferTargetType.LENGTH, chunk_size + 2, RecvBufferState.CHUNK_DATA) # to include \r\n
-                    elif r.state == RecvBufferState.CHUNK_DATA:
-                        chunk_data = target_acquired[:-2] # to exclude \r\n
-                        if len(chunk_data) == 0:
-                            r.set_target(RecvBufferTargetType.NO_TARGET)
-                        else:
-                            r.body += chunk_data
+                                r.spool_body(self.body_spool_threshold)
                             r.set_target(RecvBufferTargetType.MARKER, b'\r\n', RecvBufferState.CHUNK_SIZE)
-                    else: # recv.state == RecvState.ALL:
-                        self.request = HTTPRequestMessage(r.request_line_encapsulated, r.headers_encapsulated, r.body)
-                        self.request_handler()
-                        r.prepare()
-                else:
-                    break # latest target not finished, break the loop and wait for next peek_data
+                        elif content_length is not None:
+                            if not (content_length.isascii() and content_length.isdigit()):
+                                raise HTTPStatusException(400, 'Invalid Content-Length') # also repeated ones, combined as '1, 1'
+                            content_length = int(content_length)
+                            body_consumer = self.get_body_consumer() if content_length > 0 else None
+                            if body_consumer is not None:
+                                r.consume_body(body_consumer)
+                                r.set_target(RecvBufferTargetType.STREAM, content_length, RecvBufferState.BODY)
+                            elif content_length > self.body_spool_threshold:
+                                r.spool_body(self.body_spool_threshold, rollover = True)
+                                r.set_target(RecvBufferTargetType.STREAM, content_length, RecvBufferState.BODY)
+                            else:
+                                r.set_target(RecvBufferTargetType.LENGTH, content_length, RecvBufferState.BODY)
+                        else:
+                            # TODO: no Content-Length or Transfer-Encoding, no body in default
+                            r.set_target(RecvBufferTargetType.LENGTH, 0, RecvBufferState.BODY)
+                    except HTTPStatusException as e:
+                        self.close_with_error(e.status_code, e.status_desc) # the rest of the connection cannot be framed
+                        break
+                elif r.state == RecvBufferState.BODY:
+                    if r.body_sink is None:
+                        r.body = target_acquired                            # memoryview into the recv buffer, no copy
+                    r.set_target(RecvBufferTargetType.NO_TARGET)
+                elif r.state == RecvBufferState.CHUNK_SIZE:
+                    chunk_size = target_acquired.tobytes().partition(b';')[0].strip(b' \t') # without chunk extensions
+                    if not chunk_size or chunk_size.translate(None, b'0123456789abcdefABCDEF'):
+                        self.close_with_error(400, 'Invalid Chunk Size')
+                        break
+                    chunk_size = int(chunk_size, 16)
+                    if chunk_size == 0:
+                        r.set_target(RecvBufferTargetType.MARKER, b'\r\n', RecvBufferState.TRAILER)
+                    else:
+                        r.set_target(RecvBufferTargetType.STREAM, chunk_size, RecvBufferState.CHUNK_DATA)
+                elif r.state == RecvBufferState.CHUNK_DATA:
+                    r.set_target(RecvBufferTargetType.LENGTH, 2, RecvBufferState.CHUNK_CRLF) # the chunk data has been written to the body file
+                elif r.state == RecvBufferState.CHUNK_CRLF:
+                    if target_acquired != b'\r\n':
+                        self.close_with_error(400, 'Invalid Chunk')         # the chunk size does not frame the data
+                        break
+                    r.set_target(RecvBufferTargetType.MARKER, b'\r\n', RecvBufferState.CHUNK_SIZE)
+                elif r.state == RecvBufferState.TRAILER:
+                    if len(target_acquired) > 0:
+                        # a trailer field line, discarded; the section ends with an empty line
+                        name, colon, _ = target_acquired.tobytes().partition(b':')
+                        if not colon or not name or name != name.strip(b' \t'):
+                            self.close_with_error(400, 'Invalid Trailer')   # the rest of the connection cannot be framed
+                            break
+                        r.trailer_size += len(target_acquired) + 2
+                        continue
+                    if r.body_file is not None and r.body_file.tell() <= self.body_spool_threshold:
+                        r.unspool_body() # small enough to have stayed in memory
+                    r.set_target(RecvBufferTargetType.NO_TARGET)
+                else: # recv.state == RecvState.ALL:
+                    self.request = HTTPRequestMessage(r.request_line_encapsulated, r.headers_encapsulated, r.body, r.body_file, r.body_consumer)
+                    if self.response is None:
+                        self.refresh_response()
+                    r.prepare()
+                    self.server.dispatch_request(self) # handled here, or in a worker with this connection paused
+            else:
+                break # latest target not finished, break the loop and wait for next peek_data
     
     """ Override """
     def setup(self):
@@ -228,5 +590,6 @@ class HTTPConnectionHandler(BaseConnectionHandlerClass):
     
     """ Override """
     def finish(self):
+        self.recv_buffer_manager.release_body() # e.g. the client is gone while uploading
         log_print(f'Connection from <{self.address[0]}:{self.address[1]}>: finish()', LogLevel.INFO)
 
@@ -1,4 +1,4 @@
-from . import TCPSocketServer, HTTPConnectionHandler
+from . import TCPSocketServer, AsyncTCPSocketServer, HTTPConnectionHandler
 from ..message import HTTPUrl
 from ..exception import HTTPStatusException
 
@@ -58,10 +58,39 @@ class HTTPServer(TCPSocketServer):
     http_version = 'HTTP/1.1'
     supported_methods = ['GET', 'HEAD', 'POST']
     
-    def __init__(self, hostname, port, ConnectionHandlerClass = HTTPConnectionHandler):
-        super().__init__(hostname, port, ConnectionHandlerClass)
+    def __init__(self, hostname, port, ConnectionHandlerClass = HTTPConnectionHandler, **kwargs):
+        super().__init__(hostname, port, ConnectionHandlerClass, **kwargs)
         self.http_route_tree = RouteTree()
+        self.http_body_consumer_tree = RouteTree()
         self.http_error_handlers = {}
+        self.recv_stats = {'requests': 0, 'reads': 0, 'bytes': 0}           # request heads received, recv calls (or chunks fed) and bytes, see reads_per_request()
+    
+    def reset_after_fork(self):
+        super().reset_after_fork()
+        self.recv_stats = {'requests': 0, 'reads': 0, 'bytes': 0}
+    
+    def reads_per_request(self):
+        return self.recv_stats['reads'] / self.recv_stats['requests'] if self.recv_stats['requests'] else 0.0
+    
+    """
+        HTTP Request Dispatcher
+            connection_handler <- HTTPConnectionHandler, with a parsed `request`
+            inline in the selector thread by default, or by the worker pool (503 if its queue is full)
+    """
+    def dispatch_request(self, connection_handler):
+        if not self.worker_pool:
+            connection_handler.request_handler()
+        elif not self.run_in_worker(connection_handler, connection_handler.request_handler):
+            connection_handler.reject_request(503)
+    
+    """ Override """
+    def reject_connection(self, connection):
+        # beyond `max_connections`: a best-effort 503 before closing, the request is never read
+        try:
+            connection.send(f'{self.http_version} 503 {HTTPStatusException.default_status_description[503]}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'.encode())
+        except OSError:
+            pass
+        connection.close()
     
     """
         HTTP Error Handler
@@ -82,6 +111,7 @@ class HTTPServer(TCPSocketServer):
     """
         HTTP Route Handler
             connection_handler <- HTTPConnectionHandler
+            returns what the handler returns, i.e. an awaitable for coroutine handlers (awaited by the connection handler)
     """
     def http_route_handler(self, connection_handler):
         request = connection_handler.request
@@ -101,7 +131,23 @@ class HTTPServer(TCPSocketServer):
         args_grp['parameters'] = get_params
         args_grp['connection_handler'] = connection_handler
         
-        func(**args_grp)
+        return func(**args_grp)
+    
+    """
+        HTTP Body Consumer
+            request_line <- HTTPRequestLine, headers <- HTTPHeaders, of a request whose body has not been received yet
+            connection_handler <- HTTPConnectionHandler
+            returns a writable file object receiving the body as it arrives (instead of buffering it), or None
+    """
+    def http_body_consumer(self, request_line, headers, connection_handler):
+        if not request_line.method in self.supported_methods:
+            return None
+        
+        url = HTTPUrl.from_parsing(request_line.path)
+        func, arg_list = self.http_body_consumer_tree.search(url.path_list, request_line.method)
+        if not func:
+            return None
+        return func(path = arg_list, parameters = url.params, headers = headers, connection_handler = connection_handler)
     
     """
         Decorator for registering handler for specific path and method
@@ -109,6 +155,8 @@ class HTTPServer(TCPSocketServer):
             parameters <- dict of GET parameters
             connection_handler <- connection handler object
         
+        The handler may be a coroutine function (`async def`), e.g. to offload blocking work by `await asyncio.to_thread(...)`.
+        
         Also you can manually register handler like this:
             server.route(path, methods)(func)
     """
@@ -128,6 +176,24 @@ class HTTPServer(TCPSocketServer):
             return func
         return wrapper
 
+    """
+        Decorator for registering body consumer for specific path and method
+            path, parameters, connection_handler <- the same as route()
+            headers <- HTTPHeaders of the request
+        
+        The consumer (e.g. a MultipartFormDataParser) is written with the body while it is being received,
+        then the route handler finds it as `request.body_consumer` (with an empty `request.body`) and closes it with the request.
+        Return None to receive the body as usual, e.g. when the request is not acceptable and the route handler will refuse it.
+    """
+    def body_consumer(self, path, methods = ['POST']):
+        if type(methods) == str:
+            methods = [methods]
+        
+        def wrapper(func):
+            self.http_body_consumer_tree.extend(HTTPUrl.from_parsing(path).path_list, func, methods, [0] * len(methods))
+            return func
+        return wrapper
+    
     """
         Decorator for registering handler for error codes
     """
@@ -137,3 +203,10 @@ class HTTPServer(TCPSocketServer):
             return func
         return wrapper
 
+
+"""
+    AsyncHTTPServer
+        HTTPServer served by the asyncio engine, with the same route() / errorhandler() API
+"""
+class AsyncHTTPServer(HTTPServer, AsyncTCPSocketServer):
+    pass
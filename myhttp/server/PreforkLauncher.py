@@ -0,0 +1,115 @@
+import signal
+import socket
+import time
+import os
+
+from ..log import log_print, LogLevel
+
+
+"""
+    PreforkLauncher
+        forks `worker_num` processes, each running `server.launch()` with its own selector loop.
+        Each worker binds the port itself with SO_REUSEPORT when the platform has it (the kernel balances accepts),
+        otherwise (or when the welcome socket is handed over by a previous supervisor) the supervisor binds once
+        and the workers share the inherited welcome socket.
+        The supervisor restarts crashed workers and forwards shutdown (SIGTERM, i.e. graceful shutdown) to them.
+    Usage:
+        PreforkLauncher(server, 4).launch()     # blocks, call shutdown() (e.g. on KeyboardInterrupt) to stop
+        launcher.hot_restart()                  # e.g. on SIGHUP, a new supervisor takes over the port
+"""
+class PreforkLauncher:
+    restart_delay = 1.0                                                     # seconds to wait before restarting a crashed worker
+    shutdown_timeout = 15.0                                                 # seconds to wait for (draining) workers before SIGKILL
+    
+    def __init__(self, server, worker_num):
+        if not hasattr(os, 'fork'):
+            raise RuntimeError('Pre-fork mode requires os.fork()')
+        self.server = server
+        self.worker_num = worker_num
+        self.workers = {}                                                   # pid -> worker index
+        self.shutdown_signal = False
+    
+    def launch(self):
+        if hasattr(socket, 'SO_REUSEPORT') and self.server.listen_fd_env not in os.environ:
+            self.server.reuse_port = True
+        else:
+            self.server.create_welcome_socket()                             # inherited by all workers
+        
+        for idx in range(self.worker_num):
+            self.spawn(idx)
+        log_print(f'Supervisor <{os.getpid()}> launched {self.worker_num} workers', LogLevel.INFO)
+        
+        # supervise
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break # reaped by shutdown() in a signal handler
+            idx = self.workers.pop(pid, None)
+            if idx is None or self.shutdown_signal:
+                continue
+            log_print(f'Worker <{pid}> exited with status {status}, restarting', LogLevel.WARNING)
+            time.sleep(self.restart_delay)
+            self.spawn(idx)
+    
+    def shutdown(self):
+        self.request_graceful_shutdown()
+        
+        deadline = time.time() + self.shutdown_timeout
+        while self.workers and time.time() < deadline:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.05)
+            else:
+                self.workers.pop(pid, None)
+        for pid in self.workers:
+            self.kill(pid, signal.SIGKILL)
+        self.workers = {}
+        
+        if self.server.welcome_socket:
+            self.server.welcome_socket.close()
+            self.server.welcome_socket = None
+    
+    def request_graceful_shutdown(self):
+        # non-blocking, also safe in signal handlers; launch() returns once all workers are drained
+        self.shutdown_signal = True
+        for pid in self.workers:
+            self.kill(pid, signal.SIGTERM)
+    
+    def hot_restart(self, argv = None):
+        # hand the port over to a new supervisor (running `argv`, this command line by default), then drain the workers
+        if self.server.welcome_socket is None:
+            self.server.create_welcome_socket()                             # joins the workers' SO_REUSEPORT group, its backlog waits for the successor
+        self.server.spawn_successor(argv)
+        self.request_graceful_shutdown()
+    
+    def spawn(self, idx):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = idx
+            return
+        
+        # worker process
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)                    # Ctrl+C is handled by the supervisor
+            signal.signal(signal.SIGTERM, self.worker_sigterm_handler)
+            if hasattr(signal, 'SIGHUP'):
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)                # hot restart is done by the supervisor
+            self.server.reset_after_fork()
+            self.server.launch()
+        except BaseException:
+            exit_code = 1
+            log_print(f'Worker <{os.getpid()}> crashed', LogLevel.ERROR)
+        finally:
+            os._exit(exit_code)                                             # never return into the supervisor's code
+    
+    def worker_sigterm_handler(self, signum, frame):
+        self.server.request_graceful_shutdown()                             # the serving loop notices it and returns from launch() once drained
+    
+    @staticmethod
+    def kill(pid, sig):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            pass
@@ -1,15 +1,53 @@
 import socket
+import errno
 import threading
 import selectors
+import subprocess
+import asyncio
+import queue
+import sys
+import os
 
+from collections import deque
+from itertools import islice, takewhile
+
+from .WorkerPool import WorkerPool
+from .TimerWheel import TimerWheel
 from ..log import log_print, LogLevel, do_raise
 
 
 class BaseConnectionHandlerClass:
+    send_high_water = 1024 * 1024                                           # pending bytes above which send() in a worker waits for the socket to drain ...
+    send_low_water = 256 * 1024                                             # ... down to this
+    send_timeout = 60                                                       # seconds, give up a client that does not read at all
+    send_iov_max = 1024                                                     # buffers per sendmsg() call (IOV_MAX)
+    send_file_block = 262144                                                # bytes read per call from a file region where os.sendfile() cannot be used
+    
+    __slots__ = (
+        'connection', 'address', 'server', 'is_paused', 'is_closed',
+        'send_queue', 'send_pending', 'send_file_pending', 'cork_depth', 'selector_events',
+        'recv_bytes', 'sent_bytes', 'timer', 'timer_kind', 'timer_mark'
+    )                                                                       # one instance per connection, subclasses may declare their own
+    
     def __init__(self, connection, server):
         self.connection = connection
         self.address = connection.getpeername()
         self.server = server
+        
+        self.is_paused = False                                              # unregistered from selector while a worker is serving it
+        self.is_closed = False                                              # no more requests; the socket is closed once the send queue is flushed
+        
+        self.send_queue = None                                              # memoryviews (and file regions, body producers) waiting for the (non-blocking) socket, a deque allocated only while there are some
+        self.send_pending = 0                                               # bytes in send_queue
+        self.send_file_pending = 0                                          # ... of which in file regions and body producers, i.e. not in memory
+        self.cork_depth = 0                                                 # > 0: send() only queues, flushed all at once by the last uncork()
+        self.selector_events = selectors.EVENT_READ                         # events currently registered in the selector
+        
+        self.recv_bytes = 0                                                 # totals, for progress checks of timers
+        self.sent_bytes = 0
+        self.timer = None                                                   # at most one timer per connection, see update_timer()
+        self.timer_kind = None
+        self.timer_mark = (0, 0)                                            # (recv_bytes, sent_bytes) when the timer was set
     
     """ Override """
     def setup(self):
@@ -21,59 +59,373 @@ class BaseConnectionHandlerClass:
         # to be overridden
         pass
     
+    """ Override """
+    def feed(self, data):
+        # to be overridden, called with received data (b'' for EOF) by engines that do the receiving themselves
+        pass
+    
+    """ Override """
+    def resume(self):
+        # to be overridden, called in the selector thread after the connection is re-armed
+        pass
+    
     """ Override """
     def finish(self):
         # to be overridden
         pass
     
     """ Override """
-    def send(self, data):
-        log_print(f'Data to <{self.address[0]}:{self.address[1]}>: {data}', 'RAW_DATA')
-        self.connection.send(data)
+    def on_server_draining(self):
+        # to be overridden, called once when the server starts a graceful shutdown; by default close once pending data are sent
+        self.shutdown()
     
-    def shutdown(self):
-        self.finish()                                                       # lifecycle: finish()
-        self.server.selector.unregister(self.connection)                    # unregister
-        self.connection.shutdown(socket.SHUT_WR)
+    """ Override """
+    def send(self, *data):
+        # data: fragments of one message (e.g. header, body), queued without being joined and written by one sendmsg(), each of them is
+        #   bytes-like, or a file region (e.g. HTTPFileBody: fileno(), `offset`, `length`, close()) written by os.sendfile() and closed once sent,
+        #   or a body producer (e.g. HTTPBodyProducer: pull(), len(), close()) pulled only when the socket can take more
+        producing = self.send_pending - self.send_file_pending > self.send_high_water # already over the mark before this piece, i.e. a producer keeps on sending
+        for fragment in data:
+            is_region = not isinstance(fragment, (bytes, bytearray, memoryview))
+            if not len(fragment):
+                if is_region:
+                    fragment.close()                                        # nothing to send
+                continue
+            if self.send_queue is None:
+                self.send_queue = deque()
+            if is_region:
+                self.send_queue.append(fragment)
+                self.send_file_pending += len(fragment)
+            else:
+                self.send_queue.append(memoryview(fragment))
+            self.send_pending += len(fragment)
+        log_print(f'Data to <{self.address[0]}:{self.address[1]}>: {self.send_pending} bytes pending', 'RAW_DATA')
+        if not self.send_pending:
+            return
+        if self.cork_depth and not self.is_paused and self.send_pending - self.send_file_pending <= self.send_high_water:
+            return # coalesced until uncork(); a worker (the connection is paused) writes immediately
+        self.flush()
+        
+        if producing and self.send_pending - self.send_file_pending > self.send_high_water and self.server.worker_pool and self.server.worker_pool.is_worker():
+            self.drain(self.send_low_water)                                 # pause the producer (the caller) until the socket drains
+        # the serving thread is never blocked, the selector flushes the rest; large bodies are better handed over as body producers, pulled in on_writable()
+        if self.send_pending and not self.is_paused:
+            self.server.update_connection_events(self)                      # let the selector flush the rest
+    
+    def cork(self):
+        # hold the following send()s (e.g. responses to pipelined requests) to write them together, nestable
+        self.cork_depth += 1
+    
+    def uncork(self):
+        self.cork_depth -= 1
+        if self.cork_depth == 0 and self.send_pending and not self.is_paused and self.connection is not None:
+            if self.flush() and self.is_closed:
+                self.close_socket()                                         # shut down while corked
+            elif self.send_pending:
+                self.server.update_connection_events(self)                  # let the selector flush the rest
+    
+    def set_tcp_cork(self, on):
+        # TCP_CORK (Linux): the kernel holds partial segments until uncorked (or 200 ms), for a series of small writes
+        if hasattr(socket, 'TCP_CORK') and isinstance(self.connection, socket.socket):
+            try:
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if on else 0)
+            except OSError:
+                pass
+    
+    def flush(self):
+        # send as much as the socket takes now (gathered by sendmsg() where available), return True if the queue is empty
+        send_queue = self.send_queue
+        while send_queue:
+            if self.send_file_pending and not isinstance(send_queue[0], memoryview):
+                if hasattr(send_queue[0], 'pull'):
+                    if not self.flush_producer(send_queue[0]):
+                        break # the connection cannot take more now
+                    continue
+                if not self.flush_file(send_queue[0]):
+                    break # socket buffer is full
+                send_queue.popleft().close()
+                continue
+            try:
+                if hasattr(self.connection, 'sendmsg'):
+                    if self.send_file_pending:
+                        buffers = list(islice(takewhile(lambda buffer: isinstance(buffer, memoryview), send_queue), self.send_iov_max)) # up to the next file region
+                    else:
+                        buffers = send_queue if len(send_queue) <= self.send_iov_max else list(islice(send_queue, self.send_iov_max))
+                    sent = self.connection.sendmsg(buffers)
+                else:
+                    sent = self.connection.send(send_queue[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            self.send_pending -= sent
+            self.sent_bytes += sent
+            partial = False
+            while sent:
+                chunk = send_queue[0]
+                if sent < len(chunk):
+                    send_queue[0] = chunk[sent:]
+                    partial = True
+                    break
+                sent -= len(chunk)
+                send_queue.popleft()
+            if partial:
+                break # socket buffer is full
+        if send_queue:
+            return False
+        self.send_queue = None                                              # released while idle
+        return True
+    
+    def flush_file(self, region):
+        # send a file region, by os.sendfile() into a socket, otherwise by blocks read into memory; return True if all of it is sent
+        zero_copy = hasattr(os, 'sendfile') and isinstance(self.connection, socket.socket)
+        while region.length:
+            size = region.length if zero_copy else min(region.length, self.send_file_block)
+            try:
+                if zero_copy:
+                    try:
+                        sent = os.sendfile(self.connection.fileno(), region.fileno(), region.offset, size)
+                    except OSError as e:
+                        if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                            raise
+                        zero_copy = False                                   # not supported for this file, e.g. on some file systems
+                        continue
+                else:
+                    if hasattr(self.connection, 'is_writable') and not self.connection.is_writable():
+                        return False # e.g. the transport of asyncio is full, it calls on_writable() later
+                    sent = self.connection.send(os.pread(region.fileno(), size, region.offset))
+            except (BlockingIOError, InterruptedError):
+                return False
+            if sent == 0:
+                raise ConnectionAbortedError('File Truncated')              # the promised length cannot be sent any more
+            region.offset += sent
+            region.length -= sent
+            self.send_pending -= sent
+            self.send_file_pending -= sent
+            self.sent_bytes += sent
+            if sent < size:
+                return False # socket buffer is full
+        return True
+    
+    def flush_producer(self, producer):
+        # pull the next fragments of a body producer (at the head of the queue) in front of it, to be sent by flush(); False if not writable now
+        if hasattr(self.connection, 'is_writable') and not self.connection.is_writable():
+            return False # e.g. the transport of asyncio is full, it calls on_writable() later
+        remaining = len(producer)
+        try:
+            fragments = producer.pull()
+        except ConnectionError:
+            raise
+        except Exception as e:
+            if do_raise:
+                raise
+            log_print(f'Body producer failed: {e!r}', LogLevel.ERROR)
+            raise ConnectionAbortedError('Body Producer Failed')            # the head has been sent, the response can only be cut off
+        produced = remaining - len(producer)
+        self.send_pending -= produced
+        self.send_file_pending -= produced
+        if not len(producer):
+            self.send_queue.popleft().close()
+        for fragment in reversed(fragments):
+            if len(fragment):
+                self.send_queue.appendleft(memoryview(fragment))
+                self.send_pending += len(fragment)
+        return True
+    
+    def drain(self, low_water = 0):
+        # block the current thread (a worker, the connection is not in the selector) until at most `low_water` bytes are pending;
+        # poll() is not bounded by FD_SETSIZE like select(), which fails for descriptors >= 1024
+        Selector = selectors.PollSelector if hasattr(selectors, 'PollSelector') else selectors.SelectSelector
+        with Selector() as selector:
+            selector.register(self.connection, selectors.EVENT_WRITE)
+            while self.send_pending - self.send_file_pending > low_water:
+                if not selector.select(self.send_timeout):
+                    raise ConnectionAbortedError('Send Timeout')
+                self.flush()
+    
+    """ Override """
+    def on_writable(self):
+        # called by the selector when EVENT_WRITE is triggered
+        if self.flush() and self.is_closed:
+            self.close_socket()
+        else:
+            self.server.update_connection_events(self)
+            self.update_timer()
+    
+    """
+        Timers
+            timer_state() tells which timer the connection needs now, as (kind, seconds) or None;
+            update_timer() (in the serving thread) keeps a running timer of the same kind, otherwise replaces it.
+    """
+    
+    def update_timer(self):
+        state = None if (self.is_paused or self.connection is None) else self.timer_state()
+        kind = state[0] if state else None
+        if kind == self.timer_kind:
+            return
+        if self.timer:
+            self.timer.cancel()
+        self.timer, self.timer_kind = None, kind
+        if state:
+            self.timer_mark = (self.recv_bytes, self.sent_bytes)
+            self.timer = self.server.call_later(state[1], self.timer_expired)
+    
+    def timer_expired(self):
+        kind = self.timer_kind
+        self.timer, self.timer_kind = None, None
+        if self.is_paused or self.connection is None:
+            return
+        try:
+            self.on_timeout(kind)
+        except ConnectionError:
+            self.shutdown(force = True)
+        self.update_timer()                                                 # re-arm if still needed
+    
+    """ Override """
+    def timer_state(self):
+        if self.send_pending:
+            return ('send', self.send_timeout)
+        return None
+    
+    """ Override """
+    def on_timeout(self, kind):
+        if kind == 'send' and self.sent_bytes == self.timer_mark[1]:
+            self.shutdown(force = True)                                     # nothing could be sent for `send_timeout`
+    
+    def shutdown(self, force = False):
+        # pending responses are still flushed by the selector unless `force`
+        if not self.is_closed:
+            self.is_closed = True
+            self.finish()                                                   # lifecycle: finish()
+        if force or not self.send_pending:
+            self.close_socket()
+        elif not self.is_paused:
+            self.server.update_connection_events(self)                      # keep EVENT_WRITE only
+            self.update_timer()
+    
+    def close_socket(self):
+        if self.connection is None:
+            return
+        self.server.detach_connection(self)                                 # unregister
+        try:
+            self.connection.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass # e.g. reset by peer
         self.connection.close()
+        self.connection = None
+        if self.send_file_pending:
+            for fragment in self.send_queue:
+                if not isinstance(fragment, memoryview):
+                    fragment.close()                                        # file regions and producers not sent
+        self.send_queue = None
+        self.send_pending = 0
+        self.send_file_pending = 0
+        self.update_timer()                                                 # cancel
         # TODO: 备注，这么写的话, 在关闭服务器后其它 client recv(x) 会一直收到 b'', 不会有异常
 
 
 class TCPSocketServer:
-    backlog_size = 10
-    select_timeout = 0.01
+    backlog_size = 128                                                      # listen() backlog, capped by the kernel (net.core.somaxconn)
+    accept_budget = 64                                                      # max connections accepted per readiness event, so that established ones are not starved
+    accept_retry_delay = 0.5                                                # seconds to stop accepting when running out of file descriptors
+    drain_timeout = 10                                                      # seconds for open connections to finish in a graceful shutdown
+    listen_fd_env = 'MYHTTP_LISTEN_FD'                                      # environment variable handing over the welcome socket, see hot_restart()
     
-    def __init__(self, hostname, port, ConnectionHandlerClass = BaseConnectionHandlerClass):
+    def __init__(self, hostname, port, ConnectionHandlerClass = BaseConnectionHandlerClass, worker_threads = 0, worker_queue_size = 64, reuse_port = False, backlog_size = None, max_connections = 0, accept_queue_size = 0):
         self.hostname = hostname
         self.port = port
         self.ConnectionHandlerClass = ConnectionHandlerClass
+        if backlog_size:
+            self.backlog_size = backlog_size
+        
+        self.max_connections = max_connections                              # open connections served at most, <= 0 means unlimited
+        self.accept_queue_size = accept_queue_size                          # accepted connections waiting for a free slot beyond `max_connections`, the others are rejected
+        self.pending_connections = deque()                                  # accepted but not launched yet, see admit_connection()
+        self.is_accepting = False                                           # whether the welcome socket is in the selector
+        self.accept_stats = {'accepted': 0, 'queued': 0, 'rejected': 0}
         
-        self.welcome_socket = None
+        self.welcome_socket = None                                          # created in launch(), unless inherited (e.g. from a pre-fork supervisor)
+        self.reuse_port = reuse_port                                        # SO_REUSEPORT, for several processes listening on the same port
         self.selector = selectors.DefaultSelector()                         # IO multiplexing for sockets
         self.connection_handlers_map = {}                                   # connection socket -> connection handler
         
+        self.worker_pool = WorkerPool(worker_threads, worker_queue_size) if worker_threads > 0 else None # None -> handle requests in the selector thread
+        self.loop_callbacks = queue.SimpleQueue()                           # callbacks from workers, run in the selector thread
+        self.timer_wheel = TimerWheel()                                     # connection timeouts, driven by the selector loop
+        self.wakeup_receiver, self.wakeup_sender = None, None               # self-pipe, wakes up the selector from other threads or signal handlers
+        self.selector_thread_id = None
+        self.side_loop = None                                               # event loop of coroutine route handlers, see get_side_loop()
+        self.side_loop_lock = threading.Lock()
+        
         self.shutdown_signal = False
+        self.drain_signal = False                                           # graceful shutdown requested
+        self.is_draining = False                                            # graceful shutdown in progress, see start_draining()
         self.is_shutdown = threading.Event()
     
     def get_sockets_in_selector(self):
         return [key.fileobj for key in self.selector.get_map().values()]
     
-    def launch(self):
-        try:
-            # create welcome socket
+    def create_welcome_socket(self):
+        inherited_fd = os.environ.pop(self.listen_fd_env, None)
+        if inherited_fd is not None:
+            self.welcome_socket = socket.socket(fileno = int(inherited_fd))  # already listening, handed over by the previous server process
+            log_print(f'Inherited the welcome socket (fd {inherited_fd})', LogLevel.INFO)
+        else:
             self.welcome_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.welcome_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.welcome_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.welcome_socket.bind((self.hostname, self.port))
             self.welcome_socket.listen(self.backlog_size)
+        self.welcome_socket.setblocking(False)                              # accept() until EAGAIN; also, other processes sharing it may take a connection first
+    
+    def reset_after_fork(self):
+        # the selector (e.g. epoll) and the connections must not be shared with the parent process
+        self.selector = selectors.DefaultSelector()
+        self.connection_handlers_map = {}
+        self.pending_connections = deque()
+        self.is_accepting = False
+        self.accept_stats = {'accepted': 0, 'queued': 0, 'rejected': 0}
+        self.loop_callbacks = queue.SimpleQueue()
+        self.timer_wheel = TimerWheel()
+        self.wakeup_receiver, self.wakeup_sender = None, None
+        self.side_loop = None                                               # its thread is not forked
+        self.side_loop_lock = threading.Lock()
+        self.shutdown_signal = False
+        self.drain_signal = False
+        self.is_draining = False
+        self.is_shutdown = threading.Event()
+    
+    def launch(self):
+        self.selector_thread_id = threading.get_ident()
+        try:
+            # create welcome socket
+            if self.welcome_socket is None:
+                self.create_welcome_socket()
+            self.welcome_socket.setblocking(False)                          # an inherited one may be blocking
             
             # register welcome socket
-            self.selector.register(self.welcome_socket, selectors.EVENT_READ)
+            self.resume_accepting()
+            
+            # register wakeup socket
+            self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+            self.wakeup_receiver.setblocking(False)
+            self.wakeup_sender.setblocking(False)
+            self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
             log_print(f'Server is listening on {self.hostname}:{self.port}', 'INFO')
             
+            # launch workers
+            if self.worker_pool:
+                self.worker_pool.launch()
+                log_print(f'Requests are handled by {self.worker_pool.worker_num} worker threads', 'INFO')
+            
             # serve
             while not self.shutdown_signal:
                 try:
-                    events = self.selector.select(self.select_timeout) # timeout for shutdown_signal detection
+                    if self.drain_signal and not self.is_draining:
+                        self.start_draining()
+                    if self.is_draining and not (self.connection_handlers_map or self.pending_connections):
+                        break # all connections are finished
+                    
+                    events = self.selector.select(self.timer_wheel.next_timeout()) # block until IO, wakeup or the next timer
                     
                     for key, mask in events:
                         connection: socket.socket = key.fileobj
@@ -81,39 +433,326 @@ class TCPSocketServer:
                         # TODO: 需要确认除了来新数据、连接 reset，还有什么情况会触发 welcome socket / connection socket 的变动吗？
                         if connection == self.welcome_socket:
                             # welcome socket is triggered
-                            new_connection_handler = self.launch_connection()
-                            self.connection_handlers_map[new_connection_handler.connection] = new_connection_handler
+                            self.accept_connections()
+                        elif connection == self.wakeup_receiver:
+                            # wakeup socket is triggered, just drain it
+                            self.drain_wakeup()
                         else:
                             # connection socket is triggered
                             try:
-                                self.handle_connection(connection)
+                                if mask & selectors.EVENT_WRITE:
+                                    self.flush_connection(connection)
+                                if mask & selectors.EVENT_READ:
+                                    self.handle_connection(connection)
                             except ConnectionError: # containing ConnectionResetError, ConnectionAbortedError, etc.
                                 self.shutdown_connection(connection)
+                    
+                    self.timer_wheel.advance()
+                    self.run_loop_callbacks()
+                    if self.pending_connections:
+                        self.admit_pending_connections()                    # slots may be freed in this round
                 except Exception:
                     if do_raise:
                         raise
                     log_print('unknown error', LogLevel.ERROR)
         finally:
+            if self.worker_pool:
+                self.worker_pool.shutdown()
+            self.stop_side_loop()
             self.shutdown_signal = False
+            self.drain_signal = False
+            self.is_draining = False
             self.is_shutdown.set()
-            self.welcome_socket.close()
+            while self.pending_connections:
+                self.pending_connections.popleft().close()
+            if self.welcome_socket:
+                self.pause_accepting()
+                self.welcome_socket.close()
+                self.welcome_socket = None
+            if self.wakeup_receiver:
+                self.selector.unregister(self.wakeup_receiver)
+                self.wakeup_receiver.close()
+                self.wakeup_sender.close()
+                self.wakeup_receiver, self.wakeup_sender = None, None
     
     def shutdown(self):
+        self.request_shutdown()
+        self.is_shutdown.wait()
+    
+    def request_shutdown(self):
+        # non-blocking, also safe in signal handlers
         self.shutdown_signal = True
+        self.wakeup()
+    
+    """
+        Graceful Shutdown & Hot Restart
+            stop accepting, let open connections finish what they are doing (see on_server_draining()),
+            and shut down when all of them are closed or `drain_timeout` is reached.
+            hot_restart() first starts a successor process listening on the same welcome socket,
+            so new connections wait in the shared backlog instead of being refused.
+    """
+    
+    def graceful_shutdown(self):
+        self.request_graceful_shutdown()
         self.is_shutdown.wait()
     
-    def launch_connection(self):
-        connection, address = self.welcome_socket.accept()                  # accept new connection socket
+    def request_graceful_shutdown(self):
+        # non-blocking, also safe in signal handlers
+        self.drain_signal = True
+        self.wakeup()
+    
+    def start_draining(self):
+        # (serving thread)
+        self.is_draining = True
+        self.stop_accepting()
+        for connection_handler in list(self.connection_handlers_map.values()):
+            connection_handler.on_server_draining()
+        self.call_later(self.drain_timeout, self.request_shutdown)           # force the rest
+        log_print(f'Draining {len(self.connection_handlers_map)} connections', LogLevel.INFO)
+    
+    """ Override """
+    def stop_accepting(self):
+        if self.welcome_socket:
+            self.accept_connections()                                       # those already in the backlog are served as well
+            self.pause_accepting()
+            self.welcome_socket.close()                                     # a successor may still hold it
+            self.welcome_socket = None
+    
+    def hot_restart(self, argv = None):
+        # e.g. on SIGHUP; the successor runs `argv` (this command line by default)
+        if self.welcome_socket is None:
+            log_print('No welcome socket to hand over, hot restart ignored', LogLevel.WARNING)
+            return
+        self.spawn_successor(argv)
+        self.request_graceful_shutdown()
+    
+    def spawn_successor(self, argv = None):
+        fd = self.welcome_socket.fileno()
+        env = dict(os.environ)
+        env[self.listen_fd_env] = str(fd)
+        
+        # forked twice, so that the successor is not a child of this process (it outlives us, and pre-fork supervisors do not wait for it)
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                subprocess.Popen([sys.executable] + (argv if argv else sys.argv), env = env, pass_fds = (fd,))
+            except BaseException:
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        _, status = os.waitpid(pid, 0)
+        if status:
+            log_print('Failed to spawn the successor process', LogLevel.ERROR)
+        else:
+            log_print(f'Spawned the successor process on the welcome socket (fd {fd})', LogLevel.INFO)
+    
+    """ Override """
+    def wakeup(self):
+        # thread-safe and signal-safe
+        sender = self.wakeup_sender
+        if sender:
+            try:
+                sender.send(b'\0')
+            except OSError:
+                pass # buffer full (a wakeup is pending anyway) or already closed
+    
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+    
+    def call_later(self, delay, callback, *args):
+        # (selector thread) return a timer with cancel()
+        return self.timer_wheel.schedule(delay, callback, *args)
+    
+    """
+        Accepting & Admission Control
+            accepted connections are launched while there are less than `max_connections` open ones,
+            then kept in `pending_connections` (up to `accept_queue_size`) until some slot is freed,
+            then rejected by reject_connection().
+    """
+    
+    def accept_connections(self):
+        # (selector thread) accept a batch of connections, until EAGAIN or `accept_budget` is used up
+        for _ in range(self.accept_budget):
+            try:
+                connection, address = self.welcome_socket.accept()          # accept new connection socket
+            except (BlockingIOError, InterruptedError):
+                break # no more, or taken by another process sharing the welcome socket
+            except ConnectionAbortedError:
+                continue # reset by the client before being accepted
+            except OSError as e:
+                if e.errno not in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    raise
+                log_print(f'Failed to accept connections ({e.strerror}), retry in {self.accept_retry_delay}s', LogLevel.WARNING)
+                self.pause_accepting()                                      # otherwise the welcome socket keeps being ready
+                self.call_later(self.accept_retry_delay, self.resume_accepting)
+                break
+            connection.setblocking(False)                                   # sending is queued, see BaseConnectionHandlerClass.send()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # writes are coalesced by the connection handlers instead of Nagle's algorithm
+            self.admit_connection(connection)
+    
+    def admit_connection(self, connection):
+        if self.max_connections <= 0 or self.connection_num() < self.max_connections:
+            self.launch_connection(connection)
+        elif len(self.pending_connections) < self.accept_queue_size:
+            self.pending_connections.append(connection)
+            self.accept_stats['queued'] += 1
+        else:
+            self.accept_stats['rejected'] += 1
+            self.reject_connection(connection)
+    
+    def admit_pending_connections(self):
+        while self.pending_connections and self.connection_num() < self.max_connections:
+            self.launch_connection(self.pending_connections.popleft())
+    
+    """ Override """
+    def connection_num(self):
+        return len(self.connection_handlers_map)
+    
+    """ Override """
+    def reject_connection(self, connection):
+        connection.close()
+    
+    def pause_accepting(self):
+        if self.is_accepting:
+            self.selector.unregister(self.welcome_socket)
+            self.is_accepting = False
+    
+    def resume_accepting(self):
+        if not self.is_accepting and self.welcome_socket and not self.shutdown_signal:
+            self.selector.register(self.welcome_socket, selectors.EVENT_READ)
+            self.is_accepting = True
+    
+    def launch_connection(self, connection):
         self.selector.register(connection, selectors.EVENT_READ)            # register
         connection_handler = self.ConnectionHandlerClass(connection, self)  # encapsulate
+        self.connection_handlers_map[connection] = connection_handler
+        self.accept_stats['accepted'] += 1
         connection_handler.setup()                                          # lifecycle: setup()
+        connection_handler.update_timer()
         return connection_handler
     
     def handle_connection(self, connection):
         connection_handler = self.connection_handlers_map.get(connection)   # get connection handler
-        connection_handler.handle()                                         # lifecycle: handle()
+        if connection_handler and not connection_handler.is_closed:
+            connection_handler.handle()                                     # lifecycle: handle()
+    
+    def flush_connection(self, connection):
+        connection_handler = self.connection_handlers_map.get(connection)   # get connection handler
+        if connection_handler:
+            connection_handler.on_writable()
 
     def shutdown_connection(self, connection):
-        connection_handler = self.connection_handlers_map.pop(connection)   # get and pop connection handler
-        connection_handler.shutdown()                                       # shutdown connection handler
+        connection_handler = self.connection_handlers_map.get(connection)   # get connection handler
+        if connection_handler:
+            connection_handler.shutdown(force = True)                       # shutdown connection handler, popped in detach_connection()
 
+    def detach_connection(self, connection_handler):
+        # may be called from a worker, but then the connection is paused and not in the selector
+        if not connection_handler.is_paused:
+            self.selector.unregister(connection_handler.connection)
+        self.connection_handlers_map.pop(connection_handler.connection, None)
+    
+    def update_connection_events(self, connection_handler):
+        # (selector thread) EVENT_READ until closed, EVENT_WRITE only while there are pending data to send
+        events = 0 if connection_handler.is_closed else selectors.EVENT_READ
+        if connection_handler.send_pending:
+            events |= selectors.EVENT_WRITE
+        if events != connection_handler.selector_events and events:
+            self.selector.modify(connection_handler.connection, events)
+            connection_handler.selector_events = events
+    
+    """
+        Worker Dispatching
+            the connection is unregistered from the selector while its task is running in a worker,
+            so requests of one connection are served one by one in order.
+    """
+    
+    def call_in_loop(self, callback, *args):
+        # thread-safe, `callback` will be run in the selector thread
+        self.loop_callbacks.put((callback, args))
+        self.wakeup()
+    
+    def run_loop_callbacks(self):
+        while True:
+            try:
+                callback, args = self.loop_callbacks.get_nowait()
+            except queue.Empty:
+                break
+            callback(*args)
+    
+    def run_in_worker(self, connection_handler, func):
+        # return False if the task queue is full, then nothing is changed
+        self.pause_connection(connection_handler)
+        
+        def task():
+            try:
+                func()
+            except ConnectionError:
+                self.call_in_loop(connection_handler.shutdown, True)
+            finally:
+                self.call_in_loop(self.resume_connection, connection_handler)
+        
+        if not self.worker_pool.submit(task):
+            self.resume_connection(connection_handler, rehandle = False)
+            return False
+        return True
+    
+    def pause_connection(self, connection_handler):
+        self.selector.unregister(connection_handler.connection)
+        connection_handler.is_paused = True
+    
+    def resume_connection(self, connection_handler, rehandle = True):
+        if connection_handler.connection is None:
+            return # closed by the worker
+        connection_handler.selector_events = (0 if connection_handler.is_closed else selectors.EVENT_READ) | (selectors.EVENT_WRITE if connection_handler.send_pending else 0)
+        self.selector.register(connection_handler.connection, connection_handler.selector_events)
+        connection_handler.is_paused = False
+        if rehandle and not connection_handler.is_closed:
+            try:
+                connection_handler.resume()                                 # data of pipelined requests may be buffered already
+            except ConnectionError:
+                connection_handler.shutdown(force = True)
+    
+    def run_awaitable(self, connection_handler, awaitable):
+        # run a coroutine route handler on the side loop: a worker waits for it,
+        # the selector thread pauses the connection and goes on serving the others until it finishes
+        if threading.get_ident() != self.selector_thread_id:
+            asyncio.run_coroutine_threadsafe(awaitable, self.get_side_loop()).result() # ConnectionError is handled by run_in_worker()
+            return
+        
+        def done(future):
+            if not future.cancelled() and isinstance(future.exception(), ConnectionError):
+                self.call_in_loop(connection_handler.shutdown, True)
+            self.call_in_loop(self.resume_connection, connection_handler)
+        
+        self.pause_connection(connection_handler)
+        asyncio.run_coroutine_threadsafe(awaitable, self.get_side_loop()).add_done_callback(done)
+    
+    def get_side_loop(self):
+        # one event loop for all the coroutine route handlers (and its default executor, e.g. for asyncio.to_thread()), run by a thread started on first use
+        with self.side_loop_lock:
+            if self.side_loop is None:
+                loop = asyncio.new_event_loop()
+                
+                def run():
+                    asyncio.set_event_loop(loop)
+                    try:
+                        loop.run_forever()
+                        loop.run_until_complete(loop.shutdown_default_executor())
+                    finally:
+                        loop.close()
+                
+                threading.Thread(target = run, name = 'SideLoop', daemon = True).start()
+                self.side_loop = loop
+            return self.side_loop
+    
+    def stop_side_loop(self):
+        with self.side_loop_lock:
+            if self.side_loop is not None:
+                self.side_loop.call_soon_threadsafe(self.side_loop.stop)
+                self.side_loop = None
@@ -0,0 +1,70 @@
+import time
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+    
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+    
+    def cancel(self):
+        self.cancelled = True                                               # lazily dropped when its slot is reached
+
+
+"""
+    TimerWheel
+        hashed timing wheel driven by the selector loop: schedule() / cancel() are O(1),
+        advance() visits only the slots whose ticks have passed.
+        `tick` is the resolution, timers further than `tick * slot_num` ahead wait for more rounds in their slot.
+    Usage:
+        timer = wheel.schedule(15, callback, arg)
+        timer.cancel()
+        selector.select(wheel.next_timeout())   # None if there is no timer, i.e. sleep until IO
+        wheel.advance()                         # run expired callbacks
+"""
+class TimerWheel:
+    def __init__(self, tick = 0.5, slot_num = 256):
+        self.tick = tick
+        self.slot_num = slot_num
+        self.slots = [[] for _ in range(slot_num)]                          # slot of tick `t` -> timers with deadline in ((t - 1) * tick, t * tick]
+        self.current_tick = int(time.monotonic() / tick) + 1                # the first tick not visited yet
+        self.timer_num = 0
+    
+    def schedule(self, delay, callback, *args):
+        deadline = time.monotonic() + delay
+        timer = Timer(deadline, callback, args)
+        deadline_tick = max(int(deadline / self.tick) + 1, self.current_tick)
+        self.slots[deadline_tick % self.slot_num].append(timer)
+        self.timer_num += 1
+        return timer
+    
+    def next_timeout(self):
+        # seconds until the next tick holding an expiring timer, None if there is no timer at all
+        if self.timer_num == 0:
+            return None
+        for distance in range(self.slot_num):
+            tick_time = (self.current_tick + distance) * self.tick
+            for timer in self.slots[(self.current_tick + distance) % self.slot_num]:
+                if not timer.cancelled and timer.deadline <= tick_time:
+                    return max(0, tick_time - time.monotonic())
+        return self.slot_num * self.tick
+    
+    def advance(self):
+        now_tick = int(time.monotonic() / self.tick)
+        self.current_tick = max(self.current_tick, now_tick - self.slot_num + 1) # after a long pause, each slot needs one visit only
+        while self.current_tick <= now_tick:
+            idx = self.current_tick % self.slot_num
+            slot = self.slots[idx]
+            if slot:
+                tick_time = self.current_tick * self.tick
+                expired = [timer for timer in slot if timer.deadline <= tick_time or timer.cancelled]
+                if expired:
+                    self.slots[idx] = [timer for timer in slot if not (timer.deadline <= tick_time or timer.cancelled)] # the others wait for later rounds
+                    self.timer_num -= len(expired)
+                    for timer in expired:
+                        if not timer.cancelled:
+                            timer.callback(*timer.args)
+            self.current_tick += 1
@@ -0,0 +1,53 @@
+import threading
+import queue
+
+from ..log import log_print, LogLevel, do_raise
+
+
+"""
+    WorkerPool
+        a fixed number of worker threads consuming a bounded task queue;
+        submit() never blocks the caller (the selector thread), it returns False when the queue is full.
+"""
+class WorkerPool:
+    def __init__(self, worker_num, queue_size = 0):
+        self.worker_num = worker_num
+        self.tasks = queue.Queue(queue_size)                                # queue_size <= 0 means unbounded
+        self.workers = []
+    
+    def launch(self):
+        for idx in range(self.worker_num):
+            worker = threading.Thread(target = self.work, name = f'worker-{idx}', daemon = True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def shutdown(self):
+        for _ in self.workers:
+            self.tasks.put(None)                                            # one stop mark for each worker
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+    
+    def is_worker(self):
+        # whether the calling thread is one of the workers, which may block on a connection
+        return threading.current_thread() in self.workers
+    
+    def submit(self, func, *args):
+        try:
+            self.tasks.put_nowait((func, args))
+            return True
+        except queue.Full:
+            return False
+    
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            func, args = task
+            try:
+                func(*args)
+            except Exception:
+                if do_raise:
+                    raise
+                log_print('unknown error in worker', LogLevel.ERROR)
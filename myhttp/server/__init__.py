@@ -1,4 +1,6 @@
 from .TCPSocketServer import TCPSocketServer, BaseConnectionHandlerClass
+from .AsyncTCPSocketServer import AsyncTCPSocketServer
 from .EncryptedHTTPConnectionHandler import EncryptedHTTPConnectionHandler
 from .HTTPConnectionHandler import HTTPConnectionHandler
-from .HTTPServer import HTTPServer
\ No newline at end of file
+from .HTTPServer import HTTPServer, AsyncHTTPServer
+from .PreforkLauncher import PreforkLauncher
\ No newline at end of file
@@ -1,9 +1,10 @@
 import sys
+import signal
 import argparse
 
-from myhttp.server import HTTPConnectionHandler, EncryptedHTTPConnectionHandler
+from myhttp.server import HTTPConnectionHandler, EncryptedHTTPConnectionHandler, PreforkLauncher
 from myhttp.log import log_print, LogLevel
-from file_manager import FileManagerServer
+from file_manager import FileManagerServer, AsyncFileManagerServer
 
 
 """
@@ -14,10 +15,22 @@ def cli_parser():
     argument_parser.add_argument('--ip', '-i', type = str, default = '0.0.0.0')
     argument_parser.add_argument('--port', '-p', type = int, default = 80)
     argument_parser.add_argument('--encrypted', '-e', type = bool, default = False)
+    argument_parser.add_argument('--threads', '-t', type = int, default = 0)           # worker threads for requests, 0 -> handle in the selector thread
+    argument_parser.add_argument('--queue-size', '-q', type = int, default = 64)       # pending requests waiting for workers, beyond which 503
+    argument_parser.add_argument('--workers', '-w', type = int, default = 1)           # pre-forked server processes, 1 -> no fork
+    argument_parser.add_argument('--engine', type = str, default = 'selector', choices = ['selector', 'asyncio'])
+    argument_parser.add_argument('--backlog', type = int, default = 128)                # listen() backlog
+    argument_parser.add_argument('--max-connections', type = int, default = 0)         # open connections served at most, 0 -> unlimited
+    argument_parser.add_argument('--accept-queue', type = int, default = 0)            # connections waiting for a slot beyond --max-connections, beyond which 503
+    argument_parser.add_argument('--file-cache', type = int, default = 64)             # MiB of small user files cached in memory (per process), 0 -> no cache
+    argument_parser.add_argument('--index', action = 'store_true')                     # SQLite index of the paths under root_dir, for the search API
+    argument_parser.add_argument('--quota', type = int, default = 0)                   # MiB each user may store, 0 -> unlimited
+    argument_parser.add_argument('--quota-files', type = int, default = 0)             # files and folders each user may store, 0 -> unlimited
     return argument_parser.parse_args()
 
 args = cli_parser()
-server = FileManagerServer(
+ServerClass = AsyncFileManagerServer if args.engine == 'asyncio' else FileManagerServer
+server = ServerClass(
     args.ip,
     args.port,
     ConnectionHandlerClass = HTTPConnectionHandler if not args.encrypted else EncryptedHTTPConnectionHandler,
@@ -27,7 +40,16 @@ server = FileManagerServer(
     api_route = '/backend_api',
     fetch_route = '/',
     upload_route = '/upload',
-    delete_route = '/delete'
+    delete_route = '/delete',
+    worker_threads = args.threads,
+    worker_queue_size = args.queue_size,
+    backlog_size = args.backlog,
+    max_connections = args.max_connections,
+    accept_queue_size = args.accept_queue,
+    file_cache_size = args.file_cache * 1024 * 1024,
+    metadata_index = args.index,
+    quota_bytes = args.quota * 1024 * 1024 if args.quota > 0 else None,
+    quota_files = args.quota_files if args.quota_files > 0 else None
 )
 
 
@@ -50,11 +72,15 @@ def error_handler(code, desc, connection_handler):
     Main
 """
 if __name__ == '__main__':
+    launcher = PreforkLauncher(server, args.workers) if args.workers > 1 else server
+    signal.signal(signal.SIGTERM, lambda signum, frame: launcher.request_graceful_shutdown()) # finish open requests, then exit
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: launcher.hot_restart()) # restart on the same welcome socket, without refusing connections
     try:
-        server.launch()
+        launcher.launch()
     except KeyboardInterrupt:
         log_print('Shutting down...', LogLevel.INFO)
-        server.shutdown()
+        launcher.shutdown()
         log_print('Server is shut down', LogLevel.INFO)
         sys.exit(0)
     except: